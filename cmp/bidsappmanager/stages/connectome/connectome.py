@@ -23,7 +23,7 @@ class ConnectomeConfigUI(ConnectomeConfig):
     ----------
     output_types : list of string
         A list of ``output_types``. Valid ``output_types`` are
-        'gPickle', 'mat', 'cff', 'graphml'
+        'gPickle', 'mat', 'cff', 'graphml', 'h5', 'npz'
 
     connectivity_metrics : list of string
         A list of connectivity metrics to stored. Valid ``connectivity_metrics`` are
@@ -40,7 +40,9 @@ class ConnectomeConfigUI(ConnectomeConfig):
 
     output_types = List(
         ["gPickle"],
-        editor=CheckListEditor(values=["gPickle", "mat", "cff", "graphml"], cols=4),
+        editor=CheckListEditor(
+            values=["gPickle", "mat", "cff", "graphml", "h5", "npz"], cols=6
+        ),
     )
 
     connectivity_metrics = List(
@@ -72,6 +74,19 @@ class ConnectomeConfigUI(ConnectomeConfig):
         Group(
             Item("connectivity_metrics", label="Metrics", style="custom"),
             Item("compute_curvature"),
+            Item("scalar_map_interpolation", label="Scalar map sampling"),
+            Item("streaming", label="Read tractogram by chunks"),
+            Item(
+                "streaming_chunk_size",
+                label="Fibers per chunk",
+                enabled_when="streaming",
+            ),
+            Item("nearest_label_endpoints", label="Assign endpoints to nearest label"),
+            Item(
+                "endpoint_search_radius",
+                label="Search radius (mm)",
+                enabled_when="nearest_label_endpoints",
+            ),
             label="Connectivity matrix",
             show_border=True,
         ),
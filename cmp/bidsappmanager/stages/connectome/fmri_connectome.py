@@ -22,7 +22,10 @@ class ConnectomeConfigUI(ConnectomeConfig):
     ----------
     output_types : list of string
         A list of ``output_types``. Valid ``output_types`` are
-        'gPickle', 'mat', 'cff', 'graphml'
+        'gPickle', 'mat', 'cff', 'graphml', 'h5', 'npz'
+
+    connectivity_estimators : list of string
+        A list of connectivity estimators saved as edge metrics
 
     traits_view : traits.ui.View
         TraitsUI view that displays the Attributes of this class
@@ -34,7 +37,17 @@ class ConnectomeConfigUI(ConnectomeConfig):
 
     output_types = List(
         ["gPickle"],
-        editor=CheckListEditor(values=["gPickle", "mat", "cff", "graphml"], cols=4),
+        editor=CheckListEditor(
+            values=["gPickle", "mat", "cff", "graphml", "h5", "npz"], cols=6
+        ),
+    )
+
+    connectivity_estimators = List(
+        ["corr"],
+        editor=CheckListEditor(
+            values=["corr", "cov", "lw_cov", "precision", "partial_corr", "fisher_z", "tangent"],
+            cols=4,
+        ),
     )
 
     traits_view = View(
@@ -46,6 +59,16 @@ class ConnectomeConfigUI(ConnectomeConfig):
                 visible_when="apply_scrubbing==True",
             ),
         ),
+        Item("connectivity_estimators", style="custom", label="Connectivity estimators"),
+        VGroup(
+            Item("dynamic_fc", label="Dynamic connectivity"),
+            VGroup(
+                Item("window_length", label="Window length (volumes)"),
+                Item("window_step", label="Window step (volumes)"),
+                Item("window_taper", label="Window taper"),
+                visible_when="dynamic_fc==True",
+            ),
+        ),
         Item("output_types", style="custom"),
     )
 
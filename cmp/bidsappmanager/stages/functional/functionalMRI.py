@@ -46,11 +46,22 @@ class FunctionalMRIConfigUI(FunctionalMRIConfig):
             show_border=True,
         ),
         HGroup(
-            Item("lowpass_filter", label="Low cutoff (volumes)"),
-            Item("highpass_filter", label="High cutoff (volumes)"),
+            Item("lowpass_filter", label="Low cutoff (Hz)"),
+            Item("highpass_filter", label="High cutoff (Hz)"),
+            Item("filter_method", label="Filter"),
             label="Bandpass filtering",
             show_border=True,
         ),
+        HGroup(
+            Item("fused_postprocessing", label="Run all steps in memory"),
+            Item(
+                "save_intermediate_images",
+                label="Save intermediate images",
+                enabled_when="fused_postprocessing",
+            ),
+            label="Post-processing",
+            show_border=True,
+        ),
     )
 
 
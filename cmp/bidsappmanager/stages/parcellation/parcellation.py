@@ -59,6 +59,10 @@ class ParcellationConfigUI(ParcellationConfig):
                 label="ANTs precision type",
                 enabled_when="include_thalamic_nuclei_parcellation",
             ),
+            Item(
+                "number_of_threads",
+                label="Number of concurrent FreeSurfer commands",
+            ),
             visible_when='parcellation_scheme=="Lausanne2018"',
         ),
     )
@@ -841,6 +841,8 @@ class DiffusionPipeline(Pipeline):
             ("5tt_warped.nii.gz", self.subject + "_space-DWI_label-5TT_probseg.nii.gz"),
             ("gmwmi_warped.nii.gz", self.subject + "_space-DWI_label-GMWMI_probseg.nii.gz"),
             ("connectome_freesurferaparc", self.subject + "_label-Desikan_conndata-network_connectivity"),
+            ("connectomes.h5", f'{self.subject}_atlas-{bids_atlas_label}_conndata-network_connectivity.h5'),
+            ("connectomes.npz", f'{self.subject}_atlas-{bids_atlas_label}_conndata-network_connectivity.npz'),
             ("dwi.nii.gz", self.subject + "_dwi.nii.gz"),
             ("dwi.bval", self.subject + "_dwi.bval"),
             ("eddy_corrected.nii.gz.eddy_rotated_bvecs", self.subject + "_desc-eddyrotated.bvec"),
@@ -1126,6 +1128,16 @@ class DiffusionPipeline(Pipeline):
                 # fmt:on
 
         if self.stages["Diffusion"].enabled:
+            # The connectome settings determine the ROI dilation and the TRK conversion
+            # of the diffusion stage, without altering its configuration
+            self.stages["Diffusion"].nearest_label_endpoints = (
+                self.stages["Connectome"].enabled
+                and self.stages["Connectome"].config.nearest_label_endpoints
+            )
+            self.stages["Diffusion"].streaming_connectome = (
+                self.stages["Connectome"].enabled
+                and self.stages["Connectome"].config.streaming
+            )
             diff_flow = self.create_stage_flow("Diffusion")
             # fmt:off
             diffusion_flow.connect(
@@ -1159,6 +1171,7 @@ class DiffusionPipeline(Pipeline):
         if self.stages["Connectome"].enabled:
             self.stages["Connectome"].config.probtrackx = False
             self.stages["Connectome"].config.subject = self.global_conf.subject
+            self.stages["Connectome"].config.number_of_cores = self.number_of_cores
             con_flow = self.create_stage_flow("Connectome")
             # fmt:off
             diffusion_flow.connect(
@@ -606,7 +606,11 @@ class fMRIPipeline(Pipeline):
             ("FD.npy", self.subject + "_desc-scrubbing_FD.npy"),
             ("DVARS.npy", self.subject + "_desc-scrubbing_DVARS.npy"),
             ("fMRI_bandpass.nii.gz", self.subject + "_task-rest_desc-bandpass_bold.nii.gz"),
-            ("fMRI_discard_mean.nii.gz",  self.subject + "_meanBOLD.nii.gz")
+            ("fMRI_discard_mean.nii.gz",  self.subject + "_meanBOLD.nii.gz"),
+            ("connectomes.h5", f'{self.subject}_atlas-{bids_atlas_label}_conndata-network_connectivity.h5'),
+            ("connectomes.npz", f'{self.subject}_atlas-{bids_atlas_label}_conndata-network_connectivity.npz'),
+            ("dynamicConnectivity.h5",
+             f'{self.subject}_atlas-{bids_atlas_label}_desc-dynamic_conndata-network_connectivity.h5'),
         ]
         # fmt:on
 
@@ -618,6 +622,8 @@ class fMRIPipeline(Pipeline):
                     f'{self.subject}_space-meanBOLD_atlas-{bids_atlas_label}_dseg.nii.gz'
                 ),
                 ("connectome_freesurferaparc", self.subject + "_atlas-Desikan_conndata-network_connectivity"),
+                ("dynamicConnectivity_freesurferaparc",
+                 self.subject + "_atlas-Desikan_desc-dynamic_conndata-network_connectivity"),
                 ("averageTimeseries_freesurferaparc", self.subject + "_atlas-Desikan_timeseries"),
             ]
             # fmt:on
@@ -631,6 +637,8 @@ class fMRIPipeline(Pipeline):
                     f'{self.subject}_space-meanBOLD_atlas-{bids_atlas_label}_dseg.nii.gz'
                 ),
                 (f"connectome_{bids_atlas_name}", self.subject + f"_atlas-{bids_atlas_label}_conndata-network_connectivity"),
+                (f"dynamicConnectivity_{bids_atlas_name}",
+                 self.subject + f"_atlas-{bids_atlas_label}_desc-dynamic_conndata-network_connectivity"),
                 (f"averageTimeseries_{bids_atlas_name}", self.subject + f"_atlas-{bids_atlas_label}_timeseries"),
             ]
             # fmt:on
@@ -644,6 +652,8 @@ class fMRIPipeline(Pipeline):
                     ),
                     (f'connectome_{scale}',
                      f'{self.subject}_atlas-{bids_atlas_label}_res-{scale}_conndata-network_connectivity'),
+                    (f'dynamicConnectivity_{scale}',
+                     f'{self.subject}_atlas-{bids_atlas_label}_res-{scale}_desc-dynamic_conndata-network_connectivity'),
                     (f'averageTimeseries_{scale}', f'{self.subject}_atlas-{bids_atlas_label}_res-{scale}_timeseries')
                 ]
                 # fmt:on
@@ -872,7 +882,8 @@ class fMRIPipeline(Pipeline):
                     (reg_flow, con_flow, [("outputnode.roi_volumes_registered_crop", "inputnode.roi_volumes_registered")]),
                     (con_flow, fMRI_outputnode, [("outputnode.connectivity_matrices", "connectivity_matrices")]),
                     (con_flow, sinker, [("outputnode.connectivity_matrices", "func.@connectivity_matrices"),
-                                        ("outputnode.avg_timeseries", "func.@avg_timeseries")])
+                                        ("outputnode.avg_timeseries", "func.@avg_timeseries"),
+                                        ("outputnode.dynamic_connectivity", "func.@dynamic_connectivity")])
                 ]
             )
             # fmt:on
@@ -876,6 +876,7 @@ def run_individual(
 
             print(f"--- Set Freesurfer and ANTs to use {number_of_threads} threads by the means of OpenMP")
             anat_pipeline.stages["Segmentation"].config.number_of_threads = number_of_threads
+            anat_pipeline.stages["Parcellation"].config.number_of_threads = number_of_threads
 
             if anat_valid_inputs:
                 print(">> Process anatomical pipeline")
@@ -898,6 +899,7 @@ def run_individual(
 
             print(f"--- Set Freesurfer and ANTs to use {number_of_threads} threads by the means of OpenMP")
             anat_pipeline.stages[ "Segmentation"].config.number_of_threads = number_of_threads
+            anat_pipeline.stages["Parcellation"].config.number_of_threads = number_of_threads
 
             if anat_valid_inputs:
                 print(">> Process anatomical pipeline")
@@ -945,6 +947,7 @@ def run_individual(
 
             print(f"--- Set Freesurfer and ANTs to use {number_of_threads} threads by the means of OpenMP")
             anat_pipeline.stages[ "Segmentation"].config.number_of_threads = number_of_threads
+            anat_pipeline.stages["Parcellation"].config.number_of_threads = number_of_threads
 
             if anat_valid_inputs:
                 print(">> Process anatomical pipeline")
@@ -994,6 +997,7 @@ def run_individual(
 
             print(f"--- Set Freesurfer and ANTs to use {number_of_threads} threads by the means of OpenMP")
             anat_pipeline.stages[ "Segmentation"].config.number_of_threads = number_of_threads
+            anat_pipeline.stages["Parcellation"].config.number_of_threads = number_of_threads
 
             if anat_valid_inputs:
                 print(">> Process anatomical pipeline")
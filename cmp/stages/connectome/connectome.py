@@ -31,8 +31,38 @@ class ConnectomeConfig(HasTraits):
     compute_curvature : traits.Bool
         Compute fiber curvature (Default: False)
 
-    output_types : ['gPickle', 'mat', 'graphml']
-        Output connectome format
+    output_types : ['gPickle', 'mat', 'graphml', 'h5', 'npz']
+        Output connectome format, where 'h5' and 'npz' save the connectomes
+        of all resolutions in a single compressed file
+
+    scalar_map_interpolation : ['nearest', 'trilinear']
+        Interpolation used to sample the additional scalar maps
+        (such as FA or ADC) along the fibers (Default: 'nearest')
+
+    streaming : traits.Bool
+        Read the tractogram by chunks of fibers to bound the memory usage.
+        In this mode, the TCK tractogram produced by MRtrix does not need
+        to be converted to TRK. Fibers are labeled chunk by chunk and only
+        running per-edge sums are kept in memory. The exact medians are
+        computed by reading the per-fiber lengths and mean map values saved
+        on disk again for each block of edges, which holds at once the
+        values of the largest edge. The median of the additional maps is
+        the median of the per-fiber mean values (Default: False)
+
+    streaming_chunk_size : traits.Int
+        Number of fibers read at once in streaming mode (Default: 100000)
+
+    nearest_label_endpoints : traits.Bool
+        Assign the fiber endpoints in unlabeled voxels to the nearest
+        parcellation label, instead of dilating the parcellations in the
+        diffusion stage (Default: False)
+
+    endpoint_search_radius : traits.Float
+        Maximal distance in mm to the nearest label (Default: 2.0)
+
+    number_of_cores : traits.Int
+        Maximal number of resolutions whose connectome is built in parallel,
+        set from the number of cores used by the pipeline (Default: 1)
 
     connectivity_metrics : ['Fiber number', 'Fiber length', 'Fiber density', 'Fiber proportion', 'Normalized fiber density', 'ADC', 'gFA']
         Set of connectome maps to compute
@@ -57,6 +87,12 @@ class ConnectomeConfig(HasTraits):
     # modality = List(['Deterministic','Probabilistic'])
     compute_curvature = Bool(False)
     output_types = List(["gPickle", "mat", "graphml"])
+    scalar_map_interpolation = Enum("nearest", ["nearest", "trilinear"])
+    streaming = Bool(False)
+    streaming_chunk_size = Int(100000)
+    nearest_label_endpoints = Bool(False)
+    endpoint_search_radius = Float(2.0)
+    number_of_cores = Int(1)
     connectivity_metrics = List(
         [
             "Fiber number",
@@ -137,8 +173,16 @@ class ConnectomeStage(Stage):
         cmtk_cmat = pe.Node(
             interface=cmtklib.connectome.DmriCmat(), name="compute_matrice"
         )
+        # Reserve the cores used to process the resolutions in parallel
+        cmtk_cmat.n_procs = self.config.number_of_cores
         cmtk_cmat.inputs.compute_curvature = self.config.compute_curvature
         cmtk_cmat.inputs.output_types = self.config.output_types
+        cmtk_cmat.inputs.scalar_map_interpolation = self.config.scalar_map_interpolation
+        cmtk_cmat.inputs.streaming = self.config.streaming
+        cmtk_cmat.inputs.chunk_size = self.config.streaming_chunk_size
+        cmtk_cmat.inputs.number_of_cores = self.config.number_of_cores
+        if self.config.nearest_label_endpoints:
+            cmtk_cmat.inputs.endpoint_search_radius = self.config.endpoint_search_radius
 
         # Additional maps
         map_merge = pe.Node(interface=util.Merge(9), name="merge_additional_maps")
@@ -46,8 +46,39 @@ class ConnectomeConfig(HasTraits):
         DVARS (RMS of variance over voxels) threshold
         (Default: 4.0)
 
-    output_types : ['gPickle', 'mat', 'cff', 'graphml']
-        Output connectome format
+    connectivity_estimators : traits.List
+        Connectivity estimators saved as edge metrics, among 'corr', 'cov',
+        'lw_cov', 'precision', 'partial_corr', 'fisher_z' and 'tangent'
+        (see :obj:`cmtklib.connectome.CONNECTIVITY_ESTIMATORS`)
+        (Default: ['corr'])
+
+    dynamic_fc : traits.Bool
+        Compute sliding-window functional connectivity matrices, saved with
+        the upper triangle of each window packed in a row of a ``.npy`` array
+        (and in a single ``.h5`` file if 'h5' is an output type).
+        Windows are computed on the unscrubbed time-series, such that they
+        span consecutive volumes and their onsets are acquisition frames.
+        If scrubbing is applied, the number of volumes retained by scrubbing
+        in each window and the indices of the retained volumes are saved
+        along with them (``<scale>/dynamic/retained_frames`` and
+        ``<scale>/dynamic/scrubbing_index``)
+        (Default: False)
+
+    window_length : traits.Int
+        Sliding window length in volumes
+        (Default: 60)
+
+    window_step : traits.Int
+        Number of volumes between the onsets of consecutive windows
+        (Default: 1)
+
+    window_taper : traits.Enum
+        Sliding window weighting function
+        ('rectangular', 'hann' or 'hamming', Default: 'rectangular')
+
+    output_types : ['gPickle', 'mat', 'cff', 'graphml', 'h5', 'npz']
+        Output connectome format, where 'h5' and 'npz' save the connectomes
+        of all resolutions in a single compressed file
 
     log_visualization : traits.Bool
         Log visualization that might be obsolete as this has been detached
@@ -69,6 +100,11 @@ class ConnectomeConfig(HasTraits):
     apply_scrubbing = Bool(False)
     FD_thr = Float(0.2)
     DVARS_thr = Float(4.0)
+    connectivity_estimators = List(["corr"])
+    dynamic_fc = Bool(False)
+    window_length = Int(60)
+    window_step = Int(1)
+    window_taper = Enum("rectangular", ["rectangular", "hann", "hamming"])
     output_types = List(["gPickle", "mat", "cff", "graphml"])
     log_visualization = Bool(True)
     circular_layout = Bool(False)
@@ -105,7 +141,7 @@ class ConnectomeStage(Stage):
             "atlas_info",
             "roi_graphMLs",
         ]
-        self.outputs = ["connectivity_matrices", "avg_timeseries"]
+        self.outputs = ["connectivity_matrices", "avg_timeseries", "dynamic_connectivity"]
 
     def create_workflow(self, flow, inputnode, outputnode):
         """Create the stage worflow.
@@ -130,6 +166,12 @@ class ConnectomeStage(Stage):
         cmtk_cmat.inputs.FD_th = self.config.FD_thr
         cmtk_cmat.inputs.DVARS_th = self.config.DVARS_thr
 
+        cmtk_cmat.inputs.connectivity_estimators = self.config.connectivity_estimators
+        cmtk_cmat.inputs.dynamic_fc = self.config.dynamic_fc
+        cmtk_cmat.inputs.window_length = self.config.window_length
+        cmtk_cmat.inputs.window_step = self.config.window_step
+        cmtk_cmat.inputs.window_taper = self.config.window_taper
+
         if not isdefined(inputnode.inputs.FD) or not isdefined(inputnode.inputs.DVARS):
             cmtk_cmat.inputs.apply_scrubbing = False
 
@@ -144,7 +186,8 @@ class ConnectomeStage(Stage):
                                        ("roi_volumes_registered", "roi_volumes"),
                                        ("roi_graphMLs", "roi_graphmls"),],),
                 (cmtk_cmat, outputnode, [("connectivity_matrices", "connectivity_matrices"),
-                                         ("avg_timeseries", "avg_timeseries"),],),
+                                         ("avg_timeseries", "avg_timeseries"),
+                                         ("dynamic_connectivity", "dynamic_connectivity"),],),
             ]
         )
         # fmt: on
@@ -305,6 +305,19 @@ class DiffusionStage(Stage):
     1. `recon_flow` that estimates tensors or fiber orientation distribution functions from dMRI,
     2. `track_flow` that runs tractography from the output of `recon_flow`.
 
+    Attributes
+    ----------
+    nearest_label_endpoints : traits.Bool
+        Set by the pipeline if the connectome stage assigns fiber endpoints
+        to the nearest label, in which case the ROIs are not dilated
+        whatever ``config.dilate_rois``
+        (Default: False)
+
+    streaming_connectome : traits.Bool
+        Set by the pipeline if the connectome stage reads the tractogram by
+        chunks, in which case the MRtrix tractogram is not converted to TRK
+        (Default: False)
+
     Methods
     -------
     create_workflow()
@@ -324,6 +337,9 @@ class DiffusionStage(Stage):
     cmp.stages.diffusion.tracking.create_mrtrix_tracking_flow
     """
 
+    nearest_label_endpoints = Bool(False)
+    streaming_connectome = Bool(False)
+
     def __init__(self, bids_dir, output_dir):
         """Constructor of a :class:`~cmp.stages.diffusion.diffusion.DiffusionStage` instance."""
         self.name = "diffusion_stage"
@@ -379,7 +395,18 @@ class DiffusionStage(Stage):
         cmp.stages.diffusion.tracking.create_dipy_tracking_flow
         cmp.stages.diffusion.tracking.create_mrtrix_tracking_flow
         """
-        if self.config.dilate_rois:
+        # The connectome stage assigns the endpoints to the nearest label itself,
+        # which makes the dilation of the parcellations unnecessary
+        dilate_rois_enabled = self.config.dilate_rois and not self.nearest_label_endpoints
+        if self.config.dilate_rois and not dilate_rois_enabled:
+            print(
+                "  .. INFO: Fiber endpoints are assigned to the nearest label "
+                "in the connectome stage: ROI dilation is skipped"
+            )
+        # The connectome stage reads TCK tractograms directly in streaming mode
+        convert_to_trk = not self.streaming_connectome
+
+        if dilate_rois_enabled:
 
             dilate_rois = pe.MapNode(
                 interface=fsl.DilateImage(),
@@ -487,7 +514,6 @@ class DiffusionStage(Stage):
                         (inputnode, track_flow, [("wm_mask_registered", "inputnode.wm_mask_resampled")],),
                         # (inputnode, track_flow,[('diffusion','inputnode.DWI')]),
                         (recon_flow, track_flow, [("outputnode.FA", "inputnode.FA")]),
-                        (dilate_rois, track_flow, [("out_file", "inputnode.gm_registered")],)
                         # (recon_flow, track_flow,[('outputnode.SD','inputnode.SD')]),
                     ]
                 )
@@ -507,12 +533,28 @@ class DiffusionStage(Stage):
                         (inputnode, track_flow, [("wm_mask_registered", "inputnode.wm_mask_resampled")],),
                         # (inputnode, track_flow,[('diffusion','inputnode.DWI')]),
                         (recon_flow, track_flow, [("outputnode.FA", "inputnode.FA")]),
-                        (dilate_rois, track_flow, [("out_file", "inputnode.gm_registered")],)
                         # (recon_flow, track_flow,[('outputnode.SD','inputnode.SD')]),
                     ]
                 )
                 # fmt: on
 
+            if dilate_rois_enabled:
+                # fmt: off
+                flow.connect(
+                    [
+                        (dilate_rois, track_flow, [("out_file", "inputnode.gm_registered")])
+                    ]
+                )
+                # fmt: on
+            else:
+                # fmt: off
+                flow.connect(
+                    [
+                        (inputnode, track_flow, [("roi_volumes", "inputnode.gm_registered")])
+                    ]
+                )
+                # fmt: on
+
             if (
                 self.config.dipy_tracking_config.use_act
                 and self.config.dipy_tracking_config.seed_from_gmwmi
@@ -535,7 +577,9 @@ class DiffusionStage(Stage):
             self.config.tracking_processing_tool == "MRtrix"
             and self.config.recon_processing_tool == "MRtrix"
         ):
-            track_flow = create_mrtrix_tracking_flow(self.config.mrtrix_tracking_config)
+            track_flow = create_mrtrix_tracking_flow(
+                self.config.mrtrix_tracking_config, convert_to_trk=convert_to_trk
+            )
             # fmt: off
             flow.connect(
                 [
@@ -547,7 +591,7 @@ class DiffusionStage(Stage):
             )
             # fmt: on
 
-            if self.config.dilate_rois:
+            if dilate_rois_enabled:
                 # fmt: off
                 flow.connect(
                     [
@@ -584,7 +628,9 @@ class DiffusionStage(Stage):
             and self.config.recon_processing_tool == "Dipy"
         ):
 
-            track_flow = create_mrtrix_tracking_flow(self.config.mrtrix_tracking_config)
+            track_flow = create_mrtrix_tracking_flow(
+                self.config.mrtrix_tracking_config, convert_to_trk=convert_to_trk
+            )
 
             if self.config.diffusion_imaging_model != "DSI":
                 # fmt: off
@@ -609,7 +655,7 @@ class DiffusionStage(Stage):
                 )
                 # fmt: on
 
-            if self.config.dilate_rois:
+            if dilate_rois_enabled:
                 # fmt: off
                 flow.connect(
                     [
@@ -888,8 +934,16 @@ class DiffusionStage(Stage):
                     )
                 )
         elif self.config.tracking_processing_tool == "MRtrix":
+            if not self.streaming_connectome:
+                node_name = "trackvis"
+            elif self.config.mrtrix_tracking_config.sift:
+                node_name = "sift_node"
+            elif self.config.diffusion_model == "Deterministic":
+                node_name = "mrtrix_deterministic_tracking"
+            else:
+                node_name = "mrtrix_probabilistic_tracking"
             return os.path.exists(
                 os.path.join(
-                    self.stage_dir, "tracking", "trackvis", "result_trackvis.pklz"
+                    self.stage_dir, "tracking", node_name, "result_%s.pklz" % node_name
                 )
             )
@@ -217,6 +217,7 @@ class MRtrixTrackingConfig(HasTraits):
     sift : traits.Bool
         Filter tractogram using mrtrix3 SIFT
         (Default: True)
+
     """
 
     tracking_mode = Str
@@ -465,7 +466,34 @@ def get_freesurfer_parcellation(roi_files):
     return roi_files[0]
 
 
-def create_mrtrix_tracking_flow(config):
+def _connect_mrtrix_tracks_output(
+    flow, convert_to_trk, inputnode, outputnode, tracks_node, tracks_field
+):
+    """Connect the MRtrix tractogram to the output of the tracking workflow, converting it to TRK if required."""
+    if convert_to_trk:
+        # converter = pe.Node(interface=mrtrix.MRTrix2TrackVis(),name="trackvis")
+        converter = pe.Node(interface=Tck2Trk(), name="trackvis")
+        converter.inputs.out_tracks = "converted.trk"
+        # fmt:off
+        flow.connect(
+            [
+                (tracks_node, converter, [(tracks_field, "in_tracks")]),
+                (inputnode, converter, [("wm_mask_resampled", "in_image")]),
+                (converter, outputnode, [("out_tracks", "track_file")]),
+            ]
+        )
+        # fmt:on
+    else:
+        # fmt:off
+        flow.connect(
+            [
+                (tracks_node, outputnode, [(tracks_field, "track_file")]),
+            ]
+        )
+        # fmt:on
+
+
+def create_mrtrix_tracking_flow(config, convert_to_trk=True):
     """Create the tractography sub-workflow of the `DiffusionStage` using MRtrix3.
 
     Parameters
@@ -473,6 +501,10 @@ def create_mrtrix_tracking_flow(config):
     config : MRtrixTrackingConfig
         Sub-workflow configuration object
 
+    convert_to_trk : bool
+        If `True`, convert the TCK tractogram to TRK with :class:`~cmtklib.diffusion.Tck2Trk`
+        (not required when the connectome stage reads the tractogram by chunks)
+
     Returns
     -------
     flow : nipype.pipeline.engine.Workflow
@@ -583,10 +615,6 @@ def create_mrtrix_tracking_flow(config):
             )
             # fmt:on
 
-        # converter = pe.Node(interface=mrtrix.MRTrix2TrackVis(),name="trackvis")
-        converter = pe.Node(interface=Tck2Trk(), name="trackvis")
-        converter.inputs.out_tracks = "converted.trk"
-
         if config.sift:
 
             filter_tractogram = pe.Node(interface=FilterTractogram(), name="sift_node")
@@ -607,28 +635,19 @@ def create_mrtrix_tracking_flow(config):
                     ]
                 )
                 # fmt:on
-            # fmt:off
-            flow.connect(
-                [(filter_tractogram, converter, [("out_tracks", "in_tracks")])]
-            )
-            # fmt:on
+            tracks_node, tracks_field = filter_tractogram, "out_tracks"
         else:
-            # fmt:off
-            flow.connect(
-                [
-                    (mrtrix_tracking, converter, [("tracked", "in_tracks")]),
-                ]
-            )
-            # fmt:on
+            tracks_node, tracks_field = mrtrix_tracking, "tracked"
         # fmt:off
         flow.connect(
             [
                 (inputnode, mrtrix_tracking, [("DWI", "in_file")]),
-                (inputnode, converter, [("wm_mask_resampled", "in_image")]),
-                (converter, outputnode, [("out_tracks", "track_file")]),
             ]
         )
         # fmt:on
+        _connect_mrtrix_tracks_output(
+            flow, convert_to_trk, inputnode, outputnode, tracks_node, tracks_field
+        )
 
     elif config.tracking_mode == "Probabilistic":
         mrtrix_tracking = pe.Node(
@@ -651,9 +670,6 @@ def create_mrtrix_tracking_flow(config):
         else:
             mrtrix_tracking.inputs.inputmodel = "Tensor_Prob"
 
-        converter = pe.Node(interface=Tck2Trk(), name="trackvis")
-        converter.inputs.out_tracks = "converted.trk"
-
         if config.use_act:
             # fmt:off
             flow.connect(
@@ -710,28 +726,19 @@ def create_mrtrix_tracking_flow(config):
                     ]
                 )
                 # fmt:on
-            # fmt:off
-            flow.connect(
-                [(filter_tractogram, converter, [("out_tracks", "in_tracks")])]
-            )
-            # fmt:on
+            tracks_node, tracks_field = filter_tractogram, "out_tracks"
         else:
-            # fmt:off
-            flow.connect(
-                [
-                    (mrtrix_tracking, converter, [("tracked", "in_tracks")]),
-                ]
-            )
-            # fmt:on
+            tracks_node, tracks_field = mrtrix_tracking, "tracked"
 
         # fmt:off
         flow.connect(
             [
                 (inputnode, mrtrix_tracking, [("DWI", "in_file")]),
-                (inputnode, converter, [("wm_mask_resampled", "in_image")]),
-                (converter, outputnode, [("out_tracks", "track_file")]),
             ]
         )
         # fmt:on
+        _connect_mrtrix_tracks_output(
+            flow, convert_to_trk, inputnode, outputnode, tracks_node, tracks_field
+        )
 
     return flow
@@ -16,11 +16,16 @@ from traits.api import *
 import nipype.pipeline.engine as pe
 from nipype.interfaces.base import isdefined
 import nipype.interfaces.utility as util
-from nipype.interfaces import afni
 
 # Own imports
 from cmp.stages.common import Stage
-from cmtklib.functionalMRI import Scrubbing, Detrending, NuisanceRegression
+from cmtklib.functionalMRI import (
+    Scrubbing,
+    Detrending,
+    NuisanceRegression,
+    BandpassFilter,
+    FunctionalPostprocessing,
+)
 
 
 class FunctionalMRIConfig(HasTraits):
@@ -53,17 +58,32 @@ class FunctionalMRIConfig(HasTraits):
         (Default: "Linear")
 
     lowpass_filter = Float
-        Lowpass filter frequency
+        Low cutoff frequency in Hz of the bandpass filter, i.e. lower bound
+        of the passband (frequencies below are removed, disabled if 0)
         (Default: 0.01)
 
     highpass_filter = Float
-        Highpass filter frequency
+        High cutoff frequency in Hz of the bandpass filter, i.e. upper bound
+        of the passband (frequencies above are removed, disabled if 0)
         (Default: 0.1)
 
+    filter_method = Enum("fft", "butterworth")
+        Ideal FFT filter or zero-phase Butterworth filter
+        (Default: "fft")
+
     scrubbing = Bool
         Perform scrubbing
         (Default: True)
 
+    fused_postprocessing = Bool
+        Run scrubbing, detrending, nuisance regression and filtering
+        in memory in a single node, writing only the final image
+        (Default: False)
+
+    save_intermediate_images = Bool
+        Save the image after each step in fused post-processing
+        (Default: False)
+
     See Also
     --------
     cmp.stages.functional.functionalMRI.FunctionalMRIStage
@@ -82,9 +102,13 @@ class FunctionalMRIConfig(HasTraits):
 
     lowpass_filter = Float(0.01)
     highpass_filter = Float(0.1)
+    filter_method = Enum("fft", "butterworth")
 
     scrubbing = Bool(True)
 
+    fused_postprocessing = Bool(False)
+    save_intermediate_images = Bool(False)
+
 
 class FunctionalMRIStage(Stage):
     """Class that represents the post-registration preprocessing stage of the `fMRIPipeline`.
@@ -132,6 +156,10 @@ class FunctionalMRIStage(Stage):
         outputnode : nipype.interfaces.utility.IdentityInterface
             Identity interface describing the outputs of the stage
         """
+        if self.config.fused_postprocessing:
+            self.create_fused_workflow(flow, inputnode, outputnode)
+            return
+
         if self.config.scrubbing and isdefined(inputnode.inputs.motion_par_file):
             scrubbing = pe.Node(interface=Scrubbing(), name="scrubbing")
             # fmt:off
@@ -217,30 +245,18 @@ class FunctionalMRIStage(Stage):
             name="filter_output",
         )
         if self.config.lowpass_filter > 0 or self.config.highpass_filter > 0:
-            from cmtklib.interfaces.afni import Bandpass
-
-            filtering = pe.Node(interface=Bandpass(), name="temporal_filter")
-            # filtering = pe.Node(interface=afni.Bandpass(),name='temporal_filter')
-            converter = pe.Node(
-                interface=afni.AFNItoNIFTI(out_file="fMRI_bandpass.nii.gz"),
-                name="converter",
-            )
-            # FIXME: Seems that lowpass and highpass inputs of the nipype 3DBandPass interface swaped low and high frequencies
-            filtering.inputs.lowpass = self.config.highpass_filter
+            filtering = pe.Node(interface=BandpassFilter(), name="temporal_filter")
+            # The low (high) cutoff of the config is the lower (upper) bound of the passband,
+            # i.e. the cutoff of the high-pass (low-pass) filter
             filtering.inputs.highpass = self.config.lowpass_filter
-
-            # if self.config.detrending:
-            #    filtering.inputs.no_detrend = True
-
-            filtering.inputs.no_detrend = True
+            filtering.inputs.lowpass = self.config.highpass_filter
+            filtering.inputs.method = self.config.filter_method
 
             # fmt:off
             flow.connect(
                 [
                     (nuisance_output, filtering, [("nuisance_output", "in_file")]),
-                    # (filtering,filter_output,[("out_file","filter_output")])
-                    (filtering, converter, [("out_file", "in_file")]),
-                    (converter, filter_output, [("out_file", "filter_output")]),
+                    (filtering, filter_output, [("out_file", "filter_output")]),
                 ]
             )
             # fmt:on
@@ -257,11 +273,85 @@ class FunctionalMRIStage(Stage):
         flow.connect([(filter_output, outputnode, [("filter_output", "func_file")])])
         # fmt:on
 
+    def create_fused_workflow(self, flow, inputnode, outputnode):
+        """Create the stage workflow with a single :class:`~cmtklib.functionalMRI.FunctionalPostprocessing` node.
+
+        Parameters
+        ----------
+        flow : nipype.pipeline.engine.Workflow
+            The nipype.pipeline.engine.Workflow instance of the fMRI pipeline
+
+        inputnode : nipype.interfaces.utility.IdentityInterface
+            Identity interface describing the inputs of the stage
+
+        outputnode : nipype.interfaces.utility.IdentityInterface
+            Identity interface describing the outputs of the stage
+        """
+        postprocessing = pe.Node(
+            interface=FunctionalPostprocessing(), name="postprocessing"
+        )
+        postprocessing.inputs.detrending = self.config.detrending
+        postprocessing.inputs.detrending_mode = self.config.detrending_mode
+        postprocessing.inputs.global_nuisance = self.config.global_nuisance
+        postprocessing.inputs.csf_nuisance = self.config.csf
+        postprocessing.inputs.wm_nuisance = self.config.wm
+        postprocessing.inputs.motion_nuisance = self.config.motion
+        # The low (high) cutoff of the config is the lower (upper) bound of the passband
+        postprocessing.inputs.highpass = self.config.lowpass_filter
+        postprocessing.inputs.lowpass = self.config.highpass_filter
+        postprocessing.inputs.filter_method = self.config.filter_method
+        postprocessing.inputs.scrubbing = self.config.scrubbing and isdefined(
+            inputnode.inputs.motion_par_file
+        )
+        postprocessing.inputs.save_intermediate = self.config.save_intermediate_images
+        # fmt:off
+        flow.connect(
+            [
+                (inputnode, postprocessing, [("preproc_file", "in_file"),
+                                             ("registered_roi_volumes", "gm_file"),
+                                             ("eroded_brain", "brainfile"),
+                                             ("eroded_csf", "csf_file"),
+                                             ("registered_wm", "wm_file"),
+                                             ("motion_par_file", "motion_file")]),
+                (postprocessing, outputnode, [("out_file", "func_file")]),
+            ]
+        )
+        # fmt:on
+        if postprocessing.inputs.scrubbing:
+            # fmt:off
+            flow.connect(
+                [
+                    (postprocessing, outputnode, [("fd_npy", "FD"),
+                                                  ("dvars_npy", "DVARS")]),
+                ]
+            )
+            # fmt:on
+
     def define_inspect_outputs(self):  # pragma: no cover
         """Update the `inspect_outputs` class attribute.
 
         It contains a dictionary of stage outputs with corresponding commands for visual inspection.
         """
+        if self.config.fused_postprocessing:
+            res_dir = os.path.join(self.stage_dir, "postprocessing")
+            for label, fname in [
+                ("Detrending output", "fMRI_detrending.nii.gz"),
+                ("Regression output", "fMRI_nuisance.nii.gz"),
+                ("Filter output", "fMRI_bandpass.nii.gz"),
+            ]:
+                if os.path.exists(os.path.join(res_dir, fname)):
+                    self.inspect_outputs_dict[label] = [
+                        "fsleyes",
+                        "-sdefault",
+                        os.path.join(res_dir, fname),
+                        "-cm",
+                        "brain_colours_blackbdy_iso",
+                    ]
+            self.inspect_outputs = sorted(
+                [key for key in list(self.inspect_outputs_dict.keys())], key=str.lower
+            )
+            return
+
         if (
             self.config.wm
             or self.config.global_nuisance
@@ -290,7 +380,7 @@ class FunctionalMRIStage(Stage):
                 ]
 
         if self.config.lowpass_filter > 0 or self.config.highpass_filter > 0:
-            res_dir = os.path.join(self.stage_dir, "converter")
+            res_dir = os.path.join(self.stage_dir, "temporal_filter")
             filt = os.path.join(res_dir, "fMRI_bandpass.nii.gz")
             if os.path.exists(filt):
                 self.inspect_outputs_dict["Filter output"] = [
@@ -312,7 +402,13 @@ class FunctionalMRIStage(Stage):
         -------
         `True` if the stage has been run successfully
         """
-        if self.config.lowpass_filter > 0 or self.config.highpass_filter > 0:
+        if self.config.fused_postprocessing:
+            return os.path.exists(
+                os.path.join(
+                    self.stage_dir, "postprocessing", "result_postprocessing.pklz"
+                )
+            )
+        elif self.config.lowpass_filter > 0 or self.config.highpass_filter > 0:
             return os.path.exists(
                 os.path.join(
                     self.stage_dir, "temporal_filter", "result_temporal_filter.pklz"
@@ -89,6 +89,11 @@ class ParcellationConfig(HasTraits):
         Instance of :obj:`~cmtklib.bids.io.CustomParcellationBIDSFile`
         that describes the custom BIDS-formatted brain parcellation file
 
+    number_of_threads : traits.Int
+        Number of FreeSurfer commands run concurrently to create
+        the 'Lausanne2018' parcellation
+        (Default: 1)
+
     See Also
     --------
     cmp.stages.parcellation.parcellation.ParcellationStage
@@ -112,6 +117,9 @@ class ParcellationConfig(HasTraits):
         desc="Instance of :obj:`~cmtklib.bids.io.CustomParcellationBIDSFile`"
              "that describes the custom BIDS-formatted brain parcellation file"
     )
+    number_of_threads = Int(
+        1, desc="Number of FreeSurfer commands run concurrently to create the Lausanne2018 parcellation"
+    )
 
 
 class ParcellationStage(Stage):
@@ -183,6 +191,7 @@ class ParcellationStage(Stage):
             )
             parc_node.inputs.parcellation_scheme = self.config.parcellation_scheme
             parc_node.inputs.erode_masks = True
+            parc_node.inputs.number_of_threads = self.config.number_of_threads
             # fmt: off
             flow.connect(
                 [
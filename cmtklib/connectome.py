@@ -9,8 +9,11 @@
 from os import path as op
 import csv
 import glob
+import multiprocessing
 import os
-import copy
+import shutil
+from xml.sax.saxutils import escape, quoteattr
+from concurrent.futures import ProcessPoolExecutor
 
 from traits.api import *
 
@@ -32,8 +35,10 @@ from nipype.interfaces.base import (
 )
 from nipype.utils.filemanip import split_filename
 
-from .util import mean_curvature, length
+from .util import streamline_lengths, streamline_mean_curvature
+from .image import load_image_data, iter_spatial_chunks
 from .parcellation import get_parcellation
+from .diffusion import iter_streamline_chunks, save_streamlines_subset
 
 
 def group_analysis_sconn(output_dir, subjects_to_be_analyzed):
@@ -45,117 +50,2120 @@ def compute_curvature_array(fib):
     """Computes the curvature array."""
     print("Compute curvature ...")
 
+    points, offsets = concatenate_fibers(fib)
+    return streamline_mean_curvature(points, offsets).reshape(-1, 1)
+
+
+def create_endpoints_array(fib, voxelSize, print_info):
+    """Create the endpoints arrays for each fiber.
+
+    Parameters
+    ----------
+    fib: the fibers data
+
+    voxelSize: 3-tuple
+        It contains the voxel size of the ROI image
+
+    print_info : bool
+        If True, print extra information
+
+    Returns
+    -------
+    (endpoints: matrix of size [#fibers, 2, 3] containing for each fiber the
+               index of its first and last point in the voxelSize volume
+    endpointsmm) : endpoints in milimeter coordinates
+
+    """
+    if print_info:
+        print("========================")
+        print("create_endpoints_array")
+
     n = len(fib)
-    pc = -1
-    meancurv = np.zeros((n, 1))
+
+    # Gather the first and last points of all fibers
+    endpointsmm = np.zeros((n, 2, 3))
     for i, fi in enumerate(fib):
-        # Percent counter
-        pcN = int(round(float(100 * i) / n))
-        if pcN > pc and pcN % 1 == 0:
-            pc = pcN
-            print("%4.0f%%" % pc)
-        meancurv[i, 0] = mean_curvature(fi[0])
+        endpointsmm[i, 0, :] = fi[0][0, :]
+        endpointsmm[i, 1, :] = fi[0][-1, :]
+
+    # Translate from mm to index (truncation as done by int())
+    endpoints = np.trunc(endpointsmm / np.asarray(voxelSize[:3], dtype=np.float64))
+
+    if print_info:
+        print("  ... %i endpoints pairs created" % n)
+
+    # Return the matrices
+    return endpoints, endpointsmm
+
+
+def compute_nearest_label_volume(roi_data, voxel_size, max_distance, cache=None):
+    """Assign to each unlabeled voxel the label of the nearest labeled voxel.
+
+    The nearest labeled voxel of each unlabeled voxel is found with a
+    Euclidean distance transform in millimeters. Labeled voxels keep their
+    label and unlabeled voxels farther than `max_distance` from any labeled
+    voxel stay unlabeled.
+
+    Parameters
+    ----------
+    roi_data : numpy.ndarray
+        Parcellation volume
+
+    voxel_size : 3-tuple
+        Voxel size in mm
+
+    max_distance : float
+        Maximal distance in mm to the nearest labeled voxel
+
+    cache : dict
+        Optional dictionary where the distance transform is stored, so that it is
+        computed only once for parcellations sharing the same labeled voxels
+        (such as the resolutions of the Lausanne2018 parcellation)
+
+    Returns
+    -------
+    nearest_label_data : numpy.ndarray
+        Volume where each voxel is given its label or the label of the nearest labeled voxel
+    """
+    from scipy import ndimage
+
+    background = roi_data == 0
+    if not background.any() or background.all():
+        return roi_data.copy()
+
+    if cache is not None and np.array_equal(cache.get("background"), background):
+        distances, indices = cache["distances"], cache["indices"]
+    else:
+        indices = np.empty((3,) + background.shape, dtype=np.int32)
+        distances = ndimage.distance_transform_edt(
+            background, sampling=voxel_size[:3], return_indices=True, indices=indices
+        )
+        if cache is not None:
+            cache.update(background=background, distances=distances, indices=indices)
+
+    nearest_label_data = roi_data[tuple(indices)]
+    nearest_label_data[distances > max_distance] = 0
+    return nearest_label_data
+
+
+def label_fiber_endpoints(endpoints, roi_volumes_data):
+    """Look up the parcellation labels of the fiber endpoints for a set of ROI volumes.
+
+    Endpoint voxel indices are converted once to linear indices that are
+    then used to retrieve the labels of all ROI volumes, in one fancy-indexing
+    pass per volume. Endpoints falling outside the volume grid are flagged
+    by a mask and given the label 0.
+
+    Parameters
+    ----------
+    endpoints : numpy.ndarray
+        Matrix of size [#fibers, 2, 3] containing for each fiber the voxel
+        index of its first and last point (See :func:`create_endpoints_array`)
+
+    roi_volumes_data : list of numpy.ndarray
+        List of 3D parcellation volumes
+
+    Returns
+    -------
+    endpoint_labels : list of numpy.ndarray
+        For each ROI volume, matrix of size [#fibers, 2] containing the labels
+        of the first and last point of each fiber
+
+    inside : list of numpy.ndarray
+        For each ROI volume, boolean array of size [#fibers] that is `True`
+        when both fiber endpoints are located inside the volume
+    """
+    vox = np.asarray(endpoints).reshape(-1, 3).astype(np.int64)
+
+    endpoint_labels = []
+    inside = []
+    # Linear indices are shared by all the volumes of same shape
+    lookup_cache = {}
+    for roi_data in roi_volumes_data:
+        shape = roi_data.shape[:3]
+        if shape not in lookup_cache:
+            vox_inside = np.all((vox >= 0) & (vox < np.asarray(shape)), axis=1)
+            lin_idx = np.zeros(vox.shape[0], dtype=np.int64)
+            lin_idx[vox_inside] = np.ravel_multi_index(tuple(vox[vox_inside].T), shape)
+            lookup_cache[shape] = (lin_idx, vox_inside)
+        lin_idx, vox_inside = lookup_cache[shape]
+
+        labels = np.take(np.asarray(roi_data).reshape(-1), lin_idx).astype(np.int64)
+        labels[~vox_inside] = 0
+
+        endpoint_labels.append(labels.reshape(-1, 2))
+        inside.append(vox_inside.reshape(-1, 2).all(axis=1))
+
+    return endpoint_labels, inside
+
+
+def filter_fiber_labels(endpoint_labels, inside, n_rois):
+    """Classify the fibers based on their endpoint labels.
+
+    Parameters
+    ----------
+    endpoint_labels : numpy.ndarray
+        Matrix of size [#fibers, 2] containing the labels of the fiber
+        endpoints (See :func:`label_fiber_endpoints`)
+
+    inside : numpy.ndarray
+        Boolean array of size [#fibers] that is `True` when both fiber
+        endpoints are located inside the volume
+
+    n_rois : int
+        Number of regions expected by the parcellation node information
+
+    Returns
+    -------
+    fiberlabels : numpy.ndarray
+        Matrix of size [#fibers, 2] with the sorted start / end ROI labels of
+        the valid fibers, -1 as start label for orphan fibers, and 0 otherwise
+
+    valid : numpy.ndarray
+        Boolean array of size [#fibers] that is `True` for fibers connecting
+        two labeled regions
+
+    orphans : numpy.ndarray
+        Boolean array of size [#fibers] that is `True` for fibers starting or
+        terminating in a voxel which is not labeled
+
+    outside : numpy.ndarray
+        Boolean array of size [#fibers] that is `True` for fibers starting or
+        terminating outside the volume
+
+    overflow : numpy.ndarray
+        Boolean array of size [#fibers] that is `True` for fibers starting or
+        terminating in a voxel labeled higher than `n_rois`
+    """
+    start_roi = endpoint_labels[:, 0]
+    end_roi = endpoint_labels[:, 1]
+
+    outside = ~inside
+    orphans = inside & ((start_roi == 0) | (end_roi == 0))
+    overflow = inside & ~orphans & ((start_roi > n_rois) | (end_roi > n_rois))
+    valid = inside & ~orphans & ~overflow
+
+    fiberlabels = np.zeros((endpoint_labels.shape[0], 2), dtype=np.int32)
+    fiberlabels[orphans, 0] = -1
+    # Enforce startROI < endROI
+    fiberlabels[valid, 0] = np.minimum(start_roi[valid], end_roi[valid])
+    fiberlabels[valid, 1] = np.maximum(start_roi[valid], end_roi[valid])
+
+    return fiberlabels, valid, orphans, outside, overflow
+
+
+def compute_roi_node_information(roi_data):
+    """Compute the volume and the mean voxel position of all the ROIs of a parcellation.
+
+    Parameters
+    ----------
+    roi_data : numpy.ndarray
+        3D parcellation volume
+
+    Returns
+    -------
+    roi_volume : numpy.ndarray
+        Array indexed by ROI label giving its number of voxels
+
+    roi_position : numpy.ndarray
+        Array of size [max label + 1, 3] indexed by ROI label giving the mean
+        position of its voxels in voxel coordinates (NaN for empty labels)
+    """
+    labels = np.asarray(roi_data).reshape(-1).astype(np.int64)
+    labels[labels < 0] = 0
+    n_labels = labels.max() + 1 if labels.size > 0 else 1
+
+    roi_volume = np.bincount(labels, minlength=n_labels)
+    roi_position = np.zeros((n_labels, 3), dtype=np.float64)
+    coords = np.unravel_index(np.arange(labels.size), np.asarray(roi_data).shape[:3])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for axis in range(3):
+            roi_position[:, axis] = np.bincount(
+                labels, weights=coords[axis], minlength=n_labels
+            ) / roi_volume
+
+    return roi_volume, roi_position
+
+
+def extract_roi_timeseries(
+    fdata, roi_volumes_data, n_rois, return_counts=False, return_std=False, chunk_size=50
+):
+    """Compute the average time-series of the ROIs of several parcellations in one pass.
+
+    A sparse indicator matrix mapping the voxels to the ROIs of all the
+    parcellations is built once, and the sums over ROIs of all time points
+    of a chunk are obtained with a single sparse matrix product, such that
+    the 4D data is traversed only once.
+
+    Parameters
+    ----------
+    fdata : numpy.ndarray
+        4D fMRI data array (X x Y x Z x T)
+
+    roi_volumes_data : list of numpy.ndarray
+        3D parcellation volumes registered to the fMRI data
+
+    n_rois : list of int
+        Number of ROIs of each parcellation, labeled from 1 to `n_rois`
+
+    return_counts : bool
+        If `True`, return the number of voxels of each ROI
+
+    return_std : bool
+        If `True`, return the standard deviation over the voxels of each ROI
+        at each time point
+
+    chunk_size : int
+        Number of time points processed at once
+
+    Returns
+    -------
+    timeseries : list of numpy.ndarray
+        Average time-series of shape (n_rois, T) of each parcellation
+        (NaN for empty ROIs)
+
+    counts : list of numpy.ndarray
+        Number of voxels of each ROI of each parcellation (if `return_counts`)
+
+    std : list of numpy.ndarray
+        Standard deviation time-series of shape (n_rois, T)
+        of each parcellation (if `return_std`)
+    """
+    from scipy import sparse
+
+    tp = fdata.shape[3]
+    labels = [np.asarray(data).astype(np.int64) for data in roi_volumes_data]
+    # Voxels belonging to at least one ROI
+    inside = np.zeros(fdata.shape[:3], dtype=bool)
+    for n, label in zip(n_rois, labels):
+        inside |= (label > 0) & (label <= n)
+    voxels = np.nonzero(inside)
+
+    # Stacked indicator matrices of all parcellations (ROIs x voxels)
+    rows, cols, offsets = [], [], np.concatenate(([0], np.cumsum(n_rois)))
+    for offset, n, label in zip(offsets[:-1], n_rois, labels):
+        label = label[voxels]
+        valid = np.flatnonzero((label > 0) & (label <= n))
+        rows.append(offset + label[valid] - 1)
+        cols.append(valid)
+    rows = np.concatenate(rows)
+    indicator = sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, np.concatenate(cols))),
+        shape=(offsets[-1], len(voxels[0])),
+    )
+    counts = np.asarray(indicator.sum(axis=1)).ravel()
+
+    sums = np.zeros((offsets[-1], tp))
+    sums_sq = np.zeros((offsets[-1], tp)) if return_std else None
+    for index, (start, stop) in iter_spatial_chunks(fdata.shape, axis=3, chunk_size=chunk_size):
+        Y = fdata[index][voxels].astype(np.float64)
+        sums[:, start:stop] = indicator.dot(Y)
+        if return_std:
+            sums_sq[:, start:stop] = indicator.dot(np.square(Y))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts[:, np.newaxis]
+        if return_std:
+            std = np.sqrt(np.clip(sums_sq / counts[:, np.newaxis] - np.square(means), 0, None))
+
+    results = [[means[offsets[k]:offsets[k + 1]] for k in range(len(n_rois))]]
+    if return_counts:
+        results.append([counts[offsets[k]:offsets[k + 1]].astype(np.int64) for k in range(len(n_rois))])
+    if return_std:
+        results.append([std[offsets[k]:offsets[k + 1]] for k in range(len(n_rois))])
+    return results[0] if len(results) == 1 else tuple(results)
+
+
+def _ledoit_wolf_shrinkage(x):
+    """Return the Ledoit-Wolf shrinkage coefficient of centered observations of shape (T, N)."""
+    n_samples, n_features = x.shape
+    x2 = np.square(x)
+    emp_cov_trace = x2.sum() / n_samples
+    mu = emp_cov_trace / n_features
+    beta_ = np.sum(np.dot(x2.T, x2))
+    delta_ = np.sum(np.square(np.dot(x.T, x))) / n_samples ** 2
+    beta = (beta_ / n_samples - delta_) / (n_features * n_samples)
+    delta = (delta_ - 2.0 * mu * emp_cov_trace + n_features * mu ** 2) / n_features
+    beta = min(beta, delta)
+    return 0.0 if beta == 0 else beta / delta
+
+
+class ConnectivityEstimates(object):
+    """Cache of the quantities derived from the covariance of ROI time-series.
+
+    The empirical covariance is computed once, and each derived quantity
+    (standard deviations, Ledoit-Wolf covariance, precision, ...) is computed
+    on first request and cached, such that several connectivity estimators
+    of the same parcellation share the expensive steps (e.g. the inverse).
+    ROIs with undefined or constant time-series are left out of the
+    shrinkage and inverse computations and get NaN values.
+
+    Parameters
+    ----------
+    ts : numpy.ndarray
+        ROI time-series of shape (N, T)
+
+    Examples
+    --------
+    >>> from cmtklib.connectome import ConnectivityEstimates
+    >>> estimates = ConnectivityEstimates(np.random.randn(10, 200))
+    >>> partial_corr = estimates.get('partial_corr')
+    """
+
+    def __init__(self, ts):
+        self.ts = np.asarray(ts, dtype=np.float64)
+        self._cache = {}
+
+    def get(self, name):
+        """Return the cached quantity `name`, computing it if needed."""
+        if name not in self._cache:
+            self._cache[name] = getattr(self, "_compute_%s" % name)()
+        return self._cache[name]
+
+    def _compute_cov(self):
+        with np.errstate(invalid="ignore"):
+            return np.atleast_2d(np.cov(self.ts))
+
+    def _compute_std(self):
+        return np.sqrt(np.diag(self.get("cov")))
+
+    def _compute_valid(self):
+        std = self.get("std")
+        return np.isfinite(std) & (std > 0)
+
+    def _compute_corr(self):
+        std = self.get("std")
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.clip(self.get("cov") / np.outer(std, std), -1, 1)
+
+    def _compute_lw_cov(self):
+        valid = self.get("valid")
+        lw_cov = np.full(self.get("cov").shape, np.nan)
+        if valid.any():
+            x = self.ts[valid].T
+            x = x - x.mean(axis=0)
+            shrinkage = _ledoit_wolf_shrinkage(x)
+            emp_cov = np.dot(x.T, x) / x.shape[0]
+            mu = np.trace(emp_cov) / emp_cov.shape[0]
+            shrunk = (1.0 - shrinkage) * emp_cov
+            shrunk.flat[:: emp_cov.shape[0] + 1] += shrinkage * mu
+            lw_cov[np.ix_(valid, valid)] = shrunk
+        return lw_cov
+
+    def _compute_precision(self):
+        valid = self.get("valid")
+        precision = np.full(self.get("cov").shape, np.nan)
+        if valid.any():
+            precision[np.ix_(valid, valid)] = np.linalg.inv(
+                self.get("lw_cov")[np.ix_(valid, valid)]
+            )
+        return precision
+
+    def _compute_lw_corr(self):
+        std = np.sqrt(np.diag(self.get("lw_cov")))
+        return self.get("lw_cov") / np.outer(std, std)
+
+    def _compute_eigh_lw_corr(self):
+        valid = self.get("valid")
+        return np.linalg.eigh(self.get("lw_corr")[np.ix_(valid, valid)])
+
+
+def _partial_correlation(estimates):
+    precision = estimates.get("precision")
+    d = np.sqrt(np.diag(precision))
+    partial_corr = -precision / np.outer(d, d)
+    np.fill_diagonal(partial_corr, np.where(estimates.get("valid"), 1.0, np.nan))
+    return partial_corr
+
+
+def _fisher_z(estimates):
+    corr = estimates.get("corr").copy()
+    # The transform of a perfect correlation is infinite and left undefined
+    corr[np.abs(corr) >= 1] = np.nan
+    return np.arctanh(corr)
+
+
+def _tangent(estimates):
+    valid = estimates.get("valid")
+    tangent = np.full(estimates.get("cov").shape, np.nan)
+    if valid.any():
+        eigvals, eigvecs = estimates.get("eigh_lw_corr")
+        tangent[np.ix_(valid, valid)] = np.dot(eigvecs * np.log(eigvals), eigvecs.T)
+    return tangent
+
+
+CONNECTIVITY_ESTIMATORS = {
+    "corr": lambda estimates: estimates.get("corr"),
+    "cov": lambda estimates: estimates.get("cov"),
+    "lw_cov": lambda estimates: estimates.get("lw_cov"),
+    "precision": lambda estimates: estimates.get("precision"),
+    "partial_corr": _partial_correlation,
+    "fisher_z": _fisher_z,
+    "tangent": _tangent,
+}
+"""Functional connectivity estimators indexed by edge metric name.
+
+Each estimator is a function that takes a :class:`ConnectivityEstimates`
+instance and returns a matrix of size [N, N]:
+
+* ``corr``: Pearson's correlation coefficient
+* ``cov``: empirical covariance
+* ``lw_cov``: Ledoit-Wolf shrinkage covariance
+* ``precision``: inverse of the Ledoit-Wolf covariance
+* ``partial_corr``: partial correlation derived from the precision
+* ``fisher_z``: Fisher z-transform of the correlation (undefined for ``|r| = 1``)
+* ``tangent``: tangent-space projection at the identity of the Ledoit-Wolf
+  correlation, i.e. its matrix logarithm
+
+New estimators can be registered by adding functions to this dictionary.
+"""
+
+
+def compute_dynamic_fc(ts, window_length, window_step=1, taper="rectangular"):
+    """Compute sliding-window correlation matrices from running sums.
+
+    The weighted sums and cross-products of the ROI time-series over the
+    window are updated incrementally with the frames entering and leaving
+    the window, such that each frame costs O(N^2) instead of recomputing
+    each window in O(N^2 W). Hann and Hamming tapers of the form
+    ``a - b cos(2 pi k / (W - 1))`` are supported through additional running
+    sums modulated by ``cos`` and ``sin`` of the frame index.
+
+    Parameters
+    ----------
+    ts : numpy.ndarray
+        ROI time-series of shape (N, T)
+
+    window_length : int
+        Number of time points in a window
+
+    window_step : int
+        Number of time points between the onsets of consecutive windows
+
+    taper : "rectangular", "hann" or "hamming"
+        Window weighting function
+
+    Returns
+    -------
+    dynamic_fc : numpy.ndarray
+        Array of shape (#windows, N (N - 1) / 2) with the correlations of
+        each window packed in the row-major order of the upper triangle
+        (``numpy.triu_indices(N, k=1)``)
+
+    onsets : numpy.ndarray
+        Index of the first time point of each window
+    """
+    n_rois, tp = ts.shape
+    if window_length < 2 or window_length > tp:
+        raise ValueError(
+            "Window length (%d) must be between 2 and the number of time points (%d)"
+            % (window_length, tp)
+        )
+    a, b = {"rectangular": (1.0, 0.0), "hann": (0.5, 0.5), "hamming": (0.54, 0.46)}[taper]
+    # Demeaned time-series limit the cancellation in the running sums
+    x = ts.astype(np.float64)
+    x -= x.mean(axis=1)[:, np.newaxis]
+    theta = 2 * np.pi / (window_length - 1)
+    cos_t, sin_t = np.cos(theta * np.arange(tp)), np.sin(theta * np.arange(tp))
+    weights_sum = np.sum(a - b * np.cos(theta * np.arange(window_length)))
+
+    onsets = np.arange(0, tp - window_length + 1, window_step)
+    iu = np.triu_indices(n_rois, k=1)
+    dynamic_fc = np.zeros((len(onsets), len(iu[0])), dtype=np.float32)
+
+    # Running sums of the frames [start, end) (plain, cos- and sin-modulated)
+    s1, s2 = np.zeros(n_rois), np.zeros((n_rois, n_rois))
+    if b > 0:
+        c1, c2 = np.zeros(n_rois), np.zeros((n_rois, n_rois))
+        d1, d2 = np.zeros(n_rois), np.zeros((n_rois, n_rois))
+
+    def _update(frames, sign):
+        for t in frames:
+            xt = x[:, t]
+            xx = np.outer(xt, xt)
+            s1[:] += sign * xt
+            s2[:] += sign * xx
+            if b > 0:
+                c1[:] += (sign * cos_t[t]) * xt
+                c2[:] += (sign * cos_t[t]) * xx
+                d1[:] += (sign * sin_t[t]) * xt
+                d2[:] += (sign * sin_t[t]) * xx
+
+    start, end = 0, 0
+    for k, onset in enumerate(onsets):
+        if onset >= end:
+            # Non-overlapping windows: restart the sums
+            s1[:], s2[:] = 0, 0
+            if b > 0:
+                c1[:], c2[:], d1[:], d2[:] = 0, 0, 0, 0
+            start = end = onset
+        _update(range(start, onset), -1)
+        _update(range(end, onset + window_length), 1)
+        start, end = onset, onset + window_length
+
+        # Weighted sums with w(t) = a - b cos(theta (t - onset))
+        if b > 0:
+            co, so = np.cos(theta * onset), np.sin(theta * onset)
+            m1 = (a * s1 - b * (co * c1 + so * d1)) / weights_sum
+            m2 = (a * s2 - b * (co * c2 + so * d2)) / weights_sum
+        else:
+            m1 = s1 / weights_sum
+            m2 = s2 / weights_sum
+        cov = m2 - np.outer(m1, m1)
+        std = np.sqrt(np.clip(np.diag(cov), 0, None))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            corr = cov / np.outer(std, std)
+        dynamic_fc[k] = np.clip(corr[iu], -1, 1)
+
+    return dynamic_fc, onsets
+
+
+def _segment_statistics(sorted_values, segment_starts, segment_counts):
+    """Compute the mean, standard deviation and median of contiguous segments of values.
+
+    NaN values are ignored as in the ``np.nan*`` functions.
+
+    Parameters
+    ----------
+    sorted_values : numpy.ndarray
+        Array of values sorted in increasing order inside each segment
+        (NaN values last)
+
+    segment_starts : numpy.ndarray
+        Index of the first value of each segment
+
+    segment_counts : numpy.ndarray
+        Number of values in each segment (all segments must be non-empty)
+
+    Returns
+    -------
+    mean, std, median : numpy.ndarray
+        Statistics of each segment (NaN if a segment has only NaN values)
+    """
+    if len(segment_starts) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+
+    is_valid = ~np.isnan(sorted_values)
+    valid_count = np.add.reduceat(is_valid.astype(np.int64), segment_starts)
+    valid_values = np.where(is_valid, sorted_values, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.add.reduceat(valid_values, segment_starts) / valid_count
+        deviation = np.where(
+            is_valid, valid_values - np.repeat(mean, segment_counts), 0.0
+        )
+        std = np.sqrt(np.add.reduceat(deviation ** 2, segment_starts) / valid_count)
+
+    lower = segment_starts + np.maximum(valid_count - 1, 0) // 2
+    upper = segment_starts + np.maximum(valid_count // 2, np.maximum(valid_count - 1, 0) // 2)
+    median = np.where(
+        valid_count > 0, (sorted_values[lower] + sorted_values[upper]) / 2.0, np.nan
+    )
+    return mean, std, median
+
+
+def aggregate_edge_metrics(fiberlabels, fiberlength, roi_volume, node_ids=None):
+    """Compute the connectivity metrics of all edges by grouping fibers per (u, v) label pair.
+
+    Fibers are sorted once by label pair (and length) so that every edge
+    corresponds to a contiguous segment on which metrics are computed with
+    segment reductions.
+
+    Parameters
+    ----------
+    fiberlabels : numpy.ndarray
+        Matrix of size [#fibers, 2] with the sorted start / end ROI labels of
+        the valid fibers
+
+    fiberlength : numpy.ndarray
+        Array of size [#fibers] with the length of the valid fibers
+
+    roi_volume : numpy.ndarray
+        Array indexed by ROI label giving its number of voxels
+        (See :func:`compute_roi_node_information`)
+
+    node_ids : list of int
+        Node labels in the order of the graph used to describe the parcellation.
+        It determines the ROIs accounted in the total volume used by the
+        normalized fiber density. If `None`, nodes are ordered by label.
+
+    Returns
+    -------
+    edges : numpy.ndarray
+        Matrix of size [#edges, 2] with the (u, v) labels of each edge
+
+    metrics : dict
+        Dictionary of edge metric arrays of size [#edges]
+
+    fiber_order : numpy.ndarray
+        Indices of the fibers sorted by edge
+
+    edge_offsets : numpy.ndarray
+        Array of size [#edges + 1] such that the fibers of edge `i` are
+        ``fiber_order[edge_offsets[i]:edge_offsets[i + 1]]``
+    """
+    fiberlabels = np.asarray(fiberlabels, dtype=np.int64).reshape(-1, 2)
+    fiberlength = np.asarray(fiberlength, dtype=np.float64).reshape(-1)
+    n_fibers = fiberlabels.shape[0]
+
+    # Sort fibers by (u, v) and by length inside each edge (NaN are sorted last)
+    fiber_order = np.lexsort((fiberlength, fiberlabels[:, 1], fiberlabels[:, 0]))
+    sorted_labels = fiberlabels[fiber_order]
+    sorted_length = fiberlength[fiber_order]
+
+    if n_fibers > 0:
+        new_edge = np.any(sorted_labels[1:] != sorted_labels[:-1], axis=1)
+        edge_starts = np.concatenate(([0], np.flatnonzero(new_edge) + 1))
+    else:
+        edge_starts = np.zeros(0, dtype=np.int64)
+    edge_offsets = np.append(edge_starts, n_fibers)
+    edges = sorted_labels[edge_starts]
+
+    number_of_fibers = np.diff(edge_offsets)
+
+    length_mean, length_std, length_median = _segment_statistics(
+        sorted_length, edge_starts, number_of_fibers
+    )
+    metrics = _edge_metrics(
+        edges,
+        number_of_fibers,
+        n_fibers,
+        length_mean,
+        length_std,
+        length_median,
+        roi_volume,
+        node_ids,
+    )
+
+    return edges, metrics, fiber_order, edge_offsets
+
+
+def _edge_metrics(
+    edges,
+    number_of_fibers,
+    total_fibers,
+    length_mean,
+    length_std,
+    length_median,
+    roi_volume,
+    node_ids=None,
+):
+    """Compute the connectivity metrics of edges from the number and length statistics of their fibers.
+
+    See :func:`aggregate_edge_metrics` for the parameters.
+
+    Returns
+    -------
+    metrics : dict
+        Dictionary of edge metric arrays of size [#edges]
+    """
+    u = edges[:, 0]
+    v = edges[:, 1]
+
+    # Total volume of the ROIs that open at least one edge in the node order
+    if node_ids is None:
+        node_ids = np.unique(edges)
+    node_position = dict((int(node), pos) for pos, node in enumerate(node_ids))
+    end_position = len(node_position)
+    u_position = np.array([node_position.get(int(node), end_position) for node in u])
+    v_position = np.array([node_position.get(int(node), end_position) for node in v])
+    first_nodes = np.unique(np.where(u_position <= v_position, u, v))
+    total_volume = np.sum(roi_volume[first_nodes])
+
+    metrics = {"number_of_fibers": number_of_fibers}
+    metrics["fiber_length_mean"] = length_mean
+    metrics["fiber_length_median"] = length_median
+    metrics["fiber_length_std"] = length_std
+    metrics["fiber_proportion"] = 100.0 * (number_of_fibers / float(max(total_fibers, 1)))
+
+    # Compute density
+    # Formula: density = (#fibers / mean_fibers_length) * (2 / (area_roi_u + area_roi_v))
+    pair_volume = roi_volume[u] + roi_volume[v]
+    has_length = length_mean > 0.0
+    fiber_density = np.zeros(edges.shape[0], dtype=np.float64)
+    normalized_fiber_density = np.zeros(edges.shape[0], dtype=np.float64)
+    fiber_density[has_length] = (
+        number_of_fibers[has_length] / length_mean[has_length]
+    ) * (2.0 / pair_volume[has_length])
+    normalized_fiber_density[has_length] = (
+        (number_of_fibers[has_length] / float(max(total_fibers, 1))) / length_mean[has_length]
+    ) * ((2.0 * float(total_volume)) / pair_volume[has_length])
+    metrics["fiber_density"] = fiber_density
+    metrics["normalized_fiber_density"] = normalized_fiber_density
+
+    return metrics
+
+
+def concatenate_fibers(fib):
+    """Concatenate the points of all fibers in a single array.
+
+    Parameters
+    ----------
+    fib : the fibers data
+        Fibers as returned by ``nib.trackvis.read``
+
+    Returns
+    -------
+    points : numpy.ndarray
+        Array of size [#points, 3] with the points of all fibers
+
+    offsets : numpy.ndarray
+        Array of size [#fibers + 1] such that the points of fiber `i` are
+        ``points[offsets[i]:offsets[i + 1]]``
+    """
+    lengths = np.array([len(fi[0]) for fi in fib], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    if len(fib) > 0:
+        points = np.concatenate([fi[0] for fi in fib])
+    else:
+        points = np.zeros((0, 3), dtype=np.float32)
+    return points, offsets
+
+
+def sample_scalar_maps(
+    points,
+    offsets,
+    scalar_maps,
+    interpolation="nearest",
+    map_dtypes=None,
+    chunk_size=4194304,
+):
+    """Sample scalar maps at all the points of a set of fibers.
+
+    Point coordinates are converted to voxel indices once per map and all
+    values are gathered with one fancy-indexing pass per chunk of points.
+    A fiber with at least one point outside a map volume is discarded
+    for this map.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Array of size [#points, 3] with the point coordinates in voxmm
+
+    offsets : numpy.ndarray
+        Array of size [#fibers + 1] with the offset of the first point of each fiber
+
+    scalar_maps : dict
+        Dictionary of ``(data, voxel_size)`` tuples indexed by map name
+
+    interpolation : ['nearest', 'trilinear']
+        Sample the value of the voxel containing the point (`nearest`) or
+        interpolate the values of the 8 neighboring voxel centers (`trilinear`)
+
+    map_dtypes : dict
+        Dictionary of data types indexed by map name in which the sampled values
+        are stored and reduced (Default: `numpy.float64` for all maps)
+
+    chunk_size : int
+        Number of points processed at once
+
+    Returns
+    -------
+    sampled_maps : dict
+        Dictionary of ``(values, fiber_ok)`` tuples indexed by map name where
+        `values` is the array of size [#points] of sampled values and `fiber_ok`
+        the boolean array of size [#fibers] of fibers entirely inside the volume
+    """
+    if map_dtypes is None:
+        map_dtypes = {}
+
+    from scipy import ndimage
+
+    n_points = points.shape[0]
+    n_fibers = len(offsets) - 1
+    point_fiber = np.repeat(np.arange(n_fibers), np.diff(offsets))
+
+    sampled_maps = {}
+    for name, (data, voxel_size) in scalar_maps.items():
+        dtype = np.dtype(map_dtypes.get(name, np.float64))
+        voxel_size = np.asarray(voxel_size[:3])
+        shape = np.asarray(data.shape[:3])
+
+        values = np.zeros(n_points, dtype=dtype)
+        outside = np.zeros(n_points, dtype=bool)
+        for start in range(0, n_points, chunk_size):
+            stop = min(start + chunk_size, n_points)
+            coords = points[start:stop] / voxel_size
+            vox = np.trunc(coords)
+            inside = np.all((vox >= 0) & (vox < shape), axis=1)
+            outside[start:stop] = ~inside
+            if interpolation == "trilinear":
+                # Voxel centers are located at (index + 0.5) * voxel_size
+                values[start:stop][inside] = ndimage.map_coordinates(
+                    data,
+                    (coords[inside] - 0.5).T,
+                    output=np.float64,
+                    order=1,
+                    mode="nearest",
+                )
+            else:
+                vox = vox[inside].astype(np.intp)
+                values[start:stop][inside] = data[vox[:, 0], vox[:, 1], vox[:, 2]]
+
+        fiber_ok = np.bincount(point_fiber[outside], minlength=n_fibers) == 0
+        sampled_maps[name] = (values, fiber_ok)
+
+    return sampled_maps
+
+
+def aggregate_edge_scalars(sampled_maps, offsets, edge_fibers, edge_offsets):
+    """Compute the mean, standard deviation and median of scalar maps along the fibers of each edge.
+
+    Parameters
+    ----------
+    sampled_maps : dict
+        Dictionary of sampled values indexed by map name
+        (See :func:`sample_scalar_maps`)
+
+    offsets : numpy.ndarray
+        Array of size [#fibers + 1] with the offset of the first point of each fiber
+
+    edge_fibers : numpy.ndarray
+        Indices of the fibers sorted by edge
+
+    edge_offsets : numpy.ndarray
+        Array of size [#edges + 1] such that the fibers of edge `i` are
+        ``edge_fibers[edge_offsets[i]:edge_offsets[i + 1]]``
+
+    Returns
+    -------
+    edge_scalars : dict
+        Dictionary of ``(mean, std, median, has_values)`` tuples of arrays
+        of size [#edges] indexed by map name, where `has_values` is `False`
+        for edges without any fiber entirely inside the map volume
+    """
+    n_fibers = len(offsets) - 1
+    n_edges = len(edge_offsets) - 1
+    fiber_edge = np.full(n_fibers, -1, dtype=np.int64)
+    fiber_edge[edge_fibers] = np.repeat(np.arange(n_edges), np.diff(edge_offsets))
+    fiber_lengths = np.diff(offsets)
+
+    edge_scalars = {}
+    for name, (values, fiber_ok) in sampled_maps.items():
+        point_edge = np.repeat(np.where(fiber_ok, fiber_edge, -1), fiber_lengths)
+        selected = point_edge >= 0
+        point_edge = point_edge[selected]
+        point_values = values[selected]
+        order = np.lexsort((point_values, point_edge))
+
+        counts = np.bincount(point_edge, minlength=n_edges)
+        has_values = counts > 0
+        starts = (np.cumsum(counts) - counts)[has_values]
+
+        mean = np.full(n_edges, np.nan)
+        std = np.full(n_edges, np.nan)
+        median = np.full(n_edges, np.nan)
+        mean[has_values], std[has_values], median[has_values] = _segment_statistics(
+            point_values[order], starts, counts[has_values]
+        )
+        edge_scalars[name] = (mean, std, median, has_values)
+
+    return edge_scalars
+
+
+def reduce_fiber_scalars(sampled_maps, offsets):
+    """Reduce the values of scalar maps sampled along fibers to per-fiber sums.
+
+    Parameters
+    ----------
+    sampled_maps : dict
+        Dictionary of sampled values indexed by map name
+        (See :func:`sample_scalar_maps`)
+
+    offsets : numpy.ndarray
+        Array of size [#fibers + 1] with the offset of the first point of each fiber
+
+    Returns
+    -------
+    fiber_scalars : dict
+        Dictionary of ``(sum, sum_sq, count, fiber_ok)`` tuples of arrays
+        of size [#fibers] indexed by map name
+    """
+    n_fibers = len(offsets) - 1
+    point_fiber = np.repeat(np.arange(n_fibers), np.diff(offsets))
+
+    fiber_scalars = {}
+    for name, (values, fiber_ok) in sampled_maps.items():
+        values = values.astype(np.float64)
+        fiber_scalars[name] = (
+            np.bincount(point_fiber, weights=values, minlength=n_fibers),
+            np.bincount(point_fiber, weights=values ** 2, minlength=n_fibers),
+            np.diff(offsets),
+            fiber_ok,
+        )
+    return fiber_scalars
+
+
+def compute_endpoints(points, offsets, voxel_size):
+    """Create the endpoints arrays from the concatenated points of a set of fibers.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Array of size [#points, 3] with the points of all fibers
+
+    offsets : numpy.ndarray
+        Array of size [#fibers + 1] with the offset of the first point of each fiber
+
+    voxel_size : 3-tuple
+        Voxel size of the ROI image
+
+    Returns
+    -------
+    endpoints : numpy.ndarray
+        Matrix of size [#fibers, 2, 3] containing for each fiber the
+        index of its first and last point in the `voxel_size` volume
+
+    endpointsmm : numpy.ndarray
+        Endpoints in milimeter coordinates
+    """
+    endpointsmm = np.zeros((len(offsets) - 1, 2, 3))
+    endpointsmm[:, 0, :] = points[offsets[:-1]]
+    endpointsmm[:, 1, :] = points[offsets[1:] - 1]
+    # Translate from mm to index (truncation as done by int())
+    endpoints = np.trunc(endpointsmm / np.asarray(voxel_size[:3], dtype=np.float64))
+    return endpoints, endpointsmm
+
+
+class _NpyChunkWriter(object):
+    """Write a ``.npy`` file by appending chunks of rows so that the whole array is never held in memory.
+
+    Parameters
+    ----------
+    fname : string
+        Path of the ``.npy`` file
+
+    dtype : numpy.dtype
+        Data type of the array
+
+    row_shape : tuple
+        Shape of each row of the array
+    """
+
+    def __init__(self, fname, dtype, row_shape=()):
+        self.fname = fname
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.n_rows = 0
+        self._data = open(fname + ".part", "wb")
+
+    def append(self, rows):
+        """Append rows at the end of the array."""
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape((-1,) + self.row_shape)
+        self._data.write(rows.tobytes())
+        self.n_rows += rows.shape[0]
+
+    def close(self):
+        """Write the ``.npy`` file and return its absolute path."""
+        self._data.close()
+        header = {
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (self.n_rows,) + self.row_shape,
+        }
+        with open(self.fname, "wb") as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            with open(self.fname + ".part", "rb") as data:
+                shutil.copyfileobj(data, f)
+        os.remove(self.fname + ".part")
+        return op.abspath(self.fname)
+
+
+class _StreamedEdgeStatistics(object):
+    """Running per-edge sums of the fibers of one resolution, updated chunk by chunk in streaming mode.
+
+    Edges are indexed by the code ``u * (number_of_regions + 1) + v`` of their
+    sorted (u, v) labels so that the sums of each chunk are accumulated with
+    a single ``np.bincount``.
+
+    Parameters
+    ----------
+    n_rois : int
+        Number of regions of the resolution
+
+    map_names : list
+        Names of the additional maps
+    """
+
+    def __init__(self, n_rois, map_names):
+        self.n_labels = int(n_rois) + 1
+        size = self.n_labels ** 2
+        self.n_fibers = 0
+        self.n_orphans = 0
+        self.n_outside = 0
+        self.n_overflow = 0
+        self.number_of_fibers = np.zeros(size, dtype=np.int64)
+        # (count, sum, sum of squares) of the non-NaN fiber lengths
+        self.length = [np.zeros(size) for _ in range(3)]
+        # (count, sum, sum of squares) of the map values along the fibers
+        self.maps = dict((k, [np.zeros(size) for _ in range(3)]) for k in map_names)
+
+    def edge_codes(self, fiberlabels):
+        """Return the edge code of fibers from their sorted (u, v) labels."""
+        fiberlabels = np.asarray(fiberlabels, dtype=np.int64)
+        return fiberlabels[:, 0] * self.n_labels + fiberlabels[:, 1]
+
+    def update(self, fiberlabels, valid, orphans, outside, overflow, fiberlength, fiber_scalars):
+        """Accumulate the fibers of a chunk (See :func:`filter_fiber_labels` and :func:`reduce_fiber_scalars`)."""
+        size = self.n_labels ** 2
+        self.n_fibers += fiberlabels.shape[0]
+        self.n_orphans += int(np.count_nonzero(orphans))
+        self.n_outside += int(np.count_nonzero(outside))
+        self.n_overflow += int(np.count_nonzero(overflow))
+
+        codes = self.edge_codes(fiberlabels[valid])
+        self.number_of_fibers += np.bincount(codes, minlength=size)
+
+        length = np.asarray(fiberlength, dtype=np.float64)[valid]
+        has_length = ~np.isnan(length)
+        for acc, weights in zip(
+            self.length, (None, length[has_length], length[has_length] ** 2)
+        ):
+            acc += np.bincount(codes[has_length], weights=weights, minlength=size)
+
+        for k, (value_sum, value_sum_sq, count, fiber_ok) in fiber_scalars.items():
+            selected = np.flatnonzero(valid)[fiber_ok[valid]]
+            map_codes = self.edge_codes(fiberlabels[selected])
+            for acc, weights in zip(
+                self.maps[k], (count[selected], value_sum[selected], value_sum_sq[selected])
+            ):
+                acc += np.bincount(map_codes, weights=weights, minlength=size)
+
+    def edge_statistics(self):
+        """Compute the mean and standard deviation of the fiber lengths and map values of all edges.
+
+        Returns
+        -------
+        edge_codes : numpy.ndarray
+            Sorted codes of the edges
+
+        edges : numpy.ndarray
+            Matrix of size [#edges, 2] with the (u, v) labels of each edge
+
+        number_of_fibers : numpy.ndarray
+            Number of fibers of each edge
+
+        length_stats : tuple
+            ``(mean, std)`` of the fiber lengths of each edge
+
+        map_stats : dict
+            Dictionary of ``(mean, std, has_values)`` tuples indexed by map name
+        """
+        edge_codes = np.flatnonzero(self.number_of_fibers)
+        edges = np.stack((edge_codes // self.n_labels, edge_codes % self.n_labels), axis=1)
+
+        def _mean_std(count, value_sum, value_sum_sq):
+            count = count[edge_codes]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = value_sum[edge_codes] / count
+                mean_sq = value_sum_sq[edge_codes] / count
+                std = np.sqrt(np.maximum(mean_sq - mean ** 2, 0.0))
+            has_values = count > 0
+            mean[~has_values] = np.nan
+            std[~has_values] = np.nan
+            return mean, std, has_values
+
+        length_stats = _mean_std(*self.length)[:2]
+        map_stats = dict((k, _mean_std(*acc)) for k, acc in self.maps.items())
+        return edge_codes, edges, self.number_of_fibers[edge_codes], length_stats, map_stats
+
+
+def _streamed_edge_medians(statistics, edge_codes, fiberlabels, fiber_values, chunk_size):
+    """Compute the exact median of per-fiber values for each edge from arrays saved on disk.
+
+    The median cannot be updated chunk by chunk, so the on-disk arrays are
+    read again for each block of consecutive edges totalling at most
+    `chunk_size` fibers. The memory usage is thus bounded by the larger of
+    `chunk_size` and the number of fibers of the largest edge.
+
+    Parameters
+    ----------
+    statistics : _StreamedEdgeStatistics
+        Per-edge sums of the resolution
+
+    edge_codes : numpy.ndarray
+        Sorted codes of the edges (See :meth:`_StreamedEdgeStatistics.edge_statistics`)
+
+    fiberlabels : numpy.ndarray
+        Memory-mapped matrix of size [#fibers, 2] with the labels of all fibers
+        (See :func:`filter_fiber_labels`)
+
+    fiber_values : dict
+        Dictionary of memory-mapped arrays of size [#fibers] indexed by name,
+        where NaN values are ignored
+
+    chunk_size : int
+        Number of fibers read at once
+
+    Returns
+    -------
+    medians : dict
+        Dictionary of arrays of size [#edges] indexed by name
+    """
+    n = fiberlabels.shape[0]
+    counts = statistics.number_of_fibers[edge_codes]
+    medians = dict((k, np.full(edge_codes.size, np.nan)) for k in fiber_values)
+
+    start = 0
+    while start < edge_codes.size:
+        stop = start + max(
+            1, int(np.searchsorted(np.cumsum(counts[start:]), chunk_size, side="right"))
+        )
+        first_code = edge_codes[start]
+        last_code = edge_codes[stop - 1]
+
+        block_codes = []
+        block_values = dict((k, []) for k in fiber_values)
+        for i in range(0, n, chunk_size):
+            labels = np.asarray(fiberlabels[i:i + chunk_size])
+            codes = statistics.edge_codes(labels)
+            selected = np.flatnonzero(
+                (labels[:, 0] > 0) & (codes >= first_code) & (codes <= last_code)
+            )
+            block_codes.append(codes[selected])
+            for k, values in fiber_values.items():
+                block_values[k].append(np.asarray(values[i:i + chunk_size])[selected])
+
+        block_codes = np.concatenate(block_codes) if block_codes else np.zeros(0, np.int64)
+        block_counts = counts[start:stop]
+        block_starts = np.cumsum(block_counts) - block_counts
+        for k, values in block_values.items():
+            values = np.concatenate(values) if values else np.zeros(0)
+            order = np.lexsort((values, block_codes))
+            medians[k][start:stop] = _segment_statistics(
+                values[order], block_starts, block_counts
+            )[2]
+        start = stop
+
+    return medians
+
+
+def _stream_fiber_labels(
+    intrk,
+    roi_reference,
+    labeling_volumes,
+    resolutions,
+    scalar_maps,
+    compute_curvature,
+    scalar_map_interpolation,
+    map_dtypes,
+    chunk_size,
+    folder,
+):
+    """Label the fibers of the tractogram and accumulate the per-edge sums of all resolutions by reading it by chunks.
+
+    The endpoints of each chunk are labeled against the ROI volumes as soon as
+    it is read, so that only running per-edge sums are kept in memory.
+    The per-fiber outputs of :func:`cmat` (endpoints, curvature and labels)
+    are appended to their ``.npy`` file, and the per-fiber lengths and mean
+    map values used to compute the medians are appended to files in `folder`.
+
+    Returns
+    -------
+    statistics : dict
+        Dictionary of :class:`_StreamedEdgeStatistics` indexed by resolution
+
+    fiber_files : dict
+        Files of the per-fiber lengths and mean map values
+        (See :func:`_load_shared_arrays`)
+    """
+    roi_voxel_size = roi_reference.header.get_zooms()[:3]
+    if not op.exists(folder):
+        os.makedirs(folder)
+
+    statistics = dict(
+        (parkey, _StreamedEdgeStatistics(parval["number_of_regions"], list(scalar_maps.keys())))
+        for parkey, parval in resolutions.items()
+    )
+    writers = {
+        "endpoints": _NpyChunkWriter("endpoints.npy", np.float64, (2, 3)),
+        "endpointsmm": _NpyChunkWriter("endpointsmm.npy", np.float64, (2, 3)),
+        "fiberlength": _NpyChunkWriter(op.join(folder, "fiberlength.npy"), np.float64),
+    }
+    if compute_curvature:
+        writers["meancurvature"] = _NpyChunkWriter("meancurvature.npy", np.float64, (1,))
+    for k in scalar_maps:
+        writers["map-%s_mean" % k] = _NpyChunkWriter(
+            op.join(folder, "map-%s_mean.npy" % k), np.float64
+        )
+    for parkey in resolutions:
+        writers["fiberlabels_%s" % parkey] = _NpyChunkWriter(
+            "filtered_fiberslabel_%s.npy" % parkey, np.int32, (2,)
+        )
+    n_discarded = dict((k, 0) for k in scalar_maps)
+
+    n = 0
+    for points, offsets in iter_streamline_chunks(
+        intrk, reference=roi_reference, chunk_size=chunk_size
+    ):
+        n += len(offsets) - 1
+        print("  ... %i fibers processed" % n)
+
+        endpoints, endpointsmm = compute_endpoints(points, offsets, roi_voxel_size)
+        writers["endpoints"].append(endpoints)
+        writers["endpointsmm"].append(endpointsmm)
+        fiberlength = streamline_lengths(points, offsets)
+        writers["fiberlength"].append(fiberlength)
+        if compute_curvature:
+            writers["meancurvature"].append(streamline_mean_curvature(points, offsets))
+
+        fiber_scalars = reduce_fiber_scalars(
+            sample_scalar_maps(
+                points,
+                offsets,
+                scalar_maps,
+                interpolation=scalar_map_interpolation,
+                map_dtypes=map_dtypes,
+            ),
+            offsets,
+        )
+        for k, (value_sum, _, count, fiber_ok) in fiber_scalars.items():
+            with np.errstate(invalid="ignore", divide="ignore"):
+                writers["map-%s_mean" % k].append(
+                    np.where(fiber_ok, value_sum / count, np.nan)
+                )
+            n_discarded[k] += int(np.count_nonzero(~fiber_ok))
+        del points
+
+        endpoint_labels, endpoints_inside = label_fiber_endpoints(
+            endpoints, [labeling_volumes[parkey] for parkey in resolutions]
+        )
+        del endpoints, endpointsmm
+        for (parkey, parval), labels, inside in zip(
+            resolutions.items(), endpoint_labels, endpoints_inside
+        ):
+            fiberlabels, valid, orphans, outside, overflow = filter_fiber_labels(
+                labels, inside, parval["number_of_regions"]
+            )
+            writers["fiberlabels_%s" % parkey].append(fiberlabels)
+            statistics[parkey].update(
+                fiberlabels, valid, orphans, outside, overflow, fiberlength, fiber_scalars
+            )
+
+    fiber_files = {}
+    for name, writer in writers.items():
+        fname = writer.close()
+        if name == "fiberlength" or name.startswith("map-"):
+            fiber_files[name] = fname
+
+    for k, discarded in n_discarded.items():
+        if discarded > 0:
+            print(
+                "  ... WARNING - %i fibers have points outside the volume of the %s map "
+                "and are discarded for this measure" % (discarded, k)
+            )
+
+    return statistics, fiber_files
+
+
+class Connectome(object):
+    """Connectivity matrices of a parcellation stored as arrays.
+
+    Node attributes are stored as one list per attribute, ordered as the nodes,
+    and each connectivity metric as an array of values for the list of edges
+    (coordinate format). A ``networkx`` graph is only created when the
+    ``gPickle`` output type is saved.
+
+    Parameters
+    ----------
+    node_ids : list
+        Node identifiers (`dn_multiscaleID` for the parcellations of the pipeline)
+
+    node_attributes : dict
+        Dictionary of lists of values ordered as `node_ids` indexed by attribute name
+
+    Attributes
+    ----------
+    edges : numpy.ndarray
+        Array of size [#edges, 2] with the node identifiers of each edge
+
+    edge_metrics : dict
+        Dictionary of arrays of size [#edges] indexed by metric name
+
+    edge_masks : dict
+        Dictionary of boolean arrays of size [#edges] indexed by metric name
+        which are `False` for the edges where the metric is not defined
+
+    Examples
+    --------
+    >>> from cmtklib.connectome import Connectome
+    >>> conn = Connectome.from_graphml('/path/to/sub-01_atlas-L2018_desc-scale1_dseg.graphml')  # doctest: +SKIP
+    >>> conn.set_edges(np.array([[1, 2], [1, 3]]))  # doctest: +SKIP
+    >>> conn.add_edge_metric('number_of_fibers', np.array([10, 4]))  # doctest: +SKIP
+    >>> conn.save('connectome_scale1', ['gPickle', 'mat', 'graphml'])  # doctest: +SKIP
+    """
+
+    def __init__(self, node_ids, node_attributes=None):
+        self.node_ids = [int(u) for u in node_ids]
+        self.node_attributes = {}
+        self.edges = np.zeros((0, 2), dtype=np.int64)
+        self.edge_metrics = {}
+        self.edge_masks = {}
+        if node_attributes is not None:
+            for key, values in node_attributes.items():
+                self.set_node_attribute(key, values)
+
+    @classmethod
+    def from_graphml(cls, fname):
+        """Create a connectome without edges from the node information of a parcellation.
+
+        Parameters
+        ----------
+        fname : string
+            GraphML file describing the parcellation nodes
+
+        Returns
+        -------
+        connectome : Connectome
+        """
+        gp = nx.read_graphml(fname)
+        node_ids = []
+        node_attributes = {}
+        for i, (u, d) in enumerate(gp.nodes(data=True)):
+            node_ids.append(int(u))
+            for key in d:
+                if key not in node_attributes:
+                    node_attributes[key] = [None] * i
+                node_attributes[key].append(d[key])
+            for key in node_attributes:
+                if key not in d:
+                    node_attributes[key].append(None)
+        return cls(node_ids, node_attributes)
+
+    @property
+    def number_of_nodes(self):
+        """Number of nodes."""
+        return len(self.node_ids)
+
+    def set_node_attribute(self, key, values):
+        """Set the values of a node attribute, given in the order of the nodes."""
+        values = list(values)
+        values += [None] * (self.number_of_nodes - len(values))
+        self.node_attributes[key] = values
+
+    def set_edges(self, edges):
+        """Set the edges, given as an array of size [#edges, 2] of node identifiers.
+
+        Nodes that are not already in the connectome are added without attributes.
+        Previously added edge metrics are removed.
+        """
+        self.edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        known = set(self.node_ids)
+        for u in self.edges.ravel().tolist():
+            if u not in known:
+                known.add(u)
+                self.node_ids.append(u)
+                for values in self.node_attributes.values():
+                    values.append(None)
+        self.edge_metrics = {}
+        self.edge_masks = {}
+
+    def add_edge_metric(self, name, values, defined=None):
+        """Add a connectivity metric given as an array of values for each edge.
+
+        Parameters
+        ----------
+        name : string
+            Name of the metric
+
+        values : numpy.ndarray
+            Array of size [#edges] in the order of `edges`
+
+        defined : numpy.ndarray
+            Optional boolean array of size [#edges] which is `False` for
+            the edges where the metric is not defined
+        """
+        self.edge_metrics[name] = np.asarray(values)
+        if defined is not None:
+            self.edge_masks[name] = np.asarray(defined, dtype=bool)
+
+    def _node_index(self):
+        index = np.full(max(self.node_ids) + 1 if self.node_ids else 0, -1, dtype=np.int64)
+        index[self.node_ids] = np.arange(self.number_of_nodes)
+        return index
+
+    def _ordered_edges(self):
+        """Return the edges in the order ``networkx`` yields them for a graph built node by node.
+
+        Returns
+        -------
+        edges : numpy.ndarray
+            Array of size [#edges, 2] where the first node of each edge
+            comes first in the list of nodes
+
+        order : numpy.ndarray
+            Indices of the edges in the output order
+        """
+        index = self._node_index()
+        pos = index[self.edges]
+        flip = pos[:, 0] > pos[:, 1]
+        pos[flip] = pos[flip][:, ::-1]
+        order = np.lexsort((pos[:, 1], pos[:, 0]))
+        edges = np.asarray(self.node_ids, dtype=np.int64)[pos[order]]
+        return edges.reshape(-1, 2), order
+
+    def metric_matrix(self, name):
+        """Return the dense symmetric matrix of a metric with rows ordered as the nodes.
+
+        Entries of node pairs without edge or where the metric is not defined are 0.
+        """
+        index = self._node_index()
+        pos = index[self.edges]
+        values = self.edge_metrics[name].astype(np.float64)
+        if name in self.edge_masks:
+            values = np.where(self.edge_masks[name], values, 0)
+        matrix = np.zeros((self.number_of_nodes, self.number_of_nodes))
+        matrix[pos[:, 0], pos[:, 1]] = values
+        matrix[pos[:, 1], pos[:, 0]] = values
+        return matrix
+
+    def _ordered_edge_values(self, order):
+        """Return the metric values as lists of Python scalars (`None` if undefined) in the given edge order."""
+        edge_values = {}
+        for name, values in self.edge_metrics.items():
+            values = values[order].tolist()
+            if name in self.edge_masks:
+                values = [
+                    value if defined else None
+                    for value, defined in zip(values, self.edge_masks[name][order].tolist())
+                ]
+            edge_values[name] = values
+        return edge_values
+
+    def to_networkx(self):
+        """Create the ``networkx`` graph with the node attributes and the connectivity metrics as edge attributes."""
+        G = nx.Graph()
+        for i, u in enumerate(self.node_ids):
+            G.add_node(u)
+            for key, values in self.node_attributes.items():
+                if values[i] is not None:
+                    G.nodes[u][key] = values[i]
+        edges, order = self._ordered_edges()
+        edge_values = self._ordered_edge_values(order)
+        for edge_idx, (u, v) in enumerate(edges.tolist()):
+            G.add_edge(
+                u,
+                v,
+                **dict(
+                    (name, values[edge_idx])
+                    for name, values in edge_values.items()
+                    if values[edge_idx] is not None
+                )
+            )
+        return G
+
+    def write_tsv(self, fname):
+        """Write the list of edges with all connectivity metrics in TSV format.
+
+        Undefined metric values are written as ``n/a``.
+        """
+        edges, order = self._ordered_edges()
+        edge_values = self._ordered_edge_values(order)
+        with open(fname, "w") as out_file:
+            tsv_writer = csv.writer(out_file, delimiter="\t")
+            tsv_writer.writerow(["source", "target"] + list(edge_values.keys()))
+        with open(fname, "a") as out_file:
+            columns = [edges[:, 0].tolist(), edges[:, 1].tolist()] + list(edge_values.values())
+            for row in zip(*columns):
+                out_file.write(
+                    "\t".join(["n/a" if value is None else str(value) for value in row]) + "\n"
+                )
+
+    def write_gpickle(self, fname):
+        """Write the connectome as a pickled ``networkx`` graph."""
+        nx.write_gpickle(self.to_networkx(), fname)
+
+    def write_mat(self, fname):
+        """Write the connectivity matrices and the node attributes in Matlab format."""
+        edge_struct = {}
+        for name in self.edge_metrics.keys():
+            edge_struct[name] = self.metric_matrix(name)
+
+        node_struct = {}
+        for key, values in self.node_attributes.items():
+            if key == "dn_position":
+                node_arr = np.array(
+                    [value if value is not None else (np.nan,) * 3 for value in values],
+                    dtype=np.float64,
+                ).reshape(-1, 3)
+            else:
+                node_arr = np.zeros(self.number_of_nodes, dtype=np.object_)
+                node_arr[:] = [value if value is not None else "" for value in values]
+            node_struct[key] = node_arr
+
+        sio.savemat(
+            fname,
+            long_field_names=True,
+            mdict={"sc": edge_struct, "nodes": node_struct},
+        )
+
+    def write_graphml(self, fname):
+        """Write the connectome in GraphML format.
+
+        The file is written element by element from the node attributes
+        and the edge arrays, with the layout of ``networkx.write_graphml``.
+        """
+        node_keys = ["dn_multiscaleID", "dn_fsname", "dn_hemisphere", "dn_name"]
+        node_columns = []
+        for key in node_keys + ["dn_position", "dn_region"]:
+            if key not in self.node_attributes:
+                continue
+            values = self.node_attributes[key]
+            if key == "dn_position":
+                for axis, suffix in enumerate(["x", "y", "z"]):
+                    node_columns.append(
+                        (
+                            "dn_position_%s" % suffix,
+                            [float(value[axis]) if value is not None else None for value in values],
+                        )
+                    )
+            else:
+                node_columns.append((key, values))
+
+        edges, order = self._ordered_edges()
+        edge_values = self._ordered_edge_values(order)
+
+        # GraphML keys, numbered as networkx does (node keys first)
+        keys = []
+        for name, values in node_columns:
+            keys.append(("node", name, _graphml_type(values)))
+        for name, values in edge_values.items():
+            keys.append(("edge", name, _graphml_type(values)))
+        key_ids = ["d%d" % i for i in range(len(keys))]
+
+        def _data_elements(columns, key_offset, idx):
+            return "".join(
+                '  <data key="%s">%s</data>\n'
+                % (key_ids[key_offset + k], _graphml_value(values[idx]))
+                for k, (_, values) in enumerate(columns)
+                if values[idx] is not None
+            )
+
+        with open(fname, "w", encoding="utf-8") as out_file:
+            out_file.write(
+                "<?xml version='1.0' encoding='utf-8'?>\n"
+                '<graphml xmlns="http://graphml.graphdrawing.org/xmlns" '
+                'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                'xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns '
+                'http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">'
+            )
+            for key_id, (domain, name, xml_type) in reversed(list(zip(key_ids, keys))):
+                out_file.write(
+                    '<key id="%s" for="%s" attr.name=%s attr.type="%s"/>\n'
+                    % (key_id, domain, quoteattr(name), xml_type)
+                )
+            out_file.write('<graph edgedefault="undirected">')
+            for i, u in enumerate(self.node_ids):
+                data = _data_elements(node_columns, 0, i)
+                if data:
+                    out_file.write('<node id="%d">\n%s</node>\n' % (u, data))
+                else:
+                    out_file.write('<node id="%d"/>\n' % u)
+            edge_columns = list(edge_values.items())
+            for edge_idx, (u, v) in enumerate(edges.tolist()):
+                data = _data_elements(edge_columns, len(node_columns), edge_idx)
+                if data:
+                    out_file.write('<edge source="%d" target="%d">\n%s</edge>\n' % (u, v, data))
+                else:
+                    out_file.write('<edge source="%d" target="%d"/>\n' % (u, v))
+            out_file.write("</graph></graphml>")
+
+    def save(self, basename, output_types):
+        """Save the connectome in TSV format and in each requested output type.
+
+        Parameters
+        ----------
+        basename : string
+            Output filename without extension
+
+        output_types : ['gPickle','mat','graphml']
+            Output types in addition to TSV
+        """
+        # Storing network/graph in TSV format (by default to be BIDS compliant)
+        print("    - %s.tsv" % basename)
+        self.write_tsv("%s.tsv" % basename)
+
+        # Storing network/graph in other formats that might be prefered by the user
+        if "gPickle" in output_types:
+            print("    - %s.gpickle" % basename)
+            self.write_gpickle("%s.gpickle" % basename)
+
+        if "mat" in output_types:
+            print("    - %s.mat" % basename)
+            self.write_mat("%s.mat" % basename)
 
-    return meancurv
+        if "graphml" in output_types:
+            print("    - %s.graphml" % basename)
+            self.write_graphml("%s.graphml" % basename)
+
+
+def _graphml_type(values):
+    """Return the GraphML type of a list of attribute values, given by its first defined value."""
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, (bool, np.bool_)):
+            return "boolean"
+        if isinstance(value, (int, np.integer)):
+            return "long"
+        if isinstance(value, (float, np.floating)):
+            return "double"
+        return "string"
+    return "string"
+
+
+def _graphml_value(value):
+    """Return the text of a GraphML data element."""
+    if isinstance(value, (bool, np.bool_)):
+        return "true" if value else "false"
+    if isinstance(value, np.generic):
+        value = value.item()
+    return escape(str(value))
+
+
+def _node_attribute_array(key, values):
+    """Convert the values of a node attribute to an array that can be stored in a connectome bundle."""
+    if key == "dn_position":
+        return np.array(
+            [value if value is not None else (np.nan,) * 3 for value in values],
+            dtype=np.float64,
+        ).reshape(-1, 3)
+    array = np.asarray([value for value in values if value is not None])
+    if array.dtype.kind in "biuf" and len(array) == len(values):
+        return array
+    if array.dtype.kind in "iuf":
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    return np.array(["" if value is None else str(value) for value in values])
+
+
+def save_connectome_bundle(fname, connectomes):
+    """Save the connectomes of all the resolutions of a parcellation in a single compressed file.
+
+    The file is in HDF5 format if `fname` ends with ``.h5`` and in NumPy
+    ``.npz`` format otherwise. Each array is stored under a
+    ``<resolution>/<group>/<name>`` key so that a single metric or
+    resolution can be read without loading the others:
+
+    * ``<resolution>/node_ids``: node identifiers
+    * ``<resolution>/nodes/<attribute>``: node attributes ordered as the node identifiers
+    * ``<resolution>/edges``: array of size [#edges, 2] with the node identifiers of each edge
+    * ``<resolution>/metrics/<metric>``: values of a connectivity metric for each edge
+    * ``<resolution>/masks/<metric>``: edges where a metric is defined (if not defined for all edges)
 
+    Parameters
+    ----------
+    fname : string
+        Output filename (``.h5`` or ``.npz``)
 
-def create_endpoints_array(fib, voxelSize, print_info):
-    """Create the endpoints arrays for each fiber.
+    connectomes : dict
+        Dictionary of :class:`Connectome` indexed by resolution name
+    """
+    arrays = {}
+    for parkey, connectome in connectomes.items():
+        arrays["%s/node_ids" % parkey] = np.array(connectome.node_ids, dtype=np.int64)
+        for key, values in connectome.node_attributes.items():
+            arrays["%s/nodes/%s" % (parkey, key)] = _node_attribute_array(key, values)
+        arrays["%s/edges" % parkey] = connectome.edges
+        for name, values in connectome.edge_metrics.items():
+            arrays["%s/metrics/%s" % (parkey, name)] = values
+        for name, values in connectome.edge_masks.items():
+            arrays["%s/masks/%s" % (parkey, name)] = values
+    _save_bundle_arrays(fname, arrays)
+
+
+def _save_bundle_arrays(fname, arrays):
+    """Save a dictionary of arrays indexed by key in HDF5 (``.h5``) or compressed NumPy (``.npz``) format."""
+    if fname.endswith(".h5"):
+        import h5py
+
+        with h5py.File(fname, "w") as bundle:
+            for key, array in arrays.items():
+                if array.dtype.kind == "U":
+                    bundle.create_dataset(
+                        key, data=array.astype(object), dtype=h5py.string_dtype()
+                    )
+                elif array.size > 0:
+                    bundle.create_dataset(
+                        key, data=array, chunks=True, compression="gzip"
+                    )
+                else:
+                    bundle.create_dataset(key, data=array)
+    else:
+        np.savez_compressed(fname, **arrays)
+
+
+def _read_bundle_array(bundle, key):
+    """Read one array of a connectome bundle opened as a ``h5py.File`` or a ``numpy.lib.npyio.NpzFile``."""
+    if isinstance(bundle, np.lib.npyio.NpzFile):
+        return bundle[key]
+    array = bundle[key][()]
+    if array.dtype.kind == "O":
+        array = np.array(
+            [value.decode("utf-8") if isinstance(value, bytes) else value for value in array]
+        )
+    return array
+
+
+def _list_bundle_keys(bundle, prefix):
+    """List the names of the arrays stored under `prefix` in a connectome bundle."""
+    if isinstance(bundle, np.lib.npyio.NpzFile):
+        return [key[len(prefix):] for key in bundle.files if key.startswith(prefix)]
+    prefix = prefix.rstrip("/")
+    return list(bundle[prefix].keys()) if prefix in bundle else []
+
+
+def load_connectome_bundle(fname, parkey, metrics=None):
+    """Load the connectome of one resolution from a file saved by :func:`save_connectome_bundle`.
+
+    Only the arrays of the requested resolution and metrics are read.
 
     Parameters
     ----------
-    fib: the fibers data
+    fname : string
+        Connectome bundle (``.h5`` or ``.npz``)
 
-    voxelSize: 3-tuple
-        It contains the voxel size of the ROI image
+    parkey : string
+        Name of the resolution (such as ``scale1``)
 
-    print_info : bool
-        If True, print extra information
+    metrics : list
+        Names of the connectivity metrics to load (Default: all)
 
     Returns
     -------
-    (endpoints: matrix of size [#fibers, 2, 3] containing for each fiber the
-               index of its first and last point in the voxelSize volume
-    endpointsmm) : endpoints in milimeter coordinates
+    connectome : Connectome
 
+    Examples
+    --------
+    >>> from cmtklib.connectome import load_connectome_bundle
+    >>> conn = load_connectome_bundle('sub-01_atlas-L2018_conndata-network_connectivity.h5',
+    ...                               'scale1', metrics=['number_of_fibers'])  # doctest: +SKIP
+    >>> fiber_number = conn.metric_matrix('number_of_fibers')  # doctest: +SKIP
     """
-    if print_info:
-        print("========================")
-        print("create_endpoints_array")
+    if fname.endswith(".h5"):
+        import h5py
 
-    # Init
-    n = len(fib)
-    endpoints = np.zeros((n, 2, 3))
-    endpointsmm = np.zeros((n, 2, 3))
-    pc = -1
+        bundle = h5py.File(fname, "r")
+    else:
+        bundle = np.load(fname)
+
+    with bundle:
+        node_ids = _read_bundle_array(bundle, "%s/node_ids" % parkey).tolist()
+        node_attributes = {}
+        for key in _list_bundle_keys(bundle, "%s/nodes/" % parkey):
+            values = _read_bundle_array(bundle, "%s/nodes/%s" % (parkey, key))
+            if key == "dn_position":
+                node_attributes[key] = [tuple(value) for value in values.tolist()]
+            else:
+                node_attributes[key] = values.tolist()
+
+        connectome = Connectome(node_ids, node_attributes)
+        connectome.set_edges(_read_bundle_array(bundle, "%s/edges" % parkey))
+
+        masks = _list_bundle_keys(bundle, "%s/masks/" % parkey)
+        if metrics is None:
+            metrics = _list_bundle_keys(bundle, "%s/metrics/" % parkey)
+        for name in metrics:
+            connectome.add_edge_metric(
+                name,
+                _read_bundle_array(bundle, "%s/metrics/%s" % (parkey, name)),
+                _read_bundle_array(bundle, "%s/masks/%s" % (parkey, name))
+                if name in masks
+                else None,
+            )
+
+    return connectome
 
-    # Computation for each fiber
-    for i, fi in enumerate(fib):
 
-        # Percent counter
-        if print_info:
-            pcN = int(round(float(100 * i) / n))
-            if pcN > pc and pcN % 20 == 0:
-                pc = pcN
-                print("%4.0f%%" % pc)
+def _share_arrays(arrays, folder):
+    """Save arrays as ``.npy`` files so that they can be memory-mapped read-only by the workers of :func:`cmat`."""
+    if not op.exists(folder):
+        os.makedirs(folder)
+    files = {}
+    for name, array in arrays.items():
+        files[name] = op.abspath(op.join(folder, "%s.npy" % name))
+        np.save(files[name], array)
+    return files
 
-        f = fi[0]
 
-        # store startpoint
-        endpoints[i, 0, :] = f[0, :]
-        # store endpoint
-        endpoints[i, 1, :] = f[-1, :]
+def _load_shared_arrays(files):
+    """Memory-map the arrays saved by :func:`_share_arrays`."""
+    return dict((name, np.load(fname, mmap_mode="r")) for name, fname in files.items())
 
-        # store startpoint
-        endpointsmm[i, 0, :] = f[0, :]
-        # store endpoint
-        endpointsmm[i, 1, :] = f[-1, :]
 
-        # print 'endpoints (mm) : ',endpoints[i, 0, :],' ; ',endpoints[i, 1, :]
+def _scale_connectome_nodes(parval, roiData):
+    """Create the connectome of a resolution with the node information of the parcellation.
 
-        # Translate from mm to index
-        endpoints[i, 0, 0] = int(endpoints[i, 0, 0] / float(voxelSize[0]))
-        endpoints[i, 0, 1] = int(endpoints[i, 0, 1] / float(voxelSize[1]))
-        endpoints[i, 0, 2] = int(endpoints[i, 0, 2] / float(voxelSize[2]))
-        endpoints[i, 1, 0] = int(endpoints[i, 1, 0] / float(voxelSize[0]))
-        endpoints[i, 1, 1] = int(endpoints[i, 1, 1] / float(voxelSize[1]))
-        endpoints[i, 1, 2] = int(endpoints[i, 1, 2] / float(voxelSize[2]))
+    Returns
+    -------
+    connectome : Connectome
+        Connectome without edges
 
-        # print 'endpoints : ',endpoints[i, 0, :],' ; ',endpoints[i, 1, :]
+    roi_volume : numpy.ndarray
+        Number of voxels of each ROI indexed by label, padded up to the
+        number of regions of the resolution
 
-    # Return the matrices
-    return endpoints, endpointsmm
+    node_ids : list
+        Node labels in the order of the graph
+    """
+    # Create the matrix
+    print(
+        "  >> Create the connection matrix (%s rois)" % parval["number_of_regions"]
+    )
+
+    nROIs = parval["number_of_regions"]
+
+    # Add node information from parcellation
+    connectome = Connectome.from_graphml(parval["node_information_graphml"])
+    roi_volume, roi_position = compute_roi_node_information(roiData)
+    # compute a position for each node based on the mean position of the
+    # ROI in voxel coordinates (segmentation volume )
+    roi_ids = [int(roi_id) for roi_id in connectome.node_attributes["dn_multiscaleID"]]
+    connectome.set_node_attribute(
+        "dn_position",
+        [
+            tuple(roi_position[roi_id]) if roi_id < roi_volume.size else (np.nan, np.nan, np.nan)
+            for roi_id in roi_ids
+        ],
+    )
+    connectome.set_node_attribute(
+        "roi_volume",
+        [roi_volume[roi_id] if roi_id < roi_volume.size else 0 for roi_id in roi_ids],
+    )
+    # FIXME treat case of self-connection that gives di['fiber_length_mean'] = 0.0
+    if roi_volume.size <= nROIs:
+        roi_volume = np.pad(roi_volume, (0, nROIs + 1 - roi_volume.size))
+    return connectome, roi_volume, list(connectome.node_ids)
+
+
+def _print_fiber_filtering_info(n, dis, n_outside, n_overflow):
+    """Print the number of fibers discarded when labeling their endpoints (See :func:`filter_fiber_labels`)."""
+    if n_outside > 0:
+        print(
+            " .. ERROR: An index error occured for %i fibers. " % n_outside
+        )
+        print("           This means that the fiber start or endpoint is outside the volume.")
+        print("           Continue.")
+
+    if n_overflow > 0:
+        print(
+            " .. ERROR: Start or endpoint of %i fibers terminate in a voxel which is labeled higher"
+            % n_overflow
+        )
+        print("           than is expected by the parcellation node information.")
+        print("           This needs bugfixing!")
+        print("           Continue.")
+
+    # TODO: Refine fibers ending in thalamus
+    # if (startROI in thalamic_labels) or (endROI in thalamic_labels):
+    # Extract all thalamic nuclei the fiber is passing through
+    # Refine start/endROI connecting to the most probable nucleus
+
+    print(
+        "  ... INFO - Found %i (%f percent out of %i fibers) fibers " % (dis, dis * 100.0 / max(n, 1), n) +
+        "that start or terminate in a voxel which is not labeled. (orphans)"
+    )
+    print(
+        "  ... INFO - Valid fibers: %i (%f percent)"
+        % (n - dis, 100 - dis * 100.0 / max(n, 1))
+    )
+
+
+def _save_scale_connectome(parkey, connectome, edge_metrics, edge_scalars, output_types):
+    """Add the edge metrics to the connectome of a resolution and save it."""
+    for key, values in edge_metrics.items():
+        connectome.add_edge_metric(key, values)
+    for k, (mean, std, median, has_values) in edge_scalars.items():
+        connectome.add_edge_metric(k + "_mean", mean, has_values)
+        connectome.add_edge_metric(k + "_std", std, has_values)
+        connectome.add_edge_metric(k + "_median", median, has_values)
 
+    print("  ************************************************")
+    print("  >> Save structural connectome maps as :")
+    connectome.save("connectome_%s" % parkey, output_types)
 
-def save_fibers(oldhdr, oldfib, fname, indices):
-    """Stores a new trackvis file fname using only given indices.
+
+def _create_scale_connectome(parkey, parval, shared_files, map_names, output_types):
+    """Create and save the connectome of one resolution from the per-fiber measures shared by :func:`cmat`.
 
     Parameters
     ----------
-    oldhdr : the tractogram header
-        Tractogram header to use as reference
+    parkey : string
+        Name of the resolution
 
-    oldfib : the fibers data
-        Input fibers
+    parval : dict
+        Resolution information (``number_of_regions`` and ``node_information_graphml``)
 
-    fname : string
-        Output tractogram filename
+    shared_files : dict
+        Files of the memory-mapped arrays (See :func:`_share_arrays`)
+
+    map_names : list
+        Names of the additional maps
+
+    output_types : ['gPickle','mat','graphml']
+
+    Returns
+    -------
+    valid : numpy.ndarray
+        Boolean array of size [#fibers] which is `True` for the fibers used
+        in the connectome
+
+    connectome : Connectome
+        Connectome of the resolution
+    """
+    shared = _load_shared_arrays(shared_files)
+    fiberlength = shared["fiberlength"]
+    n = fiberlength.shape[0]  # number of fibers
+    scalars = dict(
+        (k, tuple(shared["map-%s_%i" % (k, i)] for i in range(2))) for k in map_names
+    )
+
+    nROIs = parval["number_of_regions"]
+    connectome, roi_volume, node_ids = _scale_connectome_nodes(parval, shared["roi_data"])
+
+    print("  ************************")
+    print("  >> Processing fibers and computing metrics (%s fibers)" % n)
+    fiberlabels, valid, orphans, outside, overflow = filter_fiber_labels(
+        shared["endpoint_labels"], shared["endpoints_inside"], nROIs
+    )
+    _print_fiber_filtering_info(
+        n,
+        int(np.count_nonzero(orphans)),
+        int(np.count_nonzero(outside)),
+        int(np.count_nonzero(overflow)),
+    )
+
+    final_fibers_idx = np.flatnonzero(valid)
+
+    # create a final fiber length array
+    final_fiberlength_array = fiberlength[final_fibers_idx]
+
+    # make final fiber labels as array
+    final_fiberlabels_array = np.array(fiberlabels[final_fibers_idx], dtype=np.int32)
+
+    # Compute the connectivity measures of all edges at once
+    # New connectivity measures can be added in _edge_metrics()
+    edges, edge_metrics, fiber_order, edge_offsets = aggregate_edge_metrics(
+        final_fiberlabels_array, final_fiberlength_array, roi_volume, node_ids
+    )
+    # Compute mean/std/median of the additional maps along the fibers of each edge.
+    # This is indexed into the fibers that are valid in the sense of touching start
+    # and end roi and not going out of the volume
+    edge_scalars = aggregate_edge_scalars(
+        scalars, shared["offsets"], final_fibers_idx[fiber_order], edge_offsets
+    )
+
+    connectome.set_edges(edges)
+    _save_scale_connectome(parkey, connectome, edge_metrics, edge_scalars, output_types)
+
+    # Storing final fiber length array
+    fiberlabels_fname = "final_fiberslength_%s.npy" % str(parkey)
+    np.save(fiberlabels_fname, final_fiberlength_array)
+
+    # Storing all fiber labels (with orphans)
+    fiberlabels_fname = "filtered_fiberslabel_%s.npy" % str(parkey)
+    np.save(
+        fiberlabels_fname,
+        np.array(fiberlabels, dtype=np.int32),
+    )
+
+    # Storing final fiber labels (no orphans)
+    fiberlabels_noorphans_fname = "final_fiberlabels_%s.npy" % str(parkey)
+    np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
+
+    return valid, connectome
+
+
+def _create_streamed_scale_connectome(
+    parkey, parval, shared_files, map_names, output_types, statistics, chunk_size
+):
+    """Create and save the connectome of one resolution from the per-edge sums accumulated in streaming mode.
+
+    The mean and standard deviation of each edge are computed from the sums
+    of :class:`_StreamedEdgeStatistics`, while the exact medians of the fiber
+    lengths and of the per-fiber mean map values are computed from the arrays
+    saved on disk (See :func:`_streamed_edge_medians`).
+
+    Parameters
+    ----------
+    parkey : string
+        Name of the resolution
+
+    parval : dict
+        Resolution information (``number_of_regions`` and ``node_information_graphml``)
+
+    shared_files : dict
+        Files of the memory-mapped arrays (See :func:`_stream_fiber_labels`)
 
-    indices : list
-        Indices of fibers included
+    map_names : list
+        Names of the additional maps
+
+    output_types : ['gPickle','mat','graphml']
+
+    statistics : _StreamedEdgeStatistics
+        Per-edge sums of the resolution
+
+    chunk_size : int
+        Number of fibers read at once
+
+    Returns
+    -------
+    valid : numpy.ndarray
+        Boolean array of size [#fibers] which is `True` for the fibers used
+        in the connectome
+
+    connectome : Connectome
+        Connectome of the resolution
     """
+    shared = _load_shared_arrays(shared_files)
+    fiberlabels = shared["fiberlabels"]
+    n = statistics.n_fibers  # number of fibers
 
-    hdrnew = oldhdr.copy()
+    connectome, roi_volume, node_ids = _scale_connectome_nodes(parval, shared["roi_data"])
 
-    outstreams = []
-    for i in indices:
-        outstreams.append(oldfib[i])
+    print("  ************************")
+    print("  >> Computing metrics from the fibers of each edge (%s fibers)" % n)
+    _print_fiber_filtering_info(
+        n, statistics.n_orphans, statistics.n_outside, statistics.n_overflow
+    )
+
+    edge_codes, edges, number_of_fibers, length_stats, map_stats = statistics.edge_statistics()
+    fiber_values = dict(("map-%s_mean" % k, shared["map-%s_mean" % k]) for k in map_names)
+    fiber_values["fiberlength"] = shared["fiberlength"]
+    medians = _streamed_edge_medians(
+        statistics, edge_codes, fiberlabels, fiber_values, chunk_size
+    )
+
+    edge_metrics = _edge_metrics(
+        edges,
+        number_of_fibers,
+        int(np.sum(number_of_fibers)),
+        length_stats[0],
+        length_stats[1],
+        medians["fiberlength"],
+        roi_volume,
+        node_ids,
+    )
+    edge_scalars = dict(
+        (k, (mean, std, medians["map-%s_mean" % k], has_values))
+        for k, (mean, std, has_values) in map_stats.items()
+    )
 
-    n_fib_out = len(outstreams)
-    hdrnew["n_count"] = n_fib_out
+    connectome.set_edges(edges)
+    _save_scale_connectome(parkey, connectome, edge_metrics, edge_scalars, output_types)
 
-    print("Writing final no orphan fibers: %s" % fname)
-    nib.trackvis.write(fname, outstreams, hdrnew)
+    # Storing final fiber length and labels arrays (no orphans)
+    valid = np.zeros(n, dtype=bool)
+    length_writer = _NpyChunkWriter("final_fiberslength_%s.npy" % str(parkey), np.float64)
+    labels_writer = _NpyChunkWriter("final_fiberlabels_%s.npy" % str(parkey), np.int32, (2,))
+    for i in range(0, n, chunk_size):
+        labels = np.asarray(fiberlabels[i:i + chunk_size])
+        chunk_valid = labels[:, 0] > 0
+        valid[i:i + chunk_size] = chunk_valid
+        length_writer.append(shared["fiberlength"][i:i + chunk_size][chunk_valid])
+        labels_writer.append(labels[chunk_valid])
+    length_writer.close()
+    labels_writer.close()
+
+    return valid, connectome
 
 
 def cmat(
@@ -167,13 +2175,19 @@ def cmat(
     additional_maps=None,
     output_types=None,
     atlas_info=None,
+    scalar_map_interpolation="nearest",
+    map_dtypes=None,
+    streaming=False,
+    chunk_size=100000,
+    number_of_cores=1,
+    endpoint_search_radius=0,
 ):
     """Create the connection matrix for each resolution using fibers and ROIs.
 
     Parameters
     ----------
-    intrk : TRK file
-        Reconstructed tractogram
+    intrk : TRK or TCK file
+        Reconstructed tractogram (TCK is only supported in streaming mode)
 
     roi_volumes : list
         List of parcellation files for a given parcellation scheme
@@ -189,11 +2203,47 @@ def cmat(
         A dictionary of key/value for each additional map where the value
         is the path to the map
 
-    output_types : ['gPickle','mat','graphml']
+    output_types : ['gPickle','mat','graphml','h5','npz']
+        Output types of the connectivity matrices, where 'h5' and 'npz'
+        save the connectomes of all resolutions in a single file
+        (See :func:`save_connectome_bundle`)
 
     atlas_info : dict
         Dictionary storing information such as path to files related to a
         parcellation atlas / scheme.
+
+    scalar_map_interpolation : ['nearest', 'trilinear']
+        Interpolation used to sample the additional maps along the fibers
+
+    map_dtypes : dict
+        Data type used to sample and reduce each additional map
+        (Default: `numpy.float64` for all maps)
+
+    streaming : Boolean
+        If `True`, read the tractogram by chunks of `chunk_size` fibers and
+        label the endpoints of each chunk as it is read, so that only the
+        per-edge sums (number of fibers, sums and sums of squares of lengths
+        and map values) are kept in memory. The mean and standard deviation
+        of each edge are computed from these sums. The median cannot be
+        updated chunk by chunk: the fiber lengths and per-fiber mean map
+        values are saved on disk and read again by blocks of edges, so that
+        the memory used to compute the median is bounded by the larger of
+        `chunk_size` and the number of fibers of the largest edge.
+        In this mode, the median of the additional maps for each edge is
+        the median of the per-fiber mean values.
+
+    chunk_size : int
+        Number of fibers processed at once in streaming mode
+
+    number_of_cores : int
+        Maximal number of resolutions processed in parallel. The per-fiber
+        measures are computed once and shared with the workers as
+        memory-mapped arrays.
+
+    endpoint_search_radius : float
+        If greater than 0, fiber endpoints in unlabeled voxels are assigned
+        the label of the nearest labeled voxel within this radius in mm
+        (See :func:`compute_nearest_label_volume`)
     """
     if additional_maps is None:
         additional_maps = {}
@@ -213,32 +2263,31 @@ def cmat(
     en_fnamemm = "endpointsmm.npy"
     curv_fname = "meancurvature.npy"
 
-    fib, hdr = nib.trackvis.read(intrk, False)
-    n = len(fib)  # number of fibers
-
     if parcellation_scheme != "Custom":
-        if parcellation_scheme != "Lausanne2018":
-            resolutions = get_parcellation(parcellation_scheme)
-        else:
-            resolutions = get_parcellation(parcellation_scheme)
-            for parkey, parval in list(resolutions.items()):
-                for vol, graphml in zip(roi_volumes, roi_graphmls):
-                    if parkey in vol:
-                        roi_fname = vol
-                    if parkey in graphml:
-                        roi_graphml_fname = graphml
-
-                roi = nib.load(roi_fname)
-                roiData = roi.get_data()
-                resolutions[parkey]["number_of_regions"] = roiData.max()
-                resolutions[parkey]["node_information_graphml"] = op.abspath(
-                    roi_graphml_fname
-                )
-
-            del roi, roiData
+        resolutions = get_parcellation(parcellation_scheme)
     else:
         resolutions = atlas_info
 
+    # Open the ROI volume corresponding to each resolution only once:
+    # scale1 for lausanne2008/18
+    # first volume for nativefreesurfer
+    roi_volumes_data = {}
+    for parkey in resolutions.keys():
+        for vol in roi_volumes:
+            if (parkey in vol) or (len(roi_volumes) == 1):
+                roi_fname = vol
+        roi_volumes_data[parkey] = nib.load(roi_fname).get_data()
+
+    if parcellation_scheme == "Lausanne2018":
+        for parkey, parval in list(resolutions.items()):
+            for graphml in roi_graphmls:
+                if parkey in graphml:
+                    roi_graphml_fname = graphml
+            resolutions[parkey]["number_of_regions"] = roi_volumes_data[parkey].max()
+            resolutions[parkey]["node_information_graphml"] = op.abspath(
+                roi_graphml_fname
+            )
+
     # Previously, load_endpoints_from_trk() used the voxel size stored
     # in the track hdr to transform the endpoints to ROI voxel space.
     # This only works if the ROI voxel size is the same as the DSI/DTI
@@ -250,410 +2299,182 @@ def cmat(
     firstROI = nib.load(firstROIFile)
     roiVoxelSize = firstROI.get_header().get_zooms()
 
-    (endpoints, endpointsmm) = create_endpoints_array(fib, roiVoxelSize, True)
-    np.save(en_fname, endpoints)
-    np.save(en_fnamemm, endpointsmm)
-
-    # Only compute curvature if required
-    if compute_curvature:
-        meancurv = compute_curvature_array(fib)
-        np.save(curv_fname, meancurv)
-
-    streamline_wrote = False
-    for parkey, parval in list(resolutions.items()):
-        print("------------------------------------------------")
-        print("Resolution = " + parkey)
-        print("------------------------------------------------")
-
-        # create empty fiber label array
-        fiberlabels = np.zeros((n, 2))
-        final_fiberlabels = []
-        final_fibers_idx = []
-
-        # Open the corresponding ROI:
-        # scale1 for lausanne2008/18
-        # first volume for nativefreesurfer
-        for vol in roi_volumes:
-            if (parkey in vol) or (len(roi_volumes) == 1):
-                roi_fname = vol
-        roi = nib.load(roi_fname)
-        roiData = roi.get_data()
-
-        # Create the matrix
+    # Load the additional maps
+    mmapdata = {}
+    print("  >> Maps to be processed :")
+    for k, v in list(additional_maps.items()):
+        print("     - %s map" % k)
+        da = nib.load(v)
+        mdata = np.nan_to_num(da.get_data())
+        mmapdata[k] = (mdata, da.get_header().get_zooms())
+
+    # Assign the endpoints in unlabeled voxels to the nearest label
+    if endpoint_search_radius > 0:
         print(
-            "  >> Create the connection matrix (%s rois)" % parval["number_of_regions"]
+            "  >> Assign unlabeled fiber endpoints to the nearest label within %g mm"
+            % endpoint_search_radius
         )
-
-        nROIs = parval["number_of_regions"]
-        G = nx.Graph()
-
-        # Add node information from parcellation
-        gp = nx.read_graphml(parval["node_information_graphml"])
-        n_nodes = len(gp)
-        pc = -1
-        cnt = -1
-
-        for u, d in gp.nodes(data=True):
-
-            # Percent counter
-            cnt += 1
-            pcN = int(round(float(100 * cnt) / n_nodes))
-            if pcN > pc and pcN % 10 == 0:
-                pc = pcN
-                print("%4.0f%%" % pc)
-
-            G.add_node(int(u))
-            for key in d:
-                G.nodes[int(u)][key] = d[key]
-            # compute a position for the node based on the mean position of the
-            # ROI in voxel coordinates (segmentation volume )
-            G.nodes[int(u)]["dn_position"] = tuple(
-                np.mean(np.where(roiData == int(d["dn_multiscaleID"])), axis=1)
-            )
-            G.nodes[int(u)]["roi_volume"] = np.sum(
-                roiData == int(d["dn_multiscaleID"])
+        edt_cache = {}
+        labeling_volumes = dict(
+            (
+                parkey,
+                compute_nearest_label_volume(
+                    roi_data, roiVoxelSize, endpoint_search_radius, cache=edt_cache
+                ),
             )
-
-        dis = 0
-
-        # Prepare: compute the measures
-        t = [c[0] for c in fib]
-        h = np.array(t, dtype=np.object)
-
-        mmap = additional_maps
-        mmapdata = {}
-        print("  >> Maps to be processed :")
-        for k, v in list(mmap.items()):
-            print("     - %s map" % k)
-            da = nib.load(v)
-            mdata = da.get_data()
-            print(mdata.max())
-            mdata = np.nan_to_num(mdata)
-            print(mdata.max())
-            mmapdata[k] = (mdata, da.get_header().get_zooms())
-
-        print("  ************************")
-        print("  >> Processing fibers and computing metrics (%s fibers)" % n)
-        pc = -1
-        for i in range(n):  # n: number of fibers
-            # Percent counter
-            pcN = int(round(float(100 * i) / n))
-            if pcN > pc and pcN % 10 == 0:
-                pc = pcN
-                print("%4.0f%%" % pc)
-
-            # ROI start => ROI end
-            try:
-                startvox = np.zeros((3, 1)).astype(int)
-                startvox[0] = np.int(endpoints[i, 0, 0])
-                startvox[1] = np.int(endpoints[i, 0, 1])
-                startvox[2] = np.int(endpoints[i, 0, 2])
-
-                endvox = np.zeros((3, 1)).astype(int)
-                endvox[0] = np.int(endpoints[i, 1, 0])
-                endvox[1] = np.int(endpoints[i, 1, 1])
-                endvox[2] = np.int(endpoints[i, 1, 2])
-
-                # Endpoints from create_endpoints_array
-                startROI = int(roiData[startvox[0], startvox[1], startvox[2]])
-                endROI = int(roiData[endvox[0], endvox[1], endvox[2]])
-
-            except IndexError:
-                print(" .. ERROR: An index error occured for fiber %s. " % i)
-                print("           This means that the fiber start or endpoint is outside the volume. Continue.")
-                print("           Continue.")
-                continue
-
-            # Filter
-            if startROI == 0 or endROI == 0:
-                dis += 1
-                fiberlabels[i, 0] = -1
-                continue
-
-            if startROI > nROIs or endROI > nROIs:
-                print(" .. ERROR: Start or endpoint of fiber terminate in a voxel which is labeled higher")
-                print("           than is expected by the parcellation node information.")
-                print("           Start ROI: %i, End ROI: %i" % (startROI, endROI))
-                print("           This needs bugfixing!")
-                print("           Continue.")
-                continue
-
-            # Switch the rois in order to enforce startROI < endROI
-            if endROI < startROI:
-                tmp = startROI
-                startROI = endROI
-                endROI = tmp
-
-            # TODO: Refine fibers ending in thalamus
-            # if (startROI in thalamic_labels) or (endROI in thalamic_labels):
-            # Extract all thalamic nuclei the fiber is passing through
-            # Refine start/endROI connecting to the most probable nucleus
-
-            # Update fiber label
-            fiberlabels[i, 0] = startROI
-            fiberlabels[i, 1] = endROI
-
-            final_fiberlabels.append([startROI, endROI])
-            final_fibers_idx.append(i)
-
-            # Add edge to graph
-            if G.has_edge(startROI, endROI):
-                G[startROI][endROI]["fiblist"].append(i)
-            else:
-                G.add_edge(startROI, endROI, fiblist=[i])
-
-        print(
-            "  ... INFO - Found %i (%f percent out of %i fibers) fibers " % (dis, dis * 100.0 / n, n) +
-            "that start or terminate in a voxel which is not labeled. (orphans)"
-        )
-        print(
-            "  ... INFO - Valid fibers: %i (%f percent)"
-            % (n - dis, 100 - dis * 100.0 / n)
+            for parkey, roi_data in roi_volumes_data.items()
         )
+        del edt_cache
+    else:
+        labeling_volumes = roi_volumes_data
+
+    # The per-fiber measures shared with the workers are removed even if
+    # the creation of a connectome fails
+    try:
+        map_names = list(additional_maps.keys())
+        scale_args = []
+        if streaming:
+            # Label the fibers of each chunk as it is read and only keep
+            # running per-edge sums in memory
+            print(
+                "  >> Read tractogram by chunks of %i fibers and label fiber endpoints "
+                "for all resolutions" % chunk_size
+            )
+            statistics, fiber_files = _stream_fiber_labels(
+                intrk,
+                firstROI,
+                labeling_volumes,
+                resolutions,
+                mmapdata,
+                compute_curvature,
+                scalar_map_interpolation,
+                map_dtypes,
+                chunk_size,
+                "cmat_shared",
+            )
+            del mmapdata, labeling_volumes
 
-        # create a final fiber length array
-        finalfiberlength = []
-        for idx in final_fibers_idx:
-            # compute length of fiber
-            finalfiberlength.append(length(fib[idx][0]))
-
-        # convert to array
-        final_fiberlength_array = np.array(finalfiberlength)
-
-        # make final fiber labels as array
-        final_fiberlabels_array = np.array(final_fiberlabels, dtype=np.int32)
-
-        total_fibers = 0
-        total_volume = 0
-        u_old = -1
-        for u, v, d in G.edges(data=True):
-            total_fibers += len(d["fiblist"])
-            if u != u_old:
-                total_volume += G.nodes[int(u)]["roi_volume"]
-            u_old = u
-
-        G_out = copy.deepcopy(G)
-
-        # Update edges
-        # New connectivity measures can be added here
-        # FIXME treat case of self-connection that gives di['fiber_length_mean'] = 0.0
-        for u, v, d in G.edges(data=True):
-            # Check for diagonal elements that raise an error when the edge is visited a second time
-            G_out.remove_edge(u, v)
-
-            if len(list(G[u][v].keys())) == 1:
-                di = {"number_of_fibers": len(G[u][v]["fiblist"])}
-
-                # additional measures
-                # compute mean/std of fiber measure
-                if u <= v:
-                    idx = np.where(
-                        (final_fiberlabels_array[:, 0] == int(u))
-                        & (final_fiberlabels_array[:, 1] == int(v))
-                    )[0]
-                else:
-                    idx = np.where(
-                        (final_fiberlabels_array[:, 0] == int(v))
-                        & (final_fiberlabels_array[:, 1] == int(u))
-                    )[0]
-
-                di["fiber_length_mean"] = float(
-                    np.nanmean(final_fiberlength_array[idx])
-                )
-                di["fiber_length_median"] = float(
-                    np.nanmedian(final_fiberlength_array[idx])
-                )
-                di["fiber_length_std"] = float(np.nanstd(final_fiberlength_array[idx]))
-
-                di["fiber_proportion"] = float(
-                    100.0 * (di["number_of_fibers"] / float(total_fibers))
+            for parkey, parval in list(resolutions.items()):
+                shared_files = _share_arrays(
+                    {"roi_data": roi_volumes_data[parkey]}, op.join("cmat_shared", parkey)
                 )
-
-                # Compute density
-                # Formula: density = (#fibers / mean_fibers_length) * (2 / (area_roi_u + area_roi_v))
-                if di["fiber_length_mean"] > 0.0:
-                    di["fiber_density"] = float(
-                        (float(di["number_of_fibers"]) / float(di["fiber_length_mean"]))
-                        * float(
-                            2.0
-                            / (
-                                G.nodes[int(u)]["roi_volume"]
-                                + G.nodes[int(v)]["roi_volume"]
-                            )
-                        )
+                shared_files["fiberlabels"] = op.abspath("filtered_fiberslabel_%s.npy" % parkey)
+                shared_files.update(fiber_files)
+                scale_args.append(
+                    (
+                        parkey,
+                        parval,
+                        shared_files,
+                        map_names,
+                        output_types,
+                        statistics[parkey],
+                        chunk_size,
                     )
-                    di["normalized_fiber_density"] = float(
-                        (
-                            (float(di["number_of_fibers"]) / float(total_fibers))
-                            / float(di["fiber_length_mean"])
-                        )
-                        * (
-                            (2.0 * float(total_volume))
-                            / (
-                                G.nodes[int(u)]["roi_volume"]
-                                + G.nodes[int(v)]["roi_volume"]
-                            )
-                        )
+                )
+            create_scale_connectome = _create_streamed_scale_connectome
+        else:
+            fib, _ = nib.trackvis.read(intrk, False)
+            n = len(fib)  # number of fibers
+
+            (endpoints, endpointsmm) = create_endpoints_array(fib, roiVoxelSize, True)
+            points, offsets = concatenate_fibers(fib)
+
+            # compute length of fibers
+            fiberlength = streamline_lengths(points, offsets)
+
+            # Only compute curvature if required
+            if compute_curvature:
+                print("Compute curvature ...")
+                meancurv = streamline_mean_curvature(points, offsets).reshape(-1, 1)
+
+            # Sample the additional maps along all the fibers at once
+            sampled_maps = sample_scalar_maps(
+                points,
+                offsets,
+                mmapdata,
+                interpolation=scalar_map_interpolation,
+                map_dtypes=map_dtypes,
+            )
+            del mmapdata
+
+            np.save(en_fname, endpoints)
+            np.save(en_fnamemm, endpointsmm)
+            if compute_curvature:
+                np.save(curv_fname, meancurv)
+
+            for k, (_, fiber_ok) in sampled_maps.items():
+                n_discarded = n - int(np.count_nonzero(fiber_ok))
+                if n_discarded > 0:
+                    print(
+                        "  ... WARNING - %i fibers have points outside the volume of the %s map "
+                        "and are discarded for this measure" % (n_discarded, k)
                     )
-                else:
-                    di["fiber_density"] = 0.0
-                    di["normalized_fiber_density"] = 0.0
-                # This is indexed into the fibers that are valid in the sense of touching start
-                # and end roi and not going out of the volume
-                if u <= v:
-                    idx_valid = np.where(
-                        (fiberlabels[:, 0] == int(u)) & (fiberlabels[:, 1] == int(v))
-                    )[0]
-                else:
-                    idx_valid = np.where(
-                        (fiberlabels[:, 0] == int(v)) & (fiberlabels[:, 1] == int(u))
-                    )[0]
-
-                for k, vv in list(mmapdata.items()):
-                    val = []
-                    for i in idx_valid:
-                        # retrieve indices
-                        try:
-                            idx2 = (h[i] / vv[1]).astype(np.uint32)
-                            val.append(vv[0][idx2[:, 0], idx2[:, 1], idx2[:, 2]])
-                        except IndexError as e:
-                            print(
-                                "  ... ERROR - Index error occured when trying extract scalar values for measure",
-                                k,
-                            )
-                            print(
-                                "  ... ERROR - Discard fiber with index ",
-                                i,
-                                "Exception: ",
-                                e,
-                            )
-
-                    if len(val) > 0:
-                        da = np.concatenate(val)
-
-                        if k == "shore_rtop":
-                            di[k + "_mean"] = da.astype(np.float64).mean()
-                            di[k + "_std"] = da.astype(np.float64).std()
-                            di[k + "_median"] = np.median(da.astype(np.float64))
-                        else:
-                            di[k + "_mean"] = da.mean().astype(np.float)
-                            di[k + "_std"] = da.std().astype(np.float)
-                            di[k + "_median"] = np.median(da).astype(np.float)
-
-                        del da
-                        del val
-
-                G_out.add_edge(u, v)
-                for key in di:
-                    G_out[u][v][key] = di[key]
-
-        del G
-
-        print("  ************************************************")
-        print("  >> Save structural connectome maps as :")
-        # Get the edge attributes/keys/weights from the first edge and then break.
-        # Change w.r.t networkx2
-        edge_keys = []
-        for u, v, d in G_out.edges(data=True):
-            edge_keys = list(d.keys())
-            break
 
-        # Storing network/graph in TSV format (by default to be BIDS compliant)
-        print("    - connectome_%s.tsv" % parkey)
-        # Write header fields
-        with open("connectome_%s.tsv" % parkey, "w") as out_file:
-            tsv_writer = csv.writer(out_file, delimiter="\t")
-            header = ["source", "target"]
-            header = header + [key for key in edge_keys]
-            tsv_writer.writerow(header)
-        # Write list of graph edges with all connectivity metrics (edge_keys)
-        with open("connectome_%s.tsv" % parkey, "ab") as out_file:
-            nx.write_edgelist(
-                G_out,
-                out_file,
-                comments="#",
-                delimiter="\t",
-                data=edge_keys,
-                encoding="utf-8",
+            # Look up the endpoint labels for all the resolutions at once
+            print("  >> Label fiber endpoints for all resolutions (%s fibers)" % n)
+            endpoint_labels, endpoints_inside = label_fiber_endpoints(
+                endpoints, list(labeling_volumes.values())
             )
+            del labeling_volumes
+            endpoint_labels = dict(zip(roi_volumes_data.keys(), endpoint_labels))
+            endpoints_inside = dict(zip(roi_volumes_data.keys(), endpoints_inside))
+
+            # Share the per-fiber measures with the workers that build the connectome
+            # of each resolution, as memory-mapped read-only arrays
+            common_arrays = {"fiberlength": fiberlength, "offsets": offsets}
+            for k, fields in sampled_maps.items():
+                for i, field in enumerate(fields):
+                    common_arrays["map-%s_%i" % (k, i)] = field
+            common_files = _share_arrays(common_arrays, "cmat_shared")
+            del common_arrays
 
-        # Storing network/graph in other formats that might be prefered by the user
-        if "gPickle" in output_types:
-            print("    - connectome_%s.gpickle" % parkey)
-            nx.write_gpickle(G_out, "connectome_%s.gpickle" % parkey)
-
-        if "mat" in output_types:
-            edge_struct = {}
-            for edge_key in edge_keys:
-                if edge_key != "fiblist":
-                    edge_struct[edge_key] = nx.to_numpy_matrix(G_out, weight=edge_key)
-
-            # nodes
-            size_nodes = len(list(G_out.nodes(data=True)))
-
-            # Get the node attributes/keys from the first node and then break.
-            # Change w.r.t networkx2
-            for u, d in G_out.nodes(data=True):
-                node_keys = list(d.keys())
-                break
-
-            node_struct = {}
-            for node_key in node_keys:
-                if node_key == "dn_position":
-                    node_arr = np.zeros([size_nodes, 3], dtype=np.float)
-                else:
-                    node_arr = np.zeros(size_nodes, dtype=np.object_)
-
-                node_n = 0
-                for _, node_data in G_out.nodes(data=True):
-                    node_arr[node_n] = node_data[node_key]
-                    node_n += 1
-                node_struct[node_key] = node_arr
-            print("    - connectome_%s.mat" % parkey)
-            sio.savemat(
-                "connectome_%s.mat" % parkey,
-                long_field_names=True,
-                mdict={"sc": edge_struct, "nodes": node_struct},
+            for parkey, parval in list(resolutions.items()):
+                shared_files = _share_arrays(
+                    {
+                        "roi_data": roi_volumes_data[parkey],
+                        "endpoint_labels": endpoint_labels[parkey],
+                        "endpoints_inside": endpoints_inside[parkey],
+                    },
+                    op.join("cmat_shared", parkey),
+                )
+                shared_files.update(common_files)
+                scale_args.append((parkey, parval, shared_files, map_names, output_types))
+            create_scale_connectome = _create_scale_connectome
+        del roi_volumes_data
+
+        # Processes cannot be started from a daemonic process
+        # (such as a worker of the nipype MultiProc plugin)
+        n_workers = min(number_of_cores, len(scale_args))
+        if n_workers > 1 and multiprocessing.current_process().daemon:
+            print("  ... INFO - Running in a daemonic process: resolutions are processed sequentially")
+            n_workers = 1
+
+        if n_workers > 1:
+            print("  >> Process %i resolutions with %i workers" % (len(scale_args), n_workers))
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = [executor.submit(create_scale_connectome, *args) for args in scale_args]
+                results = [future.result() for future in futures]
+        else:
+            results = [create_scale_connectome(*args) for args in scale_args]
+    finally:
+        shutil.rmtree("cmat_shared", ignore_errors=True)
+
+    valid_fibers = [valid for valid, _ in results]
+
+    for bundle_type in ["h5", "npz"]:
+        if bundle_type in output_types:
+            print("  >> Save structural connectomes of all resolutions as :")
+            print("    - connectomes.%s" % bundle_type)
+            save_connectome_bundle(
+                "connectomes.%s" % bundle_type,
+                dict((args[0], connectome) for args, (_, connectome) in zip(scale_args, results)),
             )
 
-        if "graphml" in output_types:
-            g2 = nx.Graph()
-            for u_gml, v_gml, d_gml in G_out.edges(data=True):
-                g2.add_edge(u_gml, v_gml)
-                for key in d_gml:
-                    g2[u_gml][v_gml][key] = d_gml[key]
-            for u_gml, d_gml in G_out.nodes(data=True):
-                g2.add_node(u_gml)
-                g2.nodes[u_gml]["dn_multiscaleID"] = d_gml["dn_multiscaleID"]
-                g2.nodes[u_gml]["dn_fsname"] = d_gml["dn_fsname"]
-                g2.nodes[u_gml]["dn_hemisphere"] = d_gml["dn_hemisphere"]
-                g2.nodes[u_gml]["dn_name"] = d_gml["dn_name"]
-                g2.nodes[u_gml]["dn_position_x"] = d_gml["dn_position"][0]
-                g2.nodes[u_gml]["dn_position_y"] = d_gml["dn_position"][1]
-                g2.nodes[u_gml]["dn_position_z"] = d_gml["dn_position"][2]
-                g2.nodes[u_gml]["dn_region"] = d_gml["dn_region"]
-            print("    - connectome_%s.graphml" % parkey)
-            nx.write_graphml(g2, "connectome_%s.graphml" % parkey)
-
-        # Storing final fiber length array
-        fiberlabels_fname = "final_fiberslength_%s.npy" % str(parkey)
-        np.save(fiberlabels_fname, final_fiberlength_array)
-
-        # Storing all fiber labels (with orphans)
-        fiberlabels_fname = "filtered_fiberslabel_%s.npy" % str(parkey)
-        np.save(
-            fiberlabels_fname,
-            np.array(fiberlabels, dtype=np.int32),
-        )
-
-        # Storing final fiber labels (no orphans)
-        fiberlabels_noorphans_fname = "final_fiberlabels_%s.npy" % str(parkey)
-        np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
-
-        if not streamline_wrote:
-            print("  > Filtering tractography - keeping only no orphan fibers")
-            finalfibers_fname = "streamline_final.trk"
-            save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx)
+    # The final tractogram only keeps the fibers used for the last resolution
+    print("  > Filtering tractography - keeping only no orphan fibers")
+    finalfibers_fname = "streamline_final.trk"
+    print("Writing final no orphan fibers: %s" % finalfibers_fname)
+    save_streamlines_subset(intrk, finalfibers_fname, valid_fibers[-1], firstROI)
 
     print("Done.")
     print("========================")
@@ -684,6 +2505,43 @@ class DmriCmatInputSpec(BaseInterfaceInputSpec):
         File, desc="Additional calculated maps (ADC, gFA, ...)"
     )
 
+    scalar_map_interpolation = traits.Enum(
+        "nearest",
+        ["nearest", "trilinear"],
+        desc="Interpolation used to sample the additional maps along the fibers",
+        usedefault=True,
+    )
+
+    map_dtypes = Dict(
+        Str,
+        Str,
+        desc="Data type (such as 'float32') used to sample and reduce each additional map "
+        "indexed by map name (Default: 'float64')",
+    )
+
+    streaming = traits.Bool(
+        False,
+        desc="Read the tractogram (TRK or TCK) by chunks of fibers to bound the memory usage",
+        usedefault=True,
+    )
+
+    chunk_size = traits.Int(
+        100000, desc="Number of fibers read at once in streaming mode", usedefault=True
+    )
+
+    number_of_cores = traits.Int(
+        1,
+        desc="Maximal number of resolutions whose connectome is built in parallel",
+        usedefault=True,
+    )
+
+    endpoint_search_radius = traits.Float(
+        0,
+        desc="Radius in mm in which fiber endpoints in unlabeled voxels are assigned "
+        "to the nearest label (0: disabled)",
+        usedefault=True,
+    )
+
     output_types = traits.List(Str, desc="Output types of the connectivity matrices")
 
     voxel_connectivity = InputMultiPath(
@@ -763,6 +2621,12 @@ class DmriCmat(BaseInterface):
             compute_curvature=self.inputs.compute_curvature,
             additional_maps=additional_maps,
             output_types=self.inputs.output_types,
+            scalar_map_interpolation=self.inputs.scalar_map_interpolation,
+            map_dtypes=self.inputs.map_dtypes if isdefined(self.inputs.map_dtypes) else None,
+            streaming=self.inputs.streaming,
+            chunk_size=self.inputs.chunk_size,
+            number_of_cores=self.inputs.number_of_cores,
+            endpoint_search_radius=self.inputs.endpoint_search_radius,
         )
 
         return runtime
@@ -819,10 +2683,51 @@ class RsfmriCmatInputSpec(BaseInterfaceInputSpec):
 
     output_types = traits.List(Str, desc="Output types of the connectivity matrices")
 
+    compute_roi_statistics = Bool(
+        False,
+        usedefault=True,
+        desc="Save the number of voxels and the standard deviation time-series of each ROI",
+    )
+
+    connectivity_estimators = traits.List(
+        Str,
+        ["corr"],
+        usedefault=True,
+        desc="Connectivity estimators computed as edge metrics "
+        "(see `cmtklib.connectome.CONNECTIVITY_ESTIMATORS`)",
+    )
+
+    dynamic_fc = Bool(
+        False,
+        usedefault=True,
+        desc="Compute sliding-window dynamic functional connectivity "
+        "(on the unscrubbed time-series, with the number of frames "
+        "retained by scrubbing in each window if scrubbing is applied)",
+    )
+
+    window_length = Int(60, usedefault=True, desc="Sliding window length in volumes")
+
+    window_step = Int(1, usedefault=True, desc="Number of volumes between consecutive windows")
+
+    window_taper = traits.Enum(
+        "rectangular",
+        ["rectangular", "hann", "hamming"],
+        usedefault=True,
+        desc="Sliding window weighting function",
+    )
+
 
 class RsfmriCmatOutputSpec(TraitedSpec):
     avg_timeseries = OutputMultiPath(File(exists=True), desc="ROI average timeseries")
 
+    roi_statistics = OutputMultiPath(
+        File(exists=True), desc="ROI voxel counts and standard deviation timeseries"
+    )
+
+    dynamic_connectivity = OutputMultiPath(
+        File(exists=True), desc="Sliding-window functional connectivity matrices"
+    )
+
     scrubbed_idx = File(exists=True, desc="Scrubbed indices")
 
     connectivity_matrices = OutputMultiPath(
@@ -869,8 +2774,7 @@ class RsfmriCmat(BaseInterface):
         print("   .. parcellation : %s" % self.inputs.parcellation_scheme)
         print("================================================")
 
-        fdata = nib.load(self.inputs.func_file).get_data()
-        tp = fdata.shape[3]
+        _, fdata = load_image_data(self.inputs.func_file)
 
         if self.inputs.parcellation_scheme != "Custom":
             if self.inputs.parcellation_scheme == "NativeFreesurfer":
@@ -892,31 +2796,47 @@ class RsfmriCmat(BaseInterface):
         else:
             resolutions = self.inputs.atlas_info
 
-        # loop throughout all the resolutions ('scale33', ..., 'scale500')
-        for parkey, parval in list(resolutions.items()):
-            print("------------------------------------------------")
-            print("Resolution = " + parkey)
-            print("------------------------------------------------")
-
-            # Open the corresponding ROI
+        # Open the ROI volumes of all the resolutions
+        roi_volumes_data = {}
+        for parkey in resolutions.keys():
             for vol in self.inputs.roi_volumes:
                 if (parkey in vol) or (len(self.inputs.roi_volumes) == 1):
                     roi_fname = vol
+            roi_volumes_data[parkey] = nib.load(roi_fname).get_data()
 
-            roi = nib.load(roi_fname)
-            mask = roi.get_data()
+        # Compute the average time-series of all the resolutions in one pass
+        print("  ************************************************")
+        print("  >> Compute average rs-fMRI signal for each cortical ROI ")
+        parkeys = list(resolutions.keys())
+        roi_timeseries = extract_roi_timeseries(
+            fdata,
+            [roi_volumes_data[parkey] for parkey in parkeys],
+            [int(resolutions[parkey]["number_of_regions"]) for parkey in parkeys],
+            return_counts=self.inputs.compute_roi_statistics,
+            return_std=self.inputs.compute_roi_statistics,
+        )
+        if self.inputs.compute_roi_statistics:
+            roi_timeseries, roi_counts, roi_std = roi_timeseries
+            for k, parkey in enumerate(parkeys):
+                np.save(os.path.abspath("roiVoxelCounts_%s.npy" % parkey), roi_counts[k])
+                np.save(
+                    os.path.abspath("stdTimeseries_%s.npy" % parkey),
+                    roi_std[k].astype(np.float32),
+                )
+        del fdata
 
-            # Compute average time-series
-            print("  ************************************************")
-            print("  >> Compute average rs-fMRI signal for each cortical ROI ")
-            nROIs = parval["number_of_regions"]  # number of ROIs for current resolution
+        connectomes = {}
+        dynamic_arrays = {}
+        # loop throughout all the resolutions ('scale33', ..., 'scale500')
+        for k, (parkey, parval) in enumerate(list(resolutions.items())):
+            print("------------------------------------------------")
+            print("Resolution = " + parkey)
+            print("------------------------------------------------")
 
-            # matrix number of rois vs timepoints
-            ts = np.zeros((nROIs, tp), dtype=np.float32)
+            mask = roi_volumes_data[parkey]
 
-            # loop throughout all the ROIs (current resolution)
-            for i in range(1, nROIs + 1):
-                ts[i - 1, :] = fdata[mask == i].mean(axis=0)
+            # matrix number of rois vs timepoints
+            ts = roi_timeseries[k].astype(np.float32)
 
             # Save average roi time-series
             np.save(os.path.abspath("averageTimeseries_%s.npy" % parkey), ts)
@@ -925,19 +2845,24 @@ class RsfmriCmat(BaseInterface):
             # Create graph, add node information from parcellation and recover ROI indexes
             print("  ************************************************")
             print("  >> Load %s to initialize graph " % parval["node_information_graphml"])
-            G = nx.Graph()
-            gp = nx.read_graphml(parval["node_information_graphml"])
-            ROI_idx = []
-            for u, d in gp.nodes(data=True):
-                G.add_node(int(u))
-                for key in d:
-                    G.nodes[int(u)][key] = d[key]
-                # Compute a position for the node based on the mean position of the
-                # ROI in voxel coordinates (segmentation volume )
-                G.nodes[int(u)]["dn_position"] = tuple(
-                    np.mean(np.where(mask == int(d["dn_multiscaleID"])), axis=1)
-                )
-                ROI_idx.append(int(d["dn_multiscaleID"]))
+            connectome = Connectome.from_graphml(parval["node_information_graphml"])
+            ROI_idx = [int(roi_id) for roi_id in connectome.node_attributes["dn_multiscaleID"]]
+            # Compute a position for the node based on the mean position of the
+            # ROI in voxel coordinates (segmentation volume )
+            _, roi_position = compute_roi_node_information(mask)
+            connectome.set_node_attribute(
+                "dn_position",
+                [
+                    tuple(roi_position[roi_id]) if roi_id < len(roi_position)
+                    else (np.nan, np.nan, np.nan)
+                    for roi_id in ROI_idx
+                ],
+            )
+
+            # Sliding windows are computed on the unscrubbed time-series,
+            # such that they cover consecutive acquisition frames
+            ts_frames = ts
+            index = None
 
             # Apply scrubbing (if enabled)
             if self.inputs.apply_scrubbing:
@@ -979,99 +2904,78 @@ class RsfmriCmat(BaseInterface):
 
             # Compute pairwise ROI time-series correlation
             print("  ************************************************")
-            print("  >> Compute pairwise ROI time-series correlation")
+            print("  >> Compute pairwise ROI time-series connectivity")
+            unknown = set(self.inputs.connectivity_estimators) - set(CONNECTIVITY_ESTIMATORS)
+            if unknown:
+                raise ValueError(
+                    "Unknown connectivity estimator(s) %s (available: %s)"
+                    % (", ".join(sorted(unknown)), ", ".join(sorted(CONNECTIVITY_ESTIMATORS)))
+                )
             nnodes = ts.shape[0]
-            i = -1
-            for i_signal in ts:
-                i += 1
-                for j in range(i, nnodes):
-                    j_signal = ts[j, :]
-                    value = np.corrcoef(i_signal, j_signal)[0, 1]
-                    G.add_edge(ROI_idx[i], ROI_idx[j])
-                    G[ROI_idx[i]][ROI_idx[j]]["corr"] = value
-
-            # Get the edge attributes/keys/weights from the first edge and then break.
-            # Change w.r.t networkx2
-            edge_keys = []
-            for _, _, d in G.edges(data=True):
-                edge_keys = list(d.keys())
-                break
+            estimates = ConnectivityEstimates(ts)
+            # Edges between all pairs of ROIs (self-connections included)
+            i, j = np.triu_indices(nnodes)
+            ROI_idx = np.array(ROI_idx[:nnodes], dtype=np.int64)
+            connectome.set_edges(np.column_stack((ROI_idx[i], ROI_idx[j])))
+            for estimator in self.inputs.connectivity_estimators:
+                print("    - %s" % estimator)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    values = CONNECTIVITY_ESTIMATORS[estimator](estimates)[i, j]
+                if estimator == "corr":
+                    connectome.add_edge_metric(estimator, values)
+                else:
+                    connectome.add_edge_metric(estimator, values, defined=np.isfinite(values))
+
+            # Compute sliding-window correlations (if enabled)
+            if self.inputs.dynamic_fc:
+                print("  ************************************************")
+                print(
+                    "  >> Compute dynamic functional connectivity (window: %d, step: %d, taper: %s)"
+                    % (self.inputs.window_length, self.inputs.window_step, self.inputs.window_taper)
+                )
+                dynamic_fc, onsets = compute_dynamic_fc(
+                    ts_frames,
+                    self.inputs.window_length,
+                    window_step=self.inputs.window_step,
+                    taper=self.inputs.window_taper,
+                )
+                print("    - dynamicConnectivity_%s.npy" % parkey)
+                np.save(os.path.abspath("dynamicConnectivity_%s.npy" % parkey), dynamic_fc)
+                dynamic_arrays["%s/node_ids" % parkey] = ROI_idx
+                dynamic_arrays["%s/dynamic/corr" % parkey] = dynamic_fc
+                dynamic_arrays["%s/dynamic/onsets" % parkey] = onsets
+                if index is not None:
+                    # Number of frames of each window retained by scrubbing
+                    retained = np.zeros(ts_frames.shape[1], dtype=np.int64)
+                    retained[index] = 1
+                    retained = np.concatenate(([0], np.cumsum(retained)))
+                    retained_counts = (
+                        retained[onsets + self.inputs.window_length] - retained[onsets]
+                    )
+                    print("    - dynamicConnectivity_%s_retained.npy" % parkey)
+                    np.save(
+                        os.path.abspath("dynamicConnectivity_%s_retained.npy" % parkey),
+                        retained_counts,
+                    )
+                    dynamic_arrays["%s/dynamic/retained_frames" % parkey] = retained_counts
+                    dynamic_arrays["%s/dynamic/scrubbing_index" % parkey] = index
 
             # Save the computed connectivity matrix
             print("  ************************************************")
             print("  >> Save functional connectome map as:")
+            connectome.save("connectome_%s" % parkey, self.inputs.output_types)
+            connectomes[parkey] = connectome
 
-            print("    - connectome_%s.tsv" % parkey)
-            with open("connectome_%s.tsv" % parkey, "w") as out_file:
-                tsv_writer = csv.writer(out_file, delimiter="\t")
-                header = ["source", "target"]
-                header = header + [key for key in edge_keys]
-                tsv_writer.writerow(header)
-
-            with open("connectome_%s.tsv" % parkey, "ab") as out_file:
-                nx.write_edgelist(
-                    G,
-                    out_file,
-                    comments="#",
-                    delimiter="\t",
-                    data=edge_keys,
-                    encoding="utf-8",
-                )
+        for bundle_type in ["h5", "npz"]:
+            if bundle_type in self.inputs.output_types:
+                print("  >> Save functional connectomes of all resolutions as :")
+                print("    - connectomes.%s" % bundle_type)
+                save_connectome_bundle("connectomes.%s" % bundle_type, connectomes)
 
-            # storing network
-            if "gPickle" in self.inputs.output_types:
-                print("    - connectome_%s.gpickle" % parkey)
-                nx.write_gpickle(G, "connectome_%s.gpickle" % parkey)
-
-            if "mat" in self.inputs.output_types:
-                print("    - connectome_%s.mat" % parkey)
-                edge_struct = {}
-                for edge_key in edge_keys:
-                    edge_struct[edge_key] = nx.to_numpy_matrix(G, weight=edge_key)
-
-                # Number of ROIs (nodes)
-                size_nodes = len(list(G.nodes()))
-
-                # Get the node attributes/keys from the first node and then break.
-                # Change w.r.t networkx2
-                for u, d in G.nodes(data=True):
-                    node_keys = list(d.keys())
-                    break
-
-                node_struct = {}
-                for node_key in node_keys:
-                    if node_key == "dn_position":
-                        node_arr = np.zeros([size_nodes, 3], dtype=np.float)
-                    else:
-                        node_arr = np.zeros(size_nodes, dtype=np.object_)
-                    node_n = 0
-                    for _, node_data in G.nodes(data=True):
-                        node_arr[node_n] = node_data[node_key]
-                        node_n += 1
-                    node_struct[node_key] = node_arr
-
-                sio.savemat("connectome_%s.mat" % parkey, mdict={"sc": edge_struct, "nodes": node_struct})
-
-            if "graphml" in self.inputs.output_types:
-                print("    - connectome_%s.graphml" % parkey)
-                g2 = nx.Graph()
-                # Create graph nodes
-                for u_gml, d_gml in G.nodes(data=True):
-                    g2.add_node(u_gml)
-                    g2.nodes[u_gml]["dn_multiscaleID"] = d_gml["dn_multiscaleID"]
-                    g2.nodes[u_gml]["dn_fsname"] = d_gml["dn_fsname"]
-                    g2.nodes[u_gml]["dn_hemisphere"] = d_gml["dn_hemisphere"]
-                    g2.nodes[u_gml]["dn_name"] = d_gml["dn_name"]
-                    g2.nodes[u_gml]["dn_position_x"] = d_gml["dn_position"][0]
-                    g2.nodes[u_gml]["dn_position_y"] = d_gml["dn_position"][1]
-                    g2.nodes[u_gml]["dn_position_z"] = d_gml["dn_position"][2]
-                    g2.nodes[u_gml]["dn_region"] = d_gml["dn_region"]
-                # Create graph edges
-                for u_gml, v_gml, d_gml in G.edges(data=True):
-                    g2.add_edge(u_gml, v_gml)
-                    g2[u_gml][v_gml]["corr"] = float(d_gml["corr"])
-                # Save the graph
-                nx.write_graphml(g2, "connectome_%s.graphml" % parkey)
+        if self.inputs.dynamic_fc and "h5" in self.inputs.output_types:
+            print("  >> Save dynamic functional connectivity of all resolutions as :")
+            print("    - dynamicConnectivity.h5")
+            _save_bundle_arrays("dynamicConnectivity.h5", dynamic_arrays)
 
         print("[ DONE ]")
         return runtime
@@ -1080,6 +2984,14 @@ class RsfmriCmat(BaseInterface):
         outputs = self._outputs().get()
         outputs["connectivity_matrices"] = glob.glob(os.path.abspath("connectome*"))
         outputs["avg_timeseries"] = glob.glob(os.path.abspath("averageTimeseries_*"))
+        if self.inputs.dynamic_fc:
+            outputs["dynamic_connectivity"] = glob.glob(
+                os.path.abspath("dynamicConnectivity*")
+            )
+        if self.inputs.compute_roi_statistics:
+            outputs["roi_statistics"] = glob.glob(
+                os.path.abspath("roiVoxelCounts_*")
+            ) + glob.glob(os.path.abspath("stdTimeseries_*"))
         if self.inputs.apply_scrubbing:
             outputs["scrubbed_idx"] = os.path.abspath("tp_after_scrubbing.npy")
         return outputs
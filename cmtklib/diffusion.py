@@ -7,11 +7,9 @@
 """Module that defines CMTK utility functions for the diffusion pipeline."""
 
 import os
-import subprocess
 
 import nibabel as nib
 import numpy as np
-import nibabel.trackvis as tv
 
 from nipype.interfaces.base import (
     BaseInterface,
@@ -24,7 +22,9 @@ from nipype.interfaces.base import (
 
 from traits.trait_types import List, Str, Int, Enum
 
-from .util import length
+from .util import streamline_lengths
+from .labels import label_masks
+from .morphology import sphere_kernel, modal_dilate, gaussian_smooth
 
 
 def compute_length_array(trkfile=None, streams=None, savefname="lengths.npy"):
@@ -32,8 +32,10 @@ def compute_length_array(trkfile=None, streams=None, savefname="lengths.npy"):
 
     Parameters
     ----------
-    trkfile : TRK file
-        Path to the tractogram in TRK format
+    trkfile : TRK or TCK file
+        Path to the tractogram in TRK or TCK format. Lengths are computed from
+        the points in RAS+ world coordinates (mm), such that no reference
+        image is required for TCK tractograms
 
     streams : the fibers data
         The fibers from which we want to compute the length
@@ -48,21 +50,26 @@ def compute_length_array(trkfile=None, streams=None, savefname="lengths.npy"):
     """
     if streams is None and trkfile is not None:
         print(f'Compute length array for fibers in {trkfile}')
-        streams, hdr = tv.read(trkfile, as_generator=True)
-        n_fibers = hdr["n_count"]
-        if n_fibers == 0:
+        fibers_length = [
+            streamline_lengths(points, offsets)
+            for points, offsets in iter_streamline_chunks(trkfile, space="rasmm")
+        ]
+        if len(fibers_length) == 0:
             msg = (
-                f'Header field n_count of trackfile {trkfile} is set to 0. '
+                f'Trackfile {trkfile} has no streamline. '
                 "No track seem to exist in this file."
             )
             print(msg)
             raise Exception(msg)
+        fibers_length = np.concatenate(fibers_length)
     else:
-        n_fibers = len(streams)
-
-    fibers_length = np.zeros(n_fibers, dtype=np.float)
-    for i, fib in enumerate(streams):
-        fibers_length[i] = length(fib[0])
+        lengths = np.array([len(fib[0]) for fib in streams], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        if len(streams) > 0:
+            points = np.concatenate([fib[0] for fib in streams])
+        else:
+            points = np.zeros((0, 3))
+        fibers_length = streamline_lengths(points, offsets)
 
     # store length array
     np.save(savefname, fibers_length)
@@ -71,15 +78,182 @@ def compute_length_array(trkfile=None, streams=None, savefname="lengths.npy"):
     return fibers_length
 
 
+def get_rasmm_to_voxmm_affine(tractogram_file, reference=None):
+    """Return the affine mapping streamline points from RAS+mm to trackvis `voxmm` coordinates.
+
+    The `voxmm` space is the one of the points returned by ``nibabel.trackvis.read``,
+    where point coordinates are voxel indices scaled by the voxel size
+    with the origin at the corner of the first voxel.
+
+    Parameters
+    ----------
+    tractogram_file : nibabel.streamlines.TractogramFile
+        Tractogram loaded with ``nibabel.streamlines.load``
+
+    reference : nibabel image
+        Image defining the voxel grid, used only when the tractogram has no
+        voxel grid information (TCK format)
+
+    Returns
+    -------
+    affine : numpy.ndarray
+        4x4 affine matrix
+    """
+    from nibabel.streamlines.trk import get_affine_trackvis_to_rasmm
+
+    if isinstance(tractogram_file, nib.streamlines.TrkFile):
+        return np.linalg.inv(get_affine_trackvis_to_rasmm(tractogram_file.header))
+
+    if reference is None:
+        raise ValueError(
+            "A reference image is required to express the points of a "
+            "%s tractogram in voxmm space." % type(tractogram_file).__name__
+        )
+    zooms = np.asarray(reference.header.get_zooms()[:3], dtype=np.float64)
+    vox_to_voxmm = np.diag(np.append(zooms, 1.0))
+    vox_to_voxmm[:3, 3] = 0.5 * zooms
+    return np.dot(vox_to_voxmm, np.linalg.inv(reference.affine))
+
+
+def iter_streamline_chunks(track_file, reference=None, chunk_size=100000, space="voxmm"):
+    """Iterate over the streamlines of a TRK or TCK tractogram by chunks of fixed size.
+
+    Streamlines are read lazily so that at most `chunk_size` streamlines
+    are held in memory at once.
+
+    Parameters
+    ----------
+    track_file : string
+        Path to a tractogram in TRK or TCK format
+
+    reference : nibabel image
+        Image defining the voxel grid of the `voxmm` space for TCK tractograms
+        (See :func:`get_rasmm_to_voxmm_affine`)
+
+    chunk_size : int
+        Number of streamlines per chunk
+
+    space : 'voxmm' or 'rasmm'
+        Space of the returned points: trackvis `voxmm` coordinates, or the
+        RAS+ world coordinates in mm of ``nibabel.streamlines``, which do not
+        require a reference image for TCK tractograms
+
+    Yields
+    ------
+    points : numpy.ndarray
+        Array of size [#points, 3] with the points of the streamlines of the
+        chunk in `space` coordinates
+
+    offsets : numpy.ndarray
+        Array of size [#streamlines + 1] such that the points of streamline `i`
+        are ``points[offsets[i]:offsets[i + 1]]``
+    """
+    if space not in ["voxmm", "rasmm"]:
+        raise ValueError("Invalid streamline space: %s (should be 'voxmm' or 'rasmm')" % space)
+    tractogram_file = nib.streamlines.load(track_file, lazy_load=True)
+    if space == "voxmm":
+        rasmm_to_voxmm = get_rasmm_to_voxmm_affine(tractogram_file, reference)
+    else:
+        rasmm_to_voxmm = np.eye(4)
+
+    def _to_voxmm(streamlines):
+        offsets = np.concatenate(
+            ([0], np.cumsum([len(s) for s in streamlines]))
+        ).astype(np.int64)
+        points = nib.affines.apply_affine(rasmm_to_voxmm, np.concatenate(streamlines))
+        return points.astype(np.float32), offsets
+
+    chunk = []
+    for streamline in tractogram_file.streamlines:
+        chunk.append(streamline)
+        if len(chunk) == chunk_size:
+            yield _to_voxmm(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        yield _to_voxmm(chunk)
+
+
+def save_streamlines_subset(in_file, out_file, selection, reference=None):
+    """Write a subset of the streamlines of a tractogram to a new tractogram.
+
+    Streamlines are read lazily and written one by one, so that the input
+    tractogram is never loaded entirely in memory.
+
+    Parameters
+    ----------
+    in_file : string
+        Path to the input tractogram in TRK or TCK format
+
+    out_file : string
+        Path to the output tractogram whose format (TRK or TCK)
+        is determined by its extension
+
+    selection : numpy.ndarray
+        Boolean mask of size [#streamlines] or array of indices of the
+        streamlines to keep
+
+    reference : nibabel image
+        Image defining the voxel grid, required to write a TRK file
+        from a TCK tractogram
+
+    Returns
+    -------
+    n_selected : int
+        Number of streamlines written
+    """
+    from nibabel.streamlines import Field
+    from nibabel.orientations import aff2axcodes
+
+    selection = np.asarray(selection)
+    if selection.dtype != bool:
+        mask = np.zeros(selection.max() + 1 if selection.size > 0 else 0, dtype=bool)
+        mask[selection] = True
+        selection = mask
+
+    tractogram_file = nib.streamlines.load(in_file, lazy_load=True)
+    out_format = nib.streamlines.detect_format(out_file)
+    if out_format is None:
+        raise ValueError("Unknown tractogram format of %s" % out_file)
+
+    header = None
+    if out_format is nib.streamlines.TrkFile:
+        if isinstance(tractogram_file, nib.streamlines.TrkFile):
+            header = tractogram_file.header.copy()
+        elif reference is not None:
+            header = {
+                Field.VOXEL_TO_RASMM: reference.affine.copy(),
+                Field.VOXEL_SIZES: reference.header.get_zooms()[:3],
+                Field.DIMENSIONS: reference.shape[:3],
+                Field.VOXEL_ORDER: "".join(aff2axcodes(reference.affine)),
+            }
+        else:
+            raise ValueError(
+                "A reference image is required to write the %s tractogram %s in TRK format."
+                % (type(tractogram_file).__name__, in_file)
+            )
+
+    def _selected_streamlines():
+        for i, streamline in enumerate(tractogram_file.streamlines):
+            if i < selection.size and selection[i]:
+                yield streamline
+
+    tractogram = nib.streamlines.LazyTractogram(
+        _selected_streamlines, affine_to_rasmm=np.eye(4)
+    )
+    nib.streamlines.save(tractogram, out_file, header=header)
+
+    return int(np.count_nonzero(selection))
+
+
 def filter_fibers(intrk, outtrk="", fiber_cutoff_lower=20, fiber_cutoff_upper=500):
     """Filters a tractogram based on lower / upper cutoffs.
 
     Parameters
     ----------
-    intrk : TRK file
-        Path to a tractogram file in TRK format
+    intrk : TRK or TCK file
+        Path to a tractogram file in TRK or TCK format
 
-    outtrk : TRK file
+    outtrk : TRK or TCK file
         Output path for the filtered tractogram
 
     fiber_cutoff_lower : int
@@ -102,25 +276,12 @@ def filter_fibers(intrk, outtrk="", fiber_cutoff_lower=20, fiber_cutoff_upper=50
     le = compute_length_array(intrk)
 
     # cut the fibers smaller than value
-    reducedidx = np.where((le > fiber_cutoff_lower) & (le < fiber_cutoff_upper))[0]
-
-    # load trackfile (downside, needs everything in memory)
-    fibold, hdrold = tv.read(intrk)
+    selected = (le > fiber_cutoff_lower) & (le < fiber_cutoff_upper)
 
     # rewrite the track vis file with the reduced number of fibers
-    outstreams = []
-    for i in reducedidx:
-        outstreams.append(fibold[i])
-
-    n_fib_out = len(outstreams)
-    hdrnew = hdrold.copy()
-    hdrnew["n_count"] = n_fib_out
-
-    # print("Compute length array for cutted fibers")
-    # le = compute_length_array(streams=outstreams)
     print(f'Write out file: {outtrk}')
-    print(f'Number of fibers out : {hdrnew["n_count"]}')
-    tv.write(outtrk, outstreams, hdrnew)
+    n_fib_out = save_streamlines_subset(intrk, outtrk, selected)
+    print(f'Number of fibers out : {n_fib_out}')
     print(f'File wrote : {os.path.exists(outtrk)}')
 
     # ----
@@ -270,117 +431,36 @@ class ExtractPVEsFrom5TT(BaseInterface):
         #
         # Extract from https://mrtrix.readthedocs.io/en/latest/quantitative_structural_connectivity/act.html
 
-        # Create and save PVE for CSF
-        pve_csf = data_5tt[:, :, :, 3].squeeze()
-        pve_csf_img = nib.Nifti1Image(pve_csf.astype(np.float), affine)
-        nib.save(pve_csf_img, os.path.abspath(self.inputs.pve_csf_file))
-
-        # Create and save PVE for WM
-        pve_wm = data_5tt[:, :, :, 2].squeeze()
-        pve_wm_img = nib.Nifti1Image(pve_wm.astype(np.float), affine)
-        nib.save(pve_wm_img, os.path.abspath(self.inputs.pve_wm_file))
-
-        # Create and save PVE for GM
-        pve_gm = data_5tt[:, :, :, 0].squeeze() + data_5tt[:, :, :, 1].squeeze()
-        pve_gm_img = nib.Nifti1Image(pve_gm.astype(np.float), affine)
-        nib.save(pve_gm_img, os.path.abspath(self.inputs.pve_gm_file))
+        # Create PVEs for CSF, WM and GM
+        pves = {
+            "CSF": data_5tt[:, :, :, 3].squeeze(),
+            "WM": data_5tt[:, :, :, 2].squeeze(),
+            "GM": data_5tt[:, :, :, 0].squeeze() + data_5tt[:, :, :, 1].squeeze(),
+        }
 
-        # Dilate PVEs and normalize to 1
+        # Dilate PVEs and normalize to 1, in memory
         fwhm = 2.0
-        radius = np.float(0.5 * fwhm)
-        sigma = np.float(fwhm / 2.3548)
+        radius = 0.5 * fwhm
+        sigma = fwhm / 2.3548
 
         print("sigma : %s" % sigma)
 
-        fslmaths_cmd = "fslmaths %s -kernel sphere %s -dilD %s" % (
-            os.path.abspath(self.inputs.pve_csf_file),
-            radius,
-            os.path.abspath(self.inputs.pve_csf_file),
-        )
-        print("Dilate CSF PVE")
-        print(fslmaths_cmd)
-        process = subprocess.Popen(
-            fslmaths_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        _ = process.communicate()[0].strip()
-
-        fslmaths_cmd = "fslmaths %s -kernel sphere %s -dilD %s" % (
-            os.path.abspath(self.inputs.pve_wm_file),
-            radius,
-            os.path.abspath(self.inputs.pve_wm_file),
-        )
-        print("Dilate WM PVE")
-        print(fslmaths_cmd)
-        process = subprocess.Popen(
-            fslmaths_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        _ = process.communicate()[0].strip()
-
-        fslmaths_cmd = "fslmaths %s -kernel sphere %s -dilD %s" % (
-            os.path.abspath(self.inputs.pve_gm_file),
-            radius,
-            os.path.abspath(self.inputs.pve_gm_file),
-        )
-        print("Dilate GM PVE")
-        print(fslmaths_cmd)
-        process = subprocess.Popen(
-            fslmaths_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        _ = process.communicate()[0].strip()
-
-        fslmaths_cmd = "fslmaths %s -kernel gauss %s -fmean %s" % (
-            os.path.abspath(self.inputs.pve_csf_file),
-            sigma,
-            os.path.abspath(self.inputs.pve_csf_file),
-        )
-        print("Gaussian smoothing : CSF PVE")
-        print(fslmaths_cmd)
-        process = subprocess.Popen(
-            fslmaths_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        _ = process.communicate()[0].strip()
-
-        fslmaths_cmd = "fslmaths %s -kernel gauss %s -fmean %s" % (
-            os.path.abspath(self.inputs.pve_wm_file),
-            sigma,
-            os.path.abspath(self.inputs.pve_wm_file),
-        )
-        print("Gaussian smoothing : WM PVE")
-        print(fslmaths_cmd)
-        process = subprocess.Popen(
-            fslmaths_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        _ = process.communicate()[0].strip()
-
-        fslmaths_cmd = "fslmaths %s -kernel gauss %s -fmean %s" % (
-            os.path.abspath(self.inputs.pve_gm_file),
-            sigma,
-            os.path.abspath(self.inputs.pve_gm_file),
-        )
-        print("Gaussian smoothing : GM PVE")
-        print(fslmaths_cmd)
-        process = subprocess.Popen(
-            fslmaths_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-        _ = process.communicate()[0].strip()
-
-        pve_csf = nib.load(os.path.abspath(self.inputs.pve_csf_file)).get_data()
-        pve_wm = nib.load(os.path.abspath(self.inputs.pve_wm_file)).get_data()
-        pve_gm = nib.load(os.path.abspath(self.inputs.pve_gm_file)).get_data()
-
-        pve_sum = pve_csf + pve_wm + pve_gm
-        pve_csf = np.divide(pve_csf, pve_sum)
-        pve_wm = np.divide(pve_wm, pve_sum)
-        pve_gm = np.divide(pve_gm, pve_sum)
-
-        pve_csf_img = nib.Nifti1Image(pve_csf.astype(np.float), affine)
-        nib.save(pve_csf_img, os.path.abspath(self.inputs.pve_csf_file))
-
-        pve_wm_img = nib.Nifti1Image(pve_wm.astype(np.float), affine)
-        nib.save(pve_wm_img, os.path.abspath(self.inputs.pve_wm_file))
-
-        pve_gm_img = nib.Nifti1Image(pve_gm.astype(np.float), affine)
-        nib.save(pve_gm_img, os.path.abspath(self.inputs.pve_gm_file))
+        voxel_size = np.sqrt(np.sum(np.square(affine[:3, :3]), axis=0))
+        kernel = sphere_kernel(radius, voxel_size)
+        for tissue, pve in pves.items():
+            print("Dilate %s PVE" % tissue)
+            pve = modal_dilate(pve.astype(np.float64), kernel)
+            print("Gaussian smoothing : %s PVE" % tissue)
+            pves[tissue] = gaussian_smooth(pve, voxel_size, sigma=sigma)
+
+        pve_sum = pves["CSF"] + pves["WM"] + pves["GM"]
+        for tissue, fname in [
+            ("CSF", self.inputs.pve_csf_file),
+            ("WM", self.inputs.pve_wm_file),
+            ("GM", self.inputs.pve_gm_file),
+        ]:
+            pve_img = nib.Nifti1Image(np.divide(pves[tissue], pve_sum), affine)
+            nib.save(pve_img, os.path.abspath(fname))
 
         return runtime
 
@@ -590,53 +670,16 @@ class UpdateGMWMInterfaceSeeding(BaseInterface):
         new_gmwmi_data = gmwmi_data.copy()
 
         if roi_data.max() > 83:
-            # Thalamic nuclei
-            new_gmwmi_data[roi_data == 35] = maxv
-            new_gmwmi_data[roi_data == 36] = maxv
-            new_gmwmi_data[roi_data == 37] = maxv
-            new_gmwmi_data[roi_data == 38] = maxv
-            new_gmwmi_data[roi_data == 39] = maxv
-            new_gmwmi_data[roi_data == 40] = maxv
-            new_gmwmi_data[roi_data == 41] = maxv
-            new_gmwmi_data[roi_data == 96] = maxv
-            new_gmwmi_data[roi_data == 97] = maxv
-            new_gmwmi_data[roi_data == 98] = maxv
-            new_gmwmi_data[roi_data == 99] = maxv
-            new_gmwmi_data[roi_data == 100] = maxv
-            new_gmwmi_data[roi_data == 101] = maxv
-            new_gmwmi_data[roi_data == 102] = maxv
-
-            # Hippocampal subfields
-            new_gmwmi_data[roi_data == 48] = maxv
-            new_gmwmi_data[roi_data == 49] = maxv
-            new_gmwmi_data[roi_data == 50] = maxv
-            new_gmwmi_data[roi_data == 51] = maxv
-            new_gmwmi_data[roi_data == 52] = maxv
-            new_gmwmi_data[roi_data == 53] = maxv
-            new_gmwmi_data[roi_data == 54] = maxv
-            new_gmwmi_data[roi_data == 55] = maxv
-            new_gmwmi_data[roi_data == 56] = maxv
-            new_gmwmi_data[roi_data == 57] = maxv
-            new_gmwmi_data[roi_data == 58] = maxv
-            new_gmwmi_data[roi_data == 59] = maxv
-            new_gmwmi_data[roi_data == 109] = maxv
-            new_gmwmi_data[roi_data == 110] = maxv
-            new_gmwmi_data[roi_data == 111] = maxv
-            new_gmwmi_data[roi_data == 112] = maxv
-            new_gmwmi_data[roi_data == 113] = maxv
-            new_gmwmi_data[roi_data == 114] = maxv
-            new_gmwmi_data[roi_data == 115] = maxv
-            new_gmwmi_data[roi_data == 116] = maxv
-            new_gmwmi_data[roi_data == 117] = maxv
-            new_gmwmi_data[roi_data == 118] = maxv
-            new_gmwmi_data[roi_data == 119] = maxv
-            new_gmwmi_data[roi_data == 120] = maxv
-
-            # Brain stem
-            new_gmwmi_data[roi_data == 123] = maxv
-            new_gmwmi_data[roi_data == 124] = maxv
-            new_gmwmi_data[roi_data == 125] = maxv
-            new_gmwmi_data[roi_data == 126] = maxv
+            # Voxels of all the extra structures are found in one pass over the scale1 volume
+            seeding = label_masks(roi_data, {"extra_structures": (
+                # Thalamic nuclei
+                list(range(35, 41 + 1)) + list(range(96, 102 + 1)) +
+                # Hippocampal subfields
+                list(range(48, 59 + 1)) + list(range(109, 120 + 1)) +
+                # Brain stem
+                list(range(123, 126 + 1))
+            )})["extra_structures"]
+            new_gmwmi_data[seeding] = maxv
 
         new_gmwmi_img = nib.Nifti1Pair(new_gmwmi_data, gmwmi_img.affine)
         nib.save(new_gmwmi_img, self.inputs.out_gmwmi_file)
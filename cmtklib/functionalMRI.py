@@ -17,6 +17,15 @@ from nipype.interfaces.base import (
     BaseInterfaceInputSpec,
     TraitedSpec,
     InputMultiPath,
+    OutputMultiPath,
+    isdefined,
+)
+
+from .image import (
+    load_image_data,
+    iter_voxel_chunks,
+    nonzero_timeseries_mask,
+    masked_timeseries_mean,
 )
 
 
@@ -49,12 +58,11 @@ class DiscardTP(BaseInterface):
 
     def _run_interface(self, runtime):
         dataimg = nib.load(self.inputs.in_file)
-        data = dataimg.get_data()
 
         n_discard = int(self.inputs.n_discard) - 1
 
-        new_data = data.copy()
-        new_data = new_data[:, :, :, n_discard:-1]
+        # Only the kept frames are read from the file
+        new_data = dataimg.dataobj[:, :, :, n_discard:-1]
 
         hd = dataimg.get_header()
         hd.set_data_shape(
@@ -75,6 +83,190 @@ class DiscardTP(BaseInterface):
         return outputs
 
 
+def _orthonormal_basis(X):
+    """Return an orthonormal basis of the column space of a design matrix.
+
+    SVD handles rank-deficient designs as the pseudo-inverse of `statsmodels` does.
+    """
+    u, s, _ = np.linalg.svd(X, full_matrices=False)
+    rank = np.sum(s > s.max() * max(X.shape) * np.finfo(np.float64).eps)
+    return u[:, :rank]
+
+
+def project_out_basis(data, basis, mask=None, chunk_size=10000, dtype=np.float64):
+    """Remove the projection on an orthonormal temporal basis from voxel time series.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        4D fMRI data array (X x Y x Z x T) or voxels x time matrix modified in place
+
+    basis : numpy.ndarray
+        Orthonormal basis of shape (T, n_components)
+
+    mask : numpy.ndarray
+        Boolean mask of the voxels to process (3D, or 1D for a matrix).
+        If `None`, all voxels with a non-zero time series are processed
+
+    chunk_size : int
+        Number of voxel time series processed at once
+
+    dtype : numpy.dtype
+        Floating point type used for the computation
+
+    Returns
+    -------
+    data : numpy.ndarray
+        The input data array containing the residuals in the masked voxels
+    """
+    if mask is None:
+        mask = nonzero_timeseries_mask(data)
+    basis = basis.astype(dtype)
+
+    for index in iter_voxel_chunks(mask, chunk_size):
+        Y = data[index].astype(dtype)
+        Y -= np.dot(np.dot(Y, basis), basis.T)
+        data[index] = Y
+
+    return data
+
+
+def regress_out_nuisance(data, regressors, mask=None, chunk_size=10000):
+    """Regress out nuisance covariates from all voxels at once through GLM.
+
+    The design matrix made of the regressors and a constant term is shared
+    by all voxels. An orthonormal basis of its column space is computed once
+    and the fitted signals are removed by projection, chunk by chunk, so that
+    the residuals are identical to the ones of an ordinary least-squares fit
+    of each voxel time series.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        4D fMRI data array (X x Y x Z x T) or voxels x time matrix modified in place
+
+    regressors : numpy.ndarray
+        Nuisance regressors of shape (T,) or (T, n_regressors)
+
+    mask : numpy.ndarray
+        Boolean mask of the voxels to process (3D, or 1D for a matrix).
+        If `None`, all voxels with a non-zero time series are processed,
+        the residuals of the other ones being zero anyway
+
+    chunk_size : int
+        Number of voxel time series processed at once
+
+    Returns
+    -------
+    data : numpy.ndarray
+        The input data array containing the residuals in the masked voxels
+    """
+    tp = data.shape[-1]
+    X = np.column_stack((np.ones(tp), np.asarray(regressors, dtype=np.float64).reshape(tp, -1)))
+    return project_out_basis(data, _orthonormal_basis(X), mask=mask, chunk_size=chunk_size)
+
+
+def compute_motion_regressors(move, nuisance_motion_nb_reg):
+    """Build the motion nuisance regressors from the motion parameters.
+
+    Parameters
+    ----------
+    move : numpy.ndarray
+        Motion parameters of shape (T, 6)
+
+    nuisance_motion_nb_reg : int
+        Number of motion regressors (6, 12, 24 or 36, 6 if undefined)
+
+    Returns
+    -------
+    move : numpy.ndarray
+        Demeaned motion regressors of shape (T, n_regressors)
+    """
+    nb_reg = str(nuisance_motion_nb_reg)
+    move = move - np.mean(move, 0)
+
+    # Update
+    move_der1 = np.concatenate((np.zeros([1, 6]), move[0:-1, :]), axis=0)
+    move_der2 = np.concatenate((np.zeros([2, 6]), move[0:-2, :]), axis=0)
+    move_sq = np.square(move)
+    move_der1_sq = np.square(move_der1)
+    move_der2_sq = np.square(move_der2)
+
+    move_der1 = move_der1 - np.mean(move_der1)
+    move_der2 = move_der2 - np.mean(move_der2)
+    move_der1_sq = move_der1_sq - np.mean(move_der1_sq)
+    move_der2_sq = move_der2_sq - np.mean(move_der2_sq)
+    move_sq = move_sq - np.mean(move_sq)
+
+    if nb_reg == "12" or nb_reg == "24" or nb_reg == "36":
+        move = np.hstack((move, move_sq))
+    if nb_reg == "24" or nb_reg == "36":
+        move = np.hstack((move, move_der1))
+        move = np.hstack((move, move_der1_sq))
+    if nb_reg == "36":
+        move = np.hstack((move, move_der2))
+        move = np.hstack((move, move_der2_sq))
+    return move
+
+
+def nuisance_design_matrix(tp, global_values=None, csf_values=None, wm_values=None, move=None):
+    """Stack the nuisance regressors in the order global, CSF, WM and motion.
+
+    Parameters
+    ----------
+    tp : int
+        Number of time points
+
+    global_values, csf_values, wm_values : numpy.ndarray
+        Average signals of shape (T,), omitted if `None`
+
+    move : numpy.ndarray
+        Motion regressors of shape (T, n_regressors), omitted if `None`
+
+    Returns
+    -------
+    X : numpy.ndarray
+        Nuisance regressors of shape (T, n_regressors)
+    """
+    columns = [
+        np.reshape(values, (tp, -1))
+        for values in [global_values, csf_values, wm_values, move]
+        if values is not None
+    ]
+    return np.hstack(columns)
+
+
+def trend_basis(n_timepoints, order=1, n_knots=0):
+    """Return an orthonormal basis of polynomial (and spline) trends.
+
+    Parameters
+    ----------
+    n_timepoints : int
+        Number of time points
+
+    order : int
+        Polynomial order (1: linear, 2: quadratic, 3: cubic)
+
+    n_knots : int
+        Number of equally spaced interior knots.
+        If larger than 0, truncated power functions of the given order are
+        added at each knot, such that the trend is modeled by a spline
+
+    Returns
+    -------
+    basis : numpy.ndarray
+        Orthonormal basis of shape (n_timepoints, n_components)
+    """
+    t = np.linspace(-1, 1, n_timepoints)
+    X = np.polynomial.legendre.legvander(t, order)
+    if n_knots > 0:
+        knots = np.linspace(-1, 1, n_knots + 2)[1:-1]
+        X = np.column_stack(
+            (X, np.maximum(t[:, np.newaxis] - knots[np.newaxis, :], 0) ** order)
+        )
+    return _orthonormal_basis(X)
+
+
 class NuisanceRegressionInputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, desc="Input fMRI volume")
 
@@ -104,6 +296,20 @@ class NuisanceRegressionInputSpec(BaseInterfaceInputSpec):
         desc="Number of volumes discarded from the fMRI sequence during preprocessing"
     )
 
+    regression_method = Enum(
+        "batched",
+        "statsmodels",
+        usedefault=True,
+        desc="Solve the GLM of all voxels at once by projection (`batched`) "
+        "or fit a `statsmodels` GLS model voxel by voxel (`statsmodels`, slow, for reference)",
+    )
+
+    chunk_size = Int(
+        10000,
+        usedefault=True,
+        desc="Number of voxel time series regressed at once in `batched` mode",
+    )
+
 
 class NuisanceRegressionOutputSpec(TraitedSpec):
     out_file = File(exists=True, desc="Output fMRI Volume")
@@ -156,13 +362,13 @@ class NuisanceRegression(BaseInterface):
         ref_path = self.inputs.in_file
 
         # Extract whole brain average signal
-        dataimg = nib.load(ref_path)
-        data = dataimg.get_data()
+        # from a float32 working copy which residuals are written to
+        dataimg, data = load_image_data(ref_path, writable=True)
         tp = data.shape[3]
         if self.inputs.global_nuisance:
             brainfile = self.inputs.brainfile  # load eroded whole brain mask
             brain = nib.load(brainfile).get_data().astype(np.uint32)
-            global_values = data[brain == 1].mean(axis=0)
+            global_values = masked_timeseries_mean(data, brain == 1)
             global_values = global_values - np.mean(global_values)
             np.save(os.path.abspath("averageGlobal.npy"), global_values)
             sio.savemat(
@@ -173,7 +379,7 @@ class NuisanceRegression(BaseInterface):
         if self.inputs.csf_nuisance:
             csffile = self.inputs.csf_file  # load eroded CSF mask
             csf = nib.load(csffile).get_data().astype(np.uint32)
-            csf_values = data[csf == 1].mean(axis=0)
+            csf_values = masked_timeseries_mean(data, csf == 1)
             csf_values = csf_values - np.mean(csf_values)
             np.save(os.path.abspath("averageCSF.npy"), csf_values)
             sio.savemat(os.path.abspath("averageCSF.mat"), {"avgCSF": csf_values})
@@ -182,126 +388,71 @@ class NuisanceRegression(BaseInterface):
         if self.inputs.wm_nuisance:
             WMfile = self.inputs.wm_file  # load eroded WM mask
             WM = nib.load(WMfile).get_data().astype(np.uint32)
-            wm_values = data[WM == 1].mean(axis=0)
+            wm_values = masked_timeseries_mean(data, WM == 1)
             wm_values = wm_values - np.mean(wm_values)
             np.save(os.path.abspath("averageWM.npy"), wm_values)
             sio.savemat(os.path.abspath("averageWM.mat"), {"avgWM": wm_values})
 
         # Import parameters from head motion estimation
         if self.inputs.motion_nuisance:
-            move = np.genfromtxt(self.inputs.motion_file)
-            move = move - np.mean(move, 0)
-
-            # Update
-            move_der1 = np.concatenate((np.zeros([1, 6]), move[0:-1, :]), axis=0)
-            move_der2 = np.concatenate((np.zeros([2, 6]), move[0:-2, :]), axis=0)
-            move_sq = np.square(move)
-            move_der1_sq = np.square(move_der1)
-            move_der2_sq = np.square(move_der2)
-
-            move_der1 = move_der1 - np.mean(move_der1)
-            move_der2 = move_der2 - np.mean(move_der2)
-            move_der1_sq = move_der1_sq - np.mean(move_der1_sq)
-            move_der2_sq = move_der2_sq - np.mean(move_der2_sq)
-            move_sq = move_sq - np.mean(move_sq)
-
-            if (
-                self.inputs.nuisance_motion_nb_reg == "12"
-                or self.inputs.nuisance_motion_nb_reg == "24"
-                or self.inputs.nuisance_motion_nb_reg == "36"
-            ):
-                move = np.hstack((move, move_sq))
-            if (
-                self.inputs.nuisance_motion_nb_reg == "24"
-                or self.inputs.nuisance_motion_nb_reg == "36"
-            ):
-                move = np.hstack((move, move_der1))
-                move = np.hstack((move, move_der1_sq))
-            if self.inputs.nuisance_motion_nb_reg == "36":
-                move = np.hstack((move, move_der2))
-                move = np.hstack((move, move_der2_sq))
+            move = compute_motion_regressors(
+                np.genfromtxt(self.inputs.motion_file), self.inputs.nuisance_motion_nb_reg
+            )
 
         # GLM: regress out nuisance covariates
-        new_data = data.copy()
 
         # s = gconf.parcellation.keys()[0]
 
-        gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
         # if float(self.inputs.n_discard) > 0:
         #     n_discard = int(self.inputs.n_discard) - 1
         #     if self.inputs.motion_nuisance:
         #         move = move[n_discard:-1,:]
 
         # build regressors matrix
-        if self.inputs.global_nuisance:
-            X = np.hstack(global_values.reshape(tp, 1))
-            print("> Detrend global average signal")
-            if self.inputs.csf_nuisance:
-                X = np.hstack((X.reshape(tp, 1), csf_values.reshape(tp, 1)))
-                print("... Detrend CSF average signal")
-                if self.inputs.wm_nuisance:
-                    X = np.hstack((X, wm_values.reshape(tp, 1)))
-                    print("... ... Detrend WM average signal")
-                    if self.inputs.motion_nuisance:
-                        print("... ... ... pre-Detrend motion average signals")
-                        X = np.hstack((X, move))
-                        print("... ... ... Detrend motion average signals")
-                elif self.inputs.motion_nuisance:
-                    X = np.hstack((X, move))
-                    print("... ... Detrend motion average signals")
-            elif self.inputs.wm_nuisance:
-                X = np.hstack((X.reshape(tp, 1), wm_values.reshape(tp, 1)))
-                print("... Detrend WM average signal")
-                if self.inputs.motion_nuisance:
-                    X = np.hstack((X, move))
-                    print("... ... Detrend motion average signals")
-            elif self.inputs.motion_nuisance:
-                X = np.hstack((X.reshape(tp, 1), move))
-                print("... Detrend motion average signals")
-        elif self.inputs.csf_nuisance:
-            X = np.hstack((csf_values.reshape(tp, 1)))
-            print("> Detrend CSF average signal")
-            if self.inputs.wm_nuisance:
-                X = np.hstack((X.reshape(tp, 1), wm_values.reshape(tp, 1)))
-                print("... Detrend WM average signal")
-                if self.inputs.motion_nuisance:
-                    X = np.hstack((X, move))
-                    print("... ... Detrend motion average signals")
-            elif self.inputs.motion_nuisance:
-                X = np.hstack((X.reshape(tp, 1), move))
-                print("... Detrend motion average signals")
-        elif self.inputs.wm_nuisance:
-            X = np.hstack((wm_values.reshape(tp, 1)))
-            print("> Detrend WM average signal")
-            if self.inputs.motion_nuisance:
-                print("... pre-Detrend motion average signals")
-                # print('... move shape :',move.shape)
-                # print('... X shape :',X.shape)
-                Y = X.reshape(tp, 1)
-                # print('... Y shape :',Y.shape)
-                X = np.hstack((Y, move))
-                print("... Detrend motion average signals")
-        elif self.inputs.motion_nuisance:
-            X = move
-            print("> Detrend motion average signals")
-
-        import statsmodels.api as sm
-
-        X = sm.add_constant(X)
-        # print('Shape X GLM')
-        # print(X.shape)
-
-        # loop throughout all GM voxels
-        for index, _ in np.ndenumerate(gm):
-            Y = data[index[0], index[1], index[2], :].reshape(tp, 1)
-            gls_model = sm.GLS(Y, X)
-            gls_results = gls_model.fit()
-            # new_data[index[0],index[1],index[2],:] = gls_results.resid
-            new_data[
-                index[0], index[1], index[2], :
-            ] = gls_results.resid  # + gls_results.params[8]
-
-        img = nib.Nifti1Image(new_data, dataimg.get_affine(), dataimg.get_header())
+        X = nuisance_design_matrix(
+            tp,
+            global_values=global_values if self.inputs.global_nuisance else None,
+            csf_values=csf_values if self.inputs.csf_nuisance else None,
+            wm_values=wm_values if self.inputs.wm_nuisance else None,
+            move=move if self.inputs.motion_nuisance else None,
+        )
+        for name, enabled in [
+            ("global", self.inputs.global_nuisance),
+            ("CSF", self.inputs.csf_nuisance),
+            ("WM", self.inputs.wm_nuisance),
+            ("motion", self.inputs.motion_nuisance),
+        ]:
+            if enabled:
+                print("> Detrend %s average signal" % name)
+
+        if self.inputs.regression_method == "statsmodels":
+            import statsmodels.api as sm
+
+            # Residuals of each voxel are written back in place once fitted
+            new_data = data
+            gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
+            X = sm.add_constant(X)
+            # print('Shape X GLM')
+            # print(X.shape)
+
+            # loop throughout all GM voxels
+            for index, _ in np.ndenumerate(gm):
+                Y = data[index[0], index[1], index[2], :].reshape(tp, 1)
+                gls_model = sm.GLS(Y, X)
+                gls_results = gls_model.fit()
+                # new_data[index[0],index[1],index[2],:] = gls_results.resid
+                new_data[
+                    index[0], index[1], index[2], :
+                ] = gls_results.resid  # + gls_results.params[8]
+        else:
+            # Residuals of all voxels are written back in place
+            new_data = regress_out_nuisance(
+                data, X, chunk_size=self.inputs.chunk_size
+            )
+
+        hdr = dataimg.header.copy()
+        hdr.set_data_dtype(np.float32)
+        img = nib.Nifti1Image(new_data, dataimg.affine, hdr)
         nib.save(img, os.path.abspath("fMRI_nuisance.nii.gz"))
 
         return runtime
@@ -330,6 +481,19 @@ class DetrendingInputSpec(BaseInterfaceInputSpec):
 
     mode = Enum(["linear", "quadratic", "cubic"], desc="Detrending order")
 
+    n_spline_knots = Int(
+        0,
+        usedefault=True,
+        desc="Number of equally spaced interior knots of a spline trend of the "
+        "detrending order (0: polynomial trend)",
+    )
+
+    chunk_size = Int(
+        10000,
+        usedefault=True,
+        desc="Number of voxel time series detrended at once",
+    )
+
 
 class DetrendingOutputSpec(TraitedSpec):
     out_file = File(exists=True, desc="Detrended fMRI volume")
@@ -358,78 +522,127 @@ class Detrending(BaseInterface):
     output_spec = DetrendingOutputSpec
 
     def _run_interface(self, runtime):
-        print("Linear detrending")
+        mode = self.inputs.mode if isdefined(self.inputs.mode) else "linear"
+        order = {"linear": 1, "quadratic": 2, "cubic": 3}[mode]
+        print("%s detrending" % mode.capitalize())
         print("=================")
 
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
 
-        # Load data
-        dataimg = nib.load(ref_path)
-        data = dataimg.get_data()
+        # Load data as a float32 working copy
+        dataimg, data = load_image_data(ref_path, writable=True)
         tp = data.shape[3]
 
-        # GLM: regress out nuisance covariates
-        new_data_det = data.copy()
-        gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
+        gm = nib.load(self.inputs.gm_file[0]).get_data() != 0
 
-        from scipy import signal
+        # Remove the trends of all GM voxels at once, detrended signals being written in place
+        basis = trend_basis(tp, order=order, n_knots=self.inputs.n_spline_knots)
+        new_data_det = project_out_basis(
+            data, basis, mask=gm, chunk_size=self.inputs.chunk_size, dtype=np.float32
+        )
 
-        for index, value in np.ndenumerate(gm):
-            if value == 0:
-                continue
+        hdr = dataimg.header.copy()
+        hdr.set_data_dtype(np.float32)
+        img = nib.Nifti1Image(new_data_det, dataimg.affine, hdr)
+        nib.save(img, os.path.abspath("fMRI_detrending.nii.gz"))
 
-            Ydet = signal.detrend(
-                data[index[0], index[1], index[2], :].reshape(tp, 1), axis=0
-            )
-            new_data_det[index[0], index[1], index[2], :] = Ydet[:, 0]
+        print("[ DONE ]")
+        return runtime
 
-        img = nib.Nifti1Image(new_data_det, dataimg.get_affine(), dataimg.get_header())
-        nib.save(img, os.path.abspath("fMRI_detrending.nii.gz"))
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["out_file"] = os.path.abspath("fMRI_detrending.nii.gz")
+        return outputs
 
-        if self.inputs.mode == "quadratic":
-            print("Quadratic detrending")
-            print("=================")
-            from obspy.signal.detrend import polynomial
 
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = polynomial(
-                    new_data_det2[index[0], index[1], index[2], :], order=2
-                )
+def compute_fd(motion, head_radius=50.0):
+    """Compute the framewise displacement (FD) from a table of motion parameters.
 
-            img = nib.Nifti1Image(
-                new_data_det2, dataimg.get_affine(), dataimg.get_header()
-            )
-            nib.save(img, os.path.abspath("fMRI_detrending.nii.gz"))
+    The FD is the sum of the absolute frame-to-frame changes of the
+    6 rigid-body parameters, the rotations being converted to displacements
+    in mm on a sphere of radius `head_radius` (Power et al., 2012).
 
-        if self.inputs.mode == "cubic":
-            print("Cubic-spline detrending")
-            print("=================")
-            from obspy.signal.detrend import spline
+    Parameters
+    ----------
+    motion : numpy.ndarray
+        Motion parameters of shape (T, 6) as estimated by FSL MCFLIRT,
+        i.e. 3 rotations in radians followed by 3 translations in mm
 
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = spline(new_data_det2[index[0], index[1], index[2], :], order=3)
+    head_radius : float
+        Radius of the sphere in mm used to convert the rotations
 
-            img = nib.Nifti1Image(
-                new_data_det2, dataimg.get_affine(), dataimg.get_header()
-            )
-            nib.save(img, os.path.abspath("fMRI_detrending.nii.gz"))
+    Returns
+    -------
+    fd : numpy.ndarray
+        FD of shape (T - 1,) where the i-th value is the displacement
+        between frames i and i + 1
+    """
+    dmove = np.absolute(np.diff(np.asarray(motion, dtype=np.float64), axis=0))
+    return head_radius * dmove[:, :3].sum(axis=1) + dmove[:, 3:6].sum(axis=1)
 
-        print("[ DONE ]")
-        return runtime
 
-    def _list_outputs(self):
-        outputs = self._outputs().get()
-        outputs["out_file"] = os.path.abspath("fMRI_detrending.nii.gz")
-        return outputs
+def compute_dvars(data, mask, chunk_size=10000, n_voxels=None):
+    """Compute the DVARS and standardized DVARS of a 4D fMRI image.
+
+    The masked voxels are processed by chunks of time series in float64,
+    such that the 4D image is never duplicated in memory. The standardized
+    DVARS is the DVARS divided by its expected value under temporal
+    stationarity, estimated per voxel from a robust standard deviation
+    and the lag-1 autocorrelation (Nichols, 2017).
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        4D fMRI data array (X x Y x Z x T) or voxels x time matrix
+
+    mask : numpy.ndarray
+        Boolean mask of the voxels to consider (3D, or 1D for a matrix)
+
+    chunk_size : int
+        Number of voxel time series processed at once
+
+    n_voxels : int
+        Number of voxels to average over, if larger than the number of
+        voxels in `mask` (voxels with zero time series left out of a matrix)
+
+    Returns
+    -------
+    dvars : numpy.ndarray
+        DVARS of shape (T - 1,) where the i-th value is the RMS signal
+        change between frames i and i + 1
+
+    std_dvars : numpy.ndarray
+        Standardized DVARS of shape (T - 1,)
+    """
+    tp = data.shape[-1]
+    n_masked = int(np.count_nonzero(mask))
+    if n_voxels is None:
+        n_voxels = n_masked
+    if n_voxels == 0:
+        raise ValueError("No voxel in mask to compute the DVARS")
+
+    sum_sq_diff = np.zeros(tp - 1)
+    sum_diff_sd = 0.0
+    for index in iter_voxel_chunks(mask, chunk_size):
+        Y = data[index].astype(np.float64)
+        sum_sq_diff += np.square(np.diff(Y, axis=1)).sum(axis=0)
+
+        # Expected standard deviation of the temporal difference of each voxel
+        q25, q75 = np.percentile(Y, [25, 75], axis=1)
+        robust_sd = (q75 - q25) / 1.349
+        Y -= Y.mean(axis=1)[:, np.newaxis]
+        var = np.square(Y).sum(axis=1)
+        ar1 = np.divide(
+            (Y[:, 1:] * Y[:, :-1]).sum(axis=1), var,
+            out=np.zeros_like(var), where=var > 0
+        )
+        sum_diff_sd += (np.sqrt(2 * np.clip(1 - ar1, 0, None)) * robust_sd).sum()
+
+    dvars = np.sqrt(sum_sq_diff / n_voxels)
+    diff_sd_mean = sum_diff_sd / n_voxels
+    std_dvars = dvars / diff_sd_mean if diff_sd_mean > 0 else np.zeros_like(dvars)
+    return dvars, std_dvars
 
 
 class ScrubbingInputSpec(BaseInterfaceInputSpec):
@@ -445,6 +658,18 @@ class ScrubbingInputSpec(BaseInterfaceInputSpec):
         exists=True, desc="Motion parameters from preprocessing stage"
     )
 
+    head_radius = Float(
+        50.0,
+        usedefault=True,
+        desc="Head radius in mm used to convert rotations to displacements in FD",
+    )
+
+    chunk_size = Int(
+        10000,
+        usedefault=True,
+        desc="Number of voxel time series processed at once to compute DVARS",
+    )
+
 
 class ScrubbingOutputSpec(TraitedSpec):
     fd_mat = File(exists=True, desc="FD matrix for scrubbing")
@@ -455,6 +680,10 @@ class ScrubbingOutputSpec(TraitedSpec):
 
     dvars_npy = File(exists=True, desc="DVARS in .npy format")
 
+    std_dvars_mat = File(exists=True, desc="Standardized DVARS matrix")
+
+    std_dvars_npy = File(exists=True, desc="Standardized DVARS in .npy format")
+
 
 class Scrubbing(BaseInterface):
     """Computes scrubbing parameters: `FD` and `DVARS`.
@@ -488,43 +717,25 @@ class Scrubbing(BaseInterface):
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
 
-        dataimg = nib.load(ref_path)
-        data = dataimg.get_data()
-        tp = data.shape[3]
+        _, data = load_image_data(ref_path)
         WMfile = self.inputs.wm_mask
         WM = nib.load(WMfile).get_data().astype(np.uint32)
         GM = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
-        mask = WM + GM
+        mask = (WM + GM) > 0
         move = np.genfromtxt(self.inputs.motion_parameters)
 
-        # initialize motion measures
-        FD = np.zeros((tp - 1, 1))
-        DVARS = np.zeros((tp - 1, 1))
-
-        # loop throughout all the time points
-        FD[0] = 0
-        DVARS[0] = 0
-        for i in range(1, tp - 1):
-            # FD
-            move0 = move[i - 1, :]
-            move1 = move[i, :]
-            this_move = move1 - move0
-            this_move = np.absolute(this_move)
-            FD[i] = this_move.sum()
-
-            # DVARS
-            # extract current and following time points
-            temp0 = data[:, :, :, i - 1]
-            temp1 = data[:, :, :, i]
-            temp = temp1 - temp0
-            temp = np.power(temp, 2)
-            temp = temp[mask > 0]
-            DVARS[i] = np.power(temp.mean(), 0.5)
+        # Frame-to-frame motion measures, stored as column vectors
+        FD = compute_fd(move, head_radius=self.inputs.head_radius).reshape(-1, 1)
+        DVARS, std_DVARS = compute_dvars(data, mask, chunk_size=self.inputs.chunk_size)
+        DVARS = DVARS.reshape(-1, 1)
+        std_DVARS = std_DVARS.reshape(-1, 1)
 
         np.save(os.path.abspath("FD.npy"), FD)
         np.save(os.path.abspath("DVARS.npy"), DVARS)
         sio.savemat(os.path.abspath("FD.mat"), {"FD": FD})
         sio.savemat(os.path.abspath("DVARS.mat"), {"DVARS": DVARS})
+        np.save(os.path.abspath("DVARS_std.npy"), std_DVARS)
+        sio.savemat(os.path.abspath("DVARS_std.mat"), {"DVARS_std": std_DVARS})
 
         print("[ DONE ]")
         return runtime
@@ -535,4 +746,484 @@ class Scrubbing(BaseInterface):
         outputs["dvars_mat"] = os.path.abspath("DVARS.mat")
         outputs["fd_npy"] = os.path.abspath("FD.npy")
         outputs["dvars_npy"] = os.path.abspath("DVARS.npy")
+        outputs["std_dvars_mat"] = os.path.abspath("DVARS_std.mat")
+        outputs["std_dvars_npy"] = os.path.abspath("DVARS_std.npy")
+        return outputs
+
+
+def bandpass_filter_data(
+    data, tr, highpass=0.0, lowpass=0.0, mask=None, method="fft", filter_order=4, chunk_size=10000
+):
+    """Bandpass filter the voxel time series of a 4D fMRI image in place.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        4D fMRI data array (X x Y x Z x T) or voxels x time matrix of floating point type, modified in place
+
+    tr : float
+        Repetition time in seconds
+
+    highpass : float
+        Cutoff frequency in Hz of the high-pass filter, i.e. lower bound of the
+        passband (frequencies below are removed). Disabled if not positive
+
+    lowpass : float
+        Cutoff frequency in Hz of the low-pass filter, i.e. upper bound of the
+        passband (frequencies above are removed). Disabled if not positive
+
+    mask : numpy.ndarray
+        Boolean mask of the voxels to filter (3D, or 1D for a matrix).
+        If `None`, all voxels with a non-zero time series are filtered
+
+    method : "fft" or "butterworth"
+        Ideal filter applied in the frequency domain (`fft`) or zero-phase
+        Butterworth filter applied forward and backward (`butterworth`)
+
+    filter_order : int
+        Order of the Butterworth filter
+
+    chunk_size : int
+        Number of voxel time series filtered at once
+
+    Returns
+    -------
+    data : numpy.ndarray
+        The input data array containing the filtered time series in the masked voxels
+    """
+    tp = data.shape[-1]
+    nyquist = 0.5 / tr
+    use_highpass = 0 < highpass < nyquist
+    use_lowpass = 0 < lowpass < nyquist
+    if use_highpass and use_lowpass and highpass >= lowpass:
+        raise ValueError(
+            "High-pass cutoff (%g Hz) must be lower than the low-pass cutoff (%g Hz)"
+            % (highpass, lowpass)
+        )
+    if not (use_highpass or use_lowpass):
+        return data
+
+    if method == "fft":
+        freqs = np.fft.rfftfreq(tp, d=tr)
+        keep = np.ones(len(freqs), dtype=bool)
+        if use_highpass:
+            keep &= freqs >= highpass
+        if use_lowpass:
+            keep &= freqs <= lowpass
+    else:
+        from scipy import signal
+
+        if use_highpass and use_lowpass:
+            sos = signal.butter(
+                filter_order, [highpass, lowpass], btype="bandpass", fs=1.0 / tr, output="sos"
+            )
+        elif use_highpass:
+            sos = signal.butter(filter_order, highpass, btype="highpass", fs=1.0 / tr, output="sos")
+        else:
+            sos = signal.butter(filter_order, lowpass, btype="lowpass", fs=1.0 / tr, output="sos")
+
+    if mask is None:
+        mask = nonzero_timeseries_mask(data)
+
+    for index in iter_voxel_chunks(mask, chunk_size):
+        Y = data[index]
+        if method == "fft":
+            Yf = np.fft.rfft(Y, axis=1)
+            Yf[:, ~keep] = 0
+            data[index] = np.fft.irfft(Yf, n=tp, axis=1)
+        else:
+            data[index] = signal.sosfiltfilt(sos, Y, axis=1)
+
+    return data
+
+
+class BandpassFilterInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="fMRI volume to filter")
+
+    mask_file = File(
+        exists=True,
+        desc="Mask of the voxels to filter (Default: voxels with non-zero time series)",
+    )
+
+    highpass = Float(
+        0.0,
+        usedefault=True,
+        desc="High-pass cutoff frequency in Hz, i.e. lower bound of the passband "
+        "(frequencies below are removed, disabled if 0)",
+    )
+
+    lowpass = Float(
+        0.0,
+        usedefault=True,
+        desc="Low-pass cutoff frequency in Hz, i.e. upper bound of the passband "
+        "(frequencies above are removed, disabled if 0)",
+    )
+
+    tr = Float(desc="Repetition time in seconds (Default: read from the image header)")
+
+    method = Enum(
+        "fft",
+        "butterworth",
+        usedefault=True,
+        desc="Ideal FFT filter (`fft`) or zero-phase Butterworth filter (`butterworth`)",
+    )
+
+    filter_order = Int(4, usedefault=True, desc="Order of the Butterworth filter")
+
+    chunk_size = Int(
+        10000, usedefault=True, desc="Number of voxel time series filtered at once"
+    )
+
+    out_file = File("fMRI_bandpass.nii.gz", usedefault=True, desc="Output filename")
+
+
+class BandpassFilterOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="Bandpass filtered fMRI volume")
+
+
+class BandpassFilter(BaseInterface):
+    """Bandpass filter the voxel time series of the Functional MRI signal.
+
+    Examples
+    --------
+    >>> from cmtklib.functionalMRI import BandpassFilter
+    >>> bandpass = BandpassFilter()
+    >>> bandpass.inputs.base_dir = '/my_directory'
+    >>> bandpass.inputs.in_file = '/path/to/sub-01_task-rest_desc-preproc_bold.nii.gz'
+    >>> bandpass.inputs.highpass = 0.01
+    >>> bandpass.inputs.lowpass = 0.1
+    >>> bandpass.run()  # doctest: +SKIP
+
+    """
+
+    input_spec = BandpassFilterInputSpec
+    output_spec = BandpassFilterOutputSpec
+
+    def _run_interface(self, runtime):
+        print("Bandpass filtering")
+        print("==================")
+
+        dataimg, data = load_image_data(self.inputs.in_file, writable=True)
+
+        if isdefined(self.inputs.tr):
+            tr = self.inputs.tr
+        else:
+            tr = float(dataimg.header.get_zooms()[3])
+            if dataimg.header.get_xyzt_units()[1] == "msec":
+                tr /= 1000.0
+        print("  .. TR: %g s, passband: [%g, %g] Hz" % (tr, self.inputs.highpass, self.inputs.lowpass))
+
+        mask = None
+        if isdefined(self.inputs.mask_file):
+            mask = nib.load(self.inputs.mask_file).get_data() > 0
+
+        data = bandpass_filter_data(
+            data,
+            tr,
+            highpass=self.inputs.highpass,
+            lowpass=self.inputs.lowpass,
+            mask=mask,
+            method=self.inputs.method,
+            filter_order=self.inputs.filter_order,
+            chunk_size=self.inputs.chunk_size,
+        )
+
+        hdr = dataimg.header.copy()
+        hdr.set_data_dtype(np.float32)
+        img = nib.Nifti1Image(data, dataimg.affine, hdr)
+        nib.save(img, os.path.abspath(self.inputs.out_file))
+
+        print("[ DONE ]")
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["out_file"] = os.path.abspath(self.inputs.out_file)
+        return outputs
+
+
+class FunctionalPostprocessingInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="Input 4D fMRI image")
+
+    gm_file = InputMultiPath(File(exists=True), desc="GM atlas files registered to fMRI space")
+
+    brainfile = File(desc="Eroded brain mask registered to fMRI space")
+
+    csf_file = File(desc="Eroded CSF mask registered to fMRI space")
+
+    wm_file = File(desc="WM mask registered to fMRI space")
+
+    motion_file = File(desc="Motion parameters from preprocessing stage")
+
+    detrending = Bool(False, usedefault=True, desc="If `True` perform detrending")
+
+    detrending_mode = Enum("linear", "quadratic", "cubic", usedefault=True, desc="Detrending order")
+
+    global_nuisance = Bool(False, usedefault=True, desc="If `True` perform global nuisance regression")
+
+    csf_nuisance = Bool(False, usedefault=True, desc="If `True` perform CSF nuisance regression")
+
+    wm_nuisance = Bool(False, usedefault=True, desc="If `True` perform WM nuisance regression")
+
+    motion_nuisance = Bool(False, usedefault=True, desc="If `True` perform motion nuisance regression")
+
+    nuisance_motion_nb_reg = Int(desc="Number of reg to use in motion nuisance regression")
+
+    highpass = Float(
+        0.0,
+        usedefault=True,
+        desc="High-pass cutoff frequency in Hz, i.e. lower bound of the passband (disabled if 0)",
+    )
+
+    lowpass = Float(
+        0.0,
+        usedefault=True,
+        desc="Low-pass cutoff frequency in Hz, i.e. upper bound of the passband (disabled if 0)",
+    )
+
+    tr = Float(desc="Repetition time in seconds (Default: read from the image header)")
+
+    filter_method = Enum("fft", "butterworth", usedefault=True, desc="Bandpass filter type")
+
+    scrubbing = Bool(False, usedefault=True, desc="If `True` compute FD and DVARS for scrubbing")
+
+    head_radius = Float(
+        50.0,
+        usedefault=True,
+        desc="Head radius in mm used to convert rotations to displacements in FD",
+    )
+
+    save_intermediate = Bool(
+        False,
+        usedefault=True,
+        desc="Save the image after each step for quality control",
+    )
+
+    chunk_size = Int(10000, usedefault=True, desc="Number of voxel time series processed at once")
+
+
+class FunctionalPostprocessingOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="Output fMRI volume after the last step")
+
+    intermediate_files = OutputMultiPath(
+        File(exists=True), desc="Output fMRI volumes of the intermediate steps"
+    )
+
+    averageGlobal_npy = File(desc="Output of global regression in `.npy` format")
+
+    averageCSF_npy = File(desc="Output of CSF regression in `.npy` format")
+
+    averageWM_npy = File(desc="Output of WM regression in `.npy` format")
+
+    averageGlobal_mat = File(desc="Output matrix of global regression")
+
+    averageCSF_mat = File(desc="Output matrix of CSF regression")
+
+    averageWM_mat = File(desc="Output matrix of WM regression")
+
+    fd_mat = File(desc="FD matrix for scrubbing")
+
+    dvars_mat = File(desc="DVARS matrix for scrubbing")
+
+    fd_npy = File(desc="FD in .npy format")
+
+    dvars_npy = File(desc="DVARS in .npy format")
+
+    std_dvars_mat = File(desc="Standardized DVARS matrix")
+
+    std_dvars_npy = File(desc="Standardized DVARS in .npy format")
+
+
+class FunctionalPostprocessing(BaseInterface):
+    """Apply detrending, nuisance regression and bandpass filtering in memory and compute scrubbing parameters.
+
+    The time series of the voxels with non-zero signal are loaded once as a
+    float32 voxels x time matrix and the enabled steps are applied in the order of
+    the :class:`~cmp.stages.functional.functionalMRI.FunctionalMRIStage`, producing
+    the same results as the `Scrubbing`, `Detrending`, `NuisanceRegression` and
+    `BandpassFilter` interfaces. Only the image after the last step is written,
+    with the name of the corresponding interface output, unless intermediate
+    images are requested.
+
+    Examples
+    --------
+    >>> from cmtklib.functionalMRI import FunctionalPostprocessing
+    >>> postproc = FunctionalPostprocessing()
+    >>> postproc.inputs.base_dir = '/my_directory'
+    >>> postproc.inputs.in_file = '/path/to/sub-01_task-rest_desc-preproc_bold.nii.gz'
+    >>> postproc.inputs.gm_file = ['/path/to/sub-01_space-meanBOLD_atlas-L2018_desc-scale1_dseg.nii.gz']
+    >>> postproc.inputs.wm_file = '/path/to/sub-01_space-meanBOLD_label-WM_dseg.nii.gz'
+    >>> postproc.inputs.csf_file = '/path/to/sub-01_space-meanBOLD_desc-eroded_label-CSF_dseg.nii.gz'
+    >>> postproc.inputs.motion_file = '/path/to/sub-01_motions.par'
+    >>> postproc.inputs.detrending = True
+    >>> postproc.inputs.csf_nuisance = True
+    >>> postproc.inputs.wm_nuisance = True
+    >>> postproc.inputs.motion_nuisance = True
+    >>> postproc.inputs.highpass = 0.01
+    >>> postproc.inputs.lowpass = 0.1
+    >>> postproc.inputs.scrubbing = True
+    >>> postproc.run()  # doctest: +SKIP
+
+    """
+
+    input_spec = FunctionalPostprocessingInputSpec
+    output_spec = FunctionalPostprocessingOutputSpec
+
+    def _filter_enabled(self):
+        return self.inputs.highpass > 0 or self.inputs.lowpass > 0
+
+    def _nuisance_enabled(self):
+        return (
+            self.inputs.global_nuisance
+            or self.inputs.csf_nuisance
+            or self.inputs.wm_nuisance
+            or self.inputs.motion_nuisance
+        )
+
+    def _output_filename(self):
+        if self._filter_enabled():
+            return "fMRI_bandpass.nii.gz"
+        if self._nuisance_enabled():
+            return "fMRI_nuisance.nii.gz"
+        if self.inputs.detrending:
+            return "fMRI_detrending.nii.gz"
+        return "fMRI_postprocessed.nii.gz"
+
+    def _run_interface(self, runtime):
+        print("Functional MRI post-processing")
+        print("==============================")
+
+        dataimg, data = load_image_data(self.inputs.in_file)
+        shape = data.shape
+        tp = shape[3]
+
+        # Voxels x time matrix of the voxels with non-zero time series
+        voxels = np.nonzero(nonzero_timeseries_mask(data))
+        ts = np.ascontiguousarray(data[voxels])
+        del data
+        print("  .. %d voxels x %d time points" % ts.shape)
+
+        def _load_mask(fname, mask_fn):
+            """Return the mask of the matrix rows and the total number of voxels in the mask."""
+            mask = mask_fn(nib.load(fname).get_data())
+            return mask[voxels], int(mask.sum())
+
+        def _save_image(fname):
+            volume = np.zeros(shape, dtype=np.float32)
+            volume[voxels] = ts
+            hdr = dataimg.header.copy()
+            hdr.set_data_dtype(np.float32)
+            nib.save(nib.Nifti1Image(volume, dataimg.affine, hdr), os.path.abspath(fname))
+
+        if self.inputs.scrubbing and isdefined(self.inputs.motion_file):
+            print("> Compute FD and DVARS for scrubbing")
+            wm = nib.load(self.inputs.wm_file).get_data().astype(np.uint32)
+            gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
+            mask = (wm + gm) > 0
+            FD = compute_fd(
+                np.genfromtxt(self.inputs.motion_file), head_radius=self.inputs.head_radius
+            ).reshape(-1, 1)
+            DVARS, std_DVARS = compute_dvars(
+                ts, mask[voxels], chunk_size=self.inputs.chunk_size, n_voxels=int(mask.sum())
+            )
+            DVARS = DVARS.reshape(-1, 1)
+            std_DVARS = std_DVARS.reshape(-1, 1)
+            np.save(os.path.abspath("FD.npy"), FD)
+            np.save(os.path.abspath("DVARS.npy"), DVARS)
+            sio.savemat(os.path.abspath("FD.mat"), {"FD": FD})
+            sio.savemat(os.path.abspath("DVARS.mat"), {"DVARS": DVARS})
+            np.save(os.path.abspath("DVARS_std.npy"), std_DVARS)
+            sio.savemat(os.path.abspath("DVARS_std.mat"), {"DVARS_std": std_DVARS})
+
+        if self.inputs.detrending:
+            print("> %s detrending" % self.inputs.detrending_mode.capitalize())
+            order = {"linear": 1, "quadratic": 2, "cubic": 3}[self.inputs.detrending_mode]
+            gm, _ = _load_mask(self.inputs.gm_file[0], lambda d: d != 0)
+            project_out_basis(
+                ts,
+                trend_basis(tp, order=order),
+                mask=gm,
+                chunk_size=self.inputs.chunk_size,
+                dtype=np.float32,
+            )
+            if self.inputs.save_intermediate and self._output_filename() != "fMRI_detrending.nii.gz":
+                _save_image("fMRI_detrending.nii.gz")
+
+        if self._nuisance_enabled():
+            regressors = {}
+            for name, enabled, fname, key in [
+                ("Global", self.inputs.global_nuisance, self.inputs.brainfile, "global_values"),
+                ("CSF", self.inputs.csf_nuisance, self.inputs.csf_file, "csf_values"),
+                ("WM", self.inputs.wm_nuisance, self.inputs.wm_file, "wm_values"),
+            ]:
+                if not enabled:
+                    continue
+                print("> Detrend %s average signal" % name)
+                # Voxels with zero time series count in the average
+                mask, n_mask = _load_mask(fname, lambda d: d.astype(np.uint32) == 1)
+                values = ts[mask].sum(axis=0, dtype=np.float64) / n_mask
+                values = values - np.mean(values)
+                np.save(os.path.abspath("average%s.npy" % name), values)
+                sio.savemat(os.path.abspath("average%s.mat" % name), {"avg%s" % name: values})
+                regressors[key] = values
+            if self.inputs.motion_nuisance:
+                print("> Detrend motion average signals")
+                regressors["move"] = compute_motion_regressors(
+                    np.genfromtxt(self.inputs.motion_file), self.inputs.nuisance_motion_nb_reg
+                )
+            regress_out_nuisance(
+                ts, nuisance_design_matrix(tp, **regressors), chunk_size=self.inputs.chunk_size
+            )
+            if self.inputs.save_intermediate and self._output_filename() != "fMRI_nuisance.nii.gz":
+                _save_image("fMRI_nuisance.nii.gz")
+
+        if self._filter_enabled():
+            if isdefined(self.inputs.tr):
+                tr = self.inputs.tr
+            else:
+                tr = float(dataimg.header.get_zooms()[3])
+                if dataimg.header.get_xyzt_units()[1] == "msec":
+                    tr /= 1000.0
+            print(
+                "> Bandpass filtering (TR: %g s, passband: [%g, %g] Hz)"
+                % (tr, self.inputs.highpass, self.inputs.lowpass)
+            )
+            bandpass_filter_data(
+                ts,
+                tr,
+                highpass=self.inputs.highpass,
+                lowpass=self.inputs.lowpass,
+                method=self.inputs.filter_method,
+                chunk_size=self.inputs.chunk_size,
+            )
+
+        _save_image(self._output_filename())
+
+        print("[ DONE ]")
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs["out_file"] = os.path.abspath(self._output_filename())
+        if self.inputs.save_intermediate:
+            outputs["intermediate_files"] = [
+                os.path.abspath(fname)
+                for fname in ["fMRI_detrending.nii.gz", "fMRI_nuisance.nii.gz"]
+                if os.path.exists(os.path.abspath(fname)) and fname != self._output_filename()
+            ]
+        for name, enabled in [
+            ("Global", self.inputs.global_nuisance),
+            ("CSF", self.inputs.csf_nuisance),
+            ("WM", self.inputs.wm_nuisance),
+        ]:
+            if enabled:
+                outputs["average%s_npy" % name] = os.path.abspath("average%s.npy" % name)
+                outputs["average%s_mat" % name] = os.path.abspath("average%s.mat" % name)
+        if self.inputs.scrubbing and isdefined(self.inputs.motion_file):
+            outputs["fd_mat"] = os.path.abspath("FD.mat")
+            outputs["dvars_mat"] = os.path.abspath("DVARS.mat")
+            outputs["fd_npy"] = os.path.abspath("FD.npy")
+            outputs["dvars_npy"] = os.path.abspath("DVARS.npy")
+            outputs["std_dvars_mat"] = os.path.abspath("DVARS_std.mat")
+            outputs["std_dvars_npy"] = os.path.abspath("DVARS_std.npy")
         return outputs
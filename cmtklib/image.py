@@ -0,0 +1,186 @@
+# Copyright (C) 2009-2022, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland, and CMP3 contributors
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Module that provides memory-lean access to the data of large 4D images (BOLD, DWI)."""
+
+import os
+import tempfile
+
+import numpy as np
+import nibabel as nib
+
+
+def _is_memory_mappable(fname, dataobj, dtype):
+    """Return `True` if the array of an image file can be memory-mapped as is."""
+    if str(fname).endswith(".gz") or not nib.is_proxy(dataobj):
+        return False
+    slope = getattr(dataobj, "slope", 1.0)
+    inter = getattr(dataobj, "inter", 0.0)
+    unscaled = (slope is None or slope == 1.0) and (inter is None or inter == 0.0)
+    return unscaled and dataobj.dtype == np.dtype(dtype)
+
+
+def load_image_data(fname, dtype=np.float32, writable=False, working_dir=None):
+    """Load an image with its data array memory-mapped in a given floating point type.
+
+    If the file is uncompressed, unscaled and already stored in `dtype`, the
+    data array is a read-only memory map of the file itself. Otherwise, the
+    data is copied volume by volume (`dataobj` slicing) into an uncompressed
+    working copy memory-mapped from `working_dir`, such that the image is never
+    loaded as a whole in memory, nor upcast to float64. The working copy is
+    unlinked as soon as it is mapped, and its disk space is released when the
+    array is deleted. The same is done with `writable=True` so that the data can
+    be modified in place without altering the input file.
+
+    Parameters
+    ----------
+    fname : string
+        Path to the image file
+
+    dtype : numpy.dtype
+        Floating point type of the returned data array (Default: float32)
+
+    writable : bool
+        If `True`, the data array can be modified in place
+
+    working_dir : string
+        Directory where the working copy is created
+        (Default: current working directory)
+
+    Returns
+    -------
+    img : nibabel.spatialimages.SpatialImage
+        Loaded image, the header and affine of which can be used to save outputs
+
+    data : numpy.memmap
+        Memory-mapped data array of type `dtype` in Fortran order
+    """
+    img = nib.load(fname, mmap="r", keep_file_open=True)
+    if not writable and _is_memory_mappable(fname, img.dataobj, dtype):
+        return img, np.asanyarray(img.dataobj)
+
+    if working_dir is None:
+        working_dir = os.getcwd()
+    fd, working_file = tempfile.mkstemp(suffix=".dat", prefix="working_", dir=working_dir)
+    os.close(fd)
+    try:
+        data = np.memmap(working_file, dtype=dtype, mode="w+", shape=img.shape, order="F")
+    finally:
+        os.remove(working_file)
+
+    # Volumes (or slices for 3D images) are contiguous on disk, such that
+    # the compressed stream is read sequentially
+    for index, _ in iter_spatial_chunks(img.shape, axis=len(img.shape) - 1, chunk_size=1):
+        data[index] = img.dataobj[index]
+    return img, data
+
+
+def iter_spatial_chunks(shape, axis=2, chunk_size=8):
+    """Iterate over the chunks of consecutive slices of an image along an axis.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the image data array
+
+    axis : int
+        Axis along which the image is split (Default: 2, i.e. axial slices)
+
+    chunk_size : int
+        Number of slices per chunk
+
+    Yields
+    ------
+    index : tuple of slice
+        Index of the chunk in the data array
+
+    bounds : tuple of int
+        First and last (excluded) slice of the chunk along `axis`
+    """
+    for start in range(0, shape[axis], chunk_size):
+        stop = min(start + chunk_size, shape[axis])
+        index = [slice(None)] * len(shape)
+        index[axis] = slice(start, stop)
+        yield tuple(index), (start, stop)
+
+
+def iter_voxel_chunks(mask, chunk_size=10000):
+    """Iterate over the voxel coordinates of a mask by chunks.
+
+    Voxel coordinates are used for indexing instead of a reshape, as NIfTI
+    data arrays are Fortran-ordered memory maps that a reshape would copy.
+
+    Parameters
+    ----------
+    mask : numpy.ndarray
+        Boolean mask of the voxels (3D, or 1D for a voxels x time matrix)
+
+    chunk_size : int
+        Number of voxels per chunk
+
+    Yields
+    ------
+    index : tuple of numpy.ndarray
+        Coordinates of the voxels of the chunk, that index their time series
+        in a 4D data array (or rows of a matrix)
+    """
+    voxels = np.nonzero(mask)
+    for start in range(0, len(voxels[0]), chunk_size):
+        yield tuple(v[start:start + chunk_size] for v in voxels)
+
+
+def nonzero_timeseries_mask(data, chunk_size=8):
+    """Return the mask of the voxels with a non-zero time series.
+
+    A 4D data array is processed by chunks of slices, such that the
+    boolean array of its non-zero values is never created as a whole.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        4D data array (X x Y x Z x T) or voxels x time matrix
+
+    chunk_size : int
+        Number of axial slices processed at once
+
+    Returns
+    -------
+    mask : numpy.ndarray
+        Boolean mask (3D, or 1D for a matrix)
+    """
+    if data.ndim != 4:
+        return np.any(data != 0, axis=-1)
+    mask = np.zeros(data.shape[:3], dtype=bool)
+    for index, _ in iter_spatial_chunks(data.shape, axis=2, chunk_size=chunk_size):
+        mask[index[:3]] = np.any(data[index] != 0, axis=3)
+    return mask
+
+
+def masked_timeseries_mean(data, mask, chunk_size=10000):
+    """Return the average time series of the voxels of a mask.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        4D data array (X x Y x Z x T) or voxels x time matrix
+
+    mask : numpy.ndarray
+        Boolean mask of the voxels to average (3D, or 1D for a matrix)
+
+    chunk_size : int
+        Number of voxel time series summed at once
+
+    Returns
+    -------
+    mean : numpy.ndarray
+        Average time series in float64
+    """
+    total = np.zeros(data.shape[-1])
+    n_voxels = 0
+    for index in iter_voxel_chunks(mask, chunk_size):
+        total += data[index].sum(axis=0, dtype=np.float64)
+        n_voxels += len(index[0])
+    return total / n_voxels if n_voxels > 0 else total * np.nan
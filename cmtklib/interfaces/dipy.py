@@ -17,6 +17,8 @@ from nipype.interfaces.dipy.base import DipyDiffusionInterface, DipyBaseInterfac
 from nipype.interfaces.base import TraitedSpec, File, traits, isdefined, BaseInterfaceInputSpec, InputMultiPath
 from nipype import logging
 
+from cmtklib.image import load_image_data
+
 
 standard_library.install_aliases()
 IFLOGGER = logging.getLogger('nipype.interface')
@@ -75,8 +77,8 @@ class DTIEstimateResponseSH(DipyDiffusionInterface):
 
         import pickle as pickle
 
-        img = nib.load(self.inputs.in_file)
-        imref = nib.four_to_three(img)[0]
+        img, data = load_image_data(self.inputs.in_file)
+        imref = img.slicer[..., 0]
         affine = img.affine
 
         if isdefined(self.inputs.in_mask):
@@ -86,7 +88,6 @@ class DTIEstimateResponseSH(DipyDiffusionInterface):
         else:
             msk = np.ones(imref.shape)
 
-        data = img.get_data().astype(np.float32)
         gtab = self._get_gradient_table()
 
         # Fit it
@@ -231,8 +232,8 @@ class CSD(DipyDiffusionInterface):
         import pickle as pickle
         # import gzip
 
-        img = nib.load(self.inputs.in_file)
-        imref = nib.four_to_three(img)[0]
+        img, data = load_image_data(self.inputs.in_file, writable=True)
+        imref = img.slicer[..., 0]
 
         def clipMask(mask):
             """This is a hack until we fix the behaviour of the tracking objects around the edge of the image."""
@@ -250,7 +251,6 @@ class CSD(DipyDiffusionInterface):
         else:
             msk = clipMask(np.ones(imref.shape).astype('float32'))
 
-        data = img.get_data().astype(np.float32)
         data[msk == 0] *= 0
 
         # hdr = imref.header.copy()
@@ -416,8 +416,8 @@ class SHORE(DipyDiffusionInterface):
         from dipy.reconst.shm import sf_to_sh
         from dipy.core.ndindex import ndindex
 
-        img = nib.load(self.inputs.in_file)
-        imref = nib.four_to_three(img)[0]
+        img, data = load_image_data(self.inputs.in_file, writable=True)
+        imref = img.slicer[..., 0]
         affine = img.affine
 
         def clipMask(mask):
@@ -436,7 +436,6 @@ class SHORE(DipyDiffusionInterface):
         else:
             msk = clipMask(np.ones(imref.shape).astype('float32'))
 
-        data = img.get_data().astype(np.float32)
         data[msk == 0] *= 0
 
         # hdr = imref.header.copy()
@@ -578,11 +577,10 @@ class TensorInformedEudXTractography(DipyBaseInterface):
         if not (isdefined(self.inputs.in_model)):
             raise RuntimeError("in_model should be supplied")
 
-        img = nib.load(self.inputs.in_file)
-        imref = nib.four_to_three(img)[0]
+        img, data = load_image_data(self.inputs.in_file)
+        imref = img.slicer[..., 0]
         affine = img.affine
 
-        data = img.get_data().astype(np.float32)
         hdr = imref.header.copy()
         hdr.set_data_dtype(np.float32)
         hdr['data_type'] = 16
@@ -811,11 +809,10 @@ class DirectionGetterTractography(DipyBaseInterface):
         if not (isdefined(self.inputs.in_model)):
             raise RuntimeError('in_model should be supplied')
 
-        img = nib.load(self.inputs.in_file)
-        imref = nib.four_to_three(img)[0]
+        img, data = load_image_data(self.inputs.in_file)
+        imref = img.slicer[..., 0]
         affine = img.affine
 
-        data = img.get_data().astype(np.float32)
         hdr = imref.header.copy()
         hdr.set_data_dtype(np.float32)
         hdr['data_type'] = 16
@@ -1141,10 +1138,9 @@ class MAPMRI(DipyDiffusionInterface):
         import pickle as pickle
         import gzip
 
-        img = nib.load(self.inputs.in_file)
+        img, data = load_image_data(self.inputs.in_file)
         affine = img.affine
 
-        data = img.get_data().astype(np.float32)
         gtab = self._get_gradient_table()
         gtab = gradient_table(
             bvals=gtab.bvals, bvecs=gtab.bvecs,
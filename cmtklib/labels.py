@@ -0,0 +1,129 @@
+# Copyright (C) 2009-2022, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland, and CMP3 contributors
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Module that provides lookup-table utilities to build masks and remapped volumes from label volumes."""
+
+import numpy as np
+
+
+def build_label_lut(assignments, max_label=0, dtype=np.int32, default=0):
+    """Build a lookup array that maps labels to values.
+
+    Parameters
+    ----------
+    assignments : dict or list of tuple
+        Dictionary of the value of each label, or list of (labels, value)
+        pairs assigning a value to a list of labels. Pairs are applied in order,
+        such that the last value assigned to a label is kept
+
+    max_label : int
+        Minimal largest label indexing the lookup array
+
+    dtype : numpy.dtype
+        Data type of the values
+
+    default : scalar
+        Value of the labels without assignment
+
+    Returns
+    -------
+    lut : numpy.ndarray
+        Lookup array such that `lut[label]` is the value of `label`
+
+    Examples
+    --------
+    >>> lut = build_label_lut([([4, 43], 1), ([10, 49], 2)])
+    >>> lut[[0, 4, 49]]
+    array([0, 1, 2], dtype=int32)
+    """
+    if isinstance(assignments, dict):
+        assignments = [([label], value) for label, value in assignments.items()]
+    assignments = [(np.asarray(labels, dtype=np.int64).ravel(), value) for labels, value in assignments]
+    for labels, _ in assignments:
+        if labels.size and labels.min() < 0:
+            raise ValueError("Labels of a lookup table should be positive, got %d" % labels.min())
+    max_label = max([max_label] + [int(labels.max()) for labels, _ in assignments if labels.size])
+    lut = np.full(max_label + 1, default, dtype=dtype)
+    for labels, value in assignments:
+        lut[labels] = value
+    return lut
+
+
+def apply_label_lut(label_data, lut, default=0):
+    """Map a label volume through a lookup array in one pass.
+
+    Parameters
+    ----------
+    label_data : numpy.ndarray
+        Integer-valued label volume
+
+    lut : numpy.ndarray
+        Lookup array built by :func:`build_label_lut`
+
+    default : scalar
+        Value of the labels out of the lookup array
+
+    Returns
+    -------
+    values : numpy.ndarray
+        Volume of the values of the labels, of the type of `lut`
+    """
+    label_data = np.asarray(label_data)
+    if not np.issubdtype(label_data.dtype, np.integer):
+        label_data = np.rint(label_data).astype(np.int64)
+    if label_data.size == 0:
+        return np.zeros(label_data.shape, dtype=lut.dtype)
+    min_label, max_label = int(label_data.min()), int(label_data.max())
+    if max_label >= len(lut):
+        lut = np.concatenate((lut, np.full(max_label + 1 - len(lut), default, dtype=lut.dtype)))
+    if min_label < 0:
+        # Negative labels are shifted to the end of the lookup array
+        lut = np.concatenate((lut, np.full(-min_label, default, dtype=lut.dtype)))
+    return lut[label_data]
+
+
+def label_masks(label_data, label_sets):
+    """Build the binary masks of several sets of labels in one pass over a label volume.
+
+    Each label is mapped to a bit field of the sets it belongs to, such
+    that the volume is scanned once whatever the number of sets.
+
+    Parameters
+    ----------
+    label_data : numpy.ndarray
+        Integer-valued label volume
+
+    label_sets : dict
+        Dictionary of the lists of labels of each mask, indexed by mask name
+        (at most 64 masks)
+
+    Returns
+    -------
+    masks : dict
+        Dictionary of the boolean masks indexed by mask name
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> masks = label_masks(np.array([0, 4, 10, 43]), {"ventricles": [4, 43], "thalamus": [10, 49]})
+    >>> masks["ventricles"]
+    array([False,  True, False,  True])
+    """
+    if len(label_sets) > 64:
+        raise ValueError("At most 64 label sets can be extracted in one pass, got %d" % len(label_sets))
+    names = list(label_sets.keys())
+    lut = np.zeros(1, dtype=np.uint64)
+    for bit, name in enumerate(names):
+        labels = np.asarray(label_sets[name], dtype=np.int64).ravel()
+        if labels.size and labels.max() >= len(lut):
+            lut = np.concatenate((lut, np.zeros(labels.max() + 1 - len(lut), dtype=np.uint64)))
+        lut[labels] |= np.uint64(1) << np.uint64(bit)
+    # The narrowest unsigned type holding all the bits keeps the coded volume small
+    lut = lut.astype(np.min_scalar_type(int(lut.max())))
+    codes = apply_label_lut(label_data, lut)
+    return {
+        name: (codes & lut.dtype.type(1 << bit)) != 0 for bit, name in enumerate(names)
+    }
@@ -0,0 +1,218 @@
+# Copyright (C) 2009-2022, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland, and CMP3 contributors
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Module that provides in-process morphological operations and smoothing of 3D images.
+
+Kernels and filters follow the definitions of `fslmaths`, such that
+``fslmaths in -kernel sphere <r> -dilD out`` or
+``fslmaths in -kernel gauss <sigma> -fmean out`` can be run in memory.
+"""
+
+import numpy as np
+from scipy import ndimage
+
+
+def sphere_kernel(radius, voxel_size):
+    """Return the spherical kernel of a radius in mm (`fslmaths -kernel sphere`).
+
+    Parameters
+    ----------
+    radius : float
+        Radius of the sphere in mm
+
+    voxel_size : 3-tuple
+        Voxel size in mm
+
+    Returns
+    -------
+    kernel : numpy.ndarray
+        3D boolean kernel of the voxels whose center lies in the sphere
+    """
+    voxel_size = np.asarray(voxel_size[:3], dtype=np.float64)
+    half_width = np.rint(radius / voxel_size).astype(int)
+    grid = np.meshgrid(
+        *[np.arange(-n, n + 1) * d for n, d in zip(half_width, voxel_size)], indexing="ij"
+    )
+    return np.sum([np.square(g) for g in grid], axis=0) <= radius ** 2
+
+
+def box_kernel(width, voxel_size):
+    """Return the cubic kernel of a width in mm (`fslmaths -kernel box`).
+
+    Parameters
+    ----------
+    width : float
+        Width of the cube in mm
+
+    voxel_size : 3-tuple
+        Voxel size in mm
+
+    Returns
+    -------
+    kernel : numpy.ndarray
+        3D boolean kernel of odd size along each axis
+    """
+    shape = [int(np.floor(width / d / 2.0)) * 2 + 1 for d in voxel_size[:3]]
+    return np.ones(shape, dtype=bool)
+
+
+def dilate(data, kernel):
+    """Maximum filtering of all voxels (`fslmaths -dilF`), i.e. binary dilation of masks.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        3D image
+
+    kernel : numpy.ndarray
+        3D boolean kernel (See :func:`sphere_kernel` and :func:`box_kernel`)
+
+    Returns
+    -------
+    dilated : numpy.ndarray
+        Dilated image
+    """
+    if data.dtype == bool:
+        return ndimage.binary_dilation(data, structure=kernel)
+    return ndimage.grey_dilation(data, footprint=kernel, mode="constant", cval=data.min())
+
+
+def neighbourhood_values(data, coords, offsets):
+    """Gather the values of a 3D image at offsets of a list of voxels.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        3D image
+
+    coords : numpy.ndarray
+        Voxel coordinates (n_voxels x 3)
+
+    offsets : numpy.ndarray
+        Offsets of the neighbourhood (n_offsets x 3)
+
+    Returns
+    -------
+    values : numpy.ndarray
+        Values of the neighbours of each voxel (n_voxels x n_offsets),
+        0 outside the image
+    """
+    pos = coords[:, np.newaxis, :] + offsets[np.newaxis, :, :]
+    inside = np.all((pos >= 0) & (pos < np.array(data.shape)), axis=2)
+    pos[~inside] = 0
+    values = data[pos[..., 0], pos[..., 1], pos[..., 2]]
+    values[~inside] = 0
+    return values
+
+
+def modal_values(values):
+    """Return the most frequent non-zero value of each row.
+
+    The smallest value is returned in case of ties, as done by
+    `numpy.argmax(numpy.bincount(row))`, and 0 for rows of zeros.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        2D array of values (e.g. returned by :func:`neighbourhood_values`)
+
+    Returns
+    -------
+    modes : numpy.ndarray
+        Most frequent non-zero value of each row
+    """
+    values = np.sort(values, axis=1)
+    counts = np.zeros(values.shape, dtype=np.int64)
+    for j in range(values.shape[1]):
+        counts[:, j] = np.sum(values == values[:, j:j + 1], axis=1)
+    counts[values == 0] = 0
+    return values[np.arange(len(values)), np.argmax(counts, axis=1)]
+
+
+def modal_dilate(data, kernel, chunk_size=100000):
+    """Modal dilation of non-zero voxels (`fslmaths -dilD`).
+
+    Each zero voxel with non-zero voxels in its kernel neighbourhood is given
+    the most frequent of their values (the smallest one in case of ties).
+    Non-zero voxels are left unchanged. Binary masks are thus dilated,
+    and label volumes are dilated without mixing labels.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        3D image
+
+    kernel : numpy.ndarray
+        3D boolean kernel (See :func:`sphere_kernel` and :func:`box_kernel`)
+
+    chunk_size : int
+        Number of voxels processed at once
+
+    Returns
+    -------
+    dilated : numpy.ndarray
+        Dilated image
+    """
+    nonzero = data != 0
+    dilated = data.copy()
+    if not nonzero.any():
+        return dilated
+    candidates = np.transpose(np.nonzero(ndimage.binary_dilation(nonzero, structure=kernel) & ~nonzero))
+    center = np.array(kernel.shape) // 2
+    offsets = np.transpose(np.nonzero(kernel)) - center
+    for start in range(0, len(candidates), chunk_size):
+        coords = candidates[start:start + chunk_size]
+        dilated[tuple(coords.T)] = modal_values(neighbourhood_values(data, coords, offsets))
+    return dilated
+
+
+def _gaussian_kernel_1d(sigma, voxel_dim, cutoff=4.0):
+    """Return the 1D Gaussian kernel of a sigma in mm truncated at `cutoff` sigmas."""
+    half_width = int(np.ceil(sigma * cutoff / voxel_dim))
+    x = np.arange(-half_width, half_width + 1) * voxel_dim
+    return np.exp(-np.square(x) / (2.0 * sigma ** 2))
+
+
+def gaussian_smooth(data, voxel_size, fwhm=None, sigma=None, cutoff=4.0):
+    """Kernel-weighted mean filtering with a Gaussian kernel (`fslmaths -kernel gauss <sigma> -fmean`).
+
+    The separable Gaussian kernel is truncated at `cutoff` sigmas, and the
+    weights are renormalized near the image borders to the kernel voxels
+    lying inside the image.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        3D image
+
+    voxel_size : 3-tuple
+        Voxel size in mm
+
+    fwhm : float
+        Full width at half maximum of the kernel in mm
+
+    sigma : float
+        Standard deviation of the kernel in mm (if `fwhm` is not given)
+
+    cutoff : float
+        Number of sigmas after which the kernel is truncated
+
+    Returns
+    -------
+    smoothed : numpy.ndarray
+        Smoothed image in float64
+    """
+    if fwhm is not None:
+        sigma = fwhm / (2.0 * np.sqrt(2.0 * np.log(2.0)))
+    if sigma is None or sigma <= 0:
+        raise ValueError("A positive FWHM or sigma is required for Gaussian smoothing")
+    smoothed = np.asarray(data, dtype=np.float64)
+    weights = np.ones(smoothed.shape)
+    for axis, voxel_dim in enumerate(voxel_size[:3]):
+        kernel = _gaussian_kernel_1d(sigma, voxel_dim, cutoff)
+        smoothed = ndimage.correlate1d(smoothed, kernel, axis=axis, mode="constant", cval=0.0)
+        weights = ndimage.correlate1d(weights, kernel, axis=axis, mode="constant", cval=0.0)
+    return smoothed / weights
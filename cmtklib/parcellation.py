@@ -8,13 +8,16 @@
 
 # Common libraries import
 import os
+import time
 from time import localtime, strftime
 import os.path as op
 from pathlib import Path
 import pkg_resources
 import subprocess
 import shutil
-import math
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 import nibabel as ni
 import networkx as nx
@@ -32,6 +35,10 @@ from nipype.interfaces.base import traits, BaseInterfaceInputSpec, TraitedSpec,
     InputMultiPath, OutputMultiPath
 from nipype.utils.logger import logging
 
+from .image import load_image_data, iter_spatial_chunks
+from .labels import build_label_lut, apply_label_lut, label_masks
+from .morphology import sphere_kernel, modal_dilate, modal_values, neighbourhood_values
+
 iflogger = logging.getLogger('nipype.interface')
 
 
@@ -682,33 +689,15 @@ class CombineParcellations(BaseInterface):
         iflogger.info("  > Create ventricule image")
         img_v = ni.load(roi1_fname)
         img_data = img_v.get_data()
-        tmp = np.zeros(img_data.shape)
-        ind_v = np.where(img_data == ventricle3)
-        tmp[ind_v] = 1
-
-        third_vent_fn = op.abspath('ventricle3.nii.gz')
-        hdr = img_v.get_header()
-        hdr2 = hdr.copy()
-        hdr2.set_data_dtype(np.int16)
-        iflogger.info("    ... Image saved to {}".format(third_vent_fn))
-        img = ni.Nifti1Image(tmp, img_v.get_affine(), hdr2)
-        ni.save(img, third_vent_fn)
-        del img
+        third_vent = (img_data == ventricle3).astype(np.uint8)
 
         iflogger.info("  > Dilate (modal) the ventricule image")
-        third_vent_dil = op.abspath('ventricle3_dil.nii.gz')
-        cmd = f'fslmaths -dt char {third_vent_fn} -mas {third_vent_fn} -kernel sphere 5 -dilD {third_vent_dil}'
-        iflogger.info("    ... Command: {}".format(cmd))
-        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        proc_stdout = process.communicate()[0].strip()
+        voxel_size = img_v.header.get_zooms()[:3]
+        third_vent_dil = modal_dilate(third_vent, sphere_kernel(5, voxel_size))
 
-        if self.inputs.verbose_level == 2:
-            print(proc_stdout)
-
-        tmp = ni.load(third_vent_dil)
-        indrhypothal = np.where((tmp == 1) & (img_data == right_ventral))
-        indlhypothal = np.where((tmp == 1) & (img_data == left_ventral))
-        del tmp
+        indrhypothal = np.where((third_vent_dil == 1) & (img_data == right_ventral))
+        indlhypothal = np.where((third_vent_dil == 1) & (img_data == left_ventral))
+        del third_vent, third_vent_dil
 
         f_color_lut = None
         f_graphml = None
@@ -1760,61 +1749,9 @@ class ParcellateThalamus(BaseInterface):
         proc_stdout = process.communicate()[0].strip()
         iflogger.info(proc_stdout)
 
-        iflogger.info('Correcting the volumes after the interpolation ')
-        # Load jacobian file
-        img_data_jacob = ni.load(jacobian_file).get_data()  # numpy.ndarray
-
-        # Load probability maps in native space after applying estimated transform and deformation
-        img_spams = ni.load(output_maps)
-        img_data_vspams = img_spams.get_data()  # numpy.ndarray
-        img_data_vspams[img_data_vspams < 0] = 0
-        img_data_vspams[img_data_vspams > 1] = 1
-
-        # Creating max_prob
-        thresh = 0.05
-        img_data_spams = img_data_vspams.copy()
-        img_data_spams[img_data_spams < thresh] = 0
-        ind = np.where(np.sum(img_data_spams, axis=3) == 0)
-        max_prob = img_data_spams.argmax(axis=3) + 1
-        max_prob[ind] = 0
-        # ? max_prob = imfill(max_prob,'holes');
-
-        del img_data_spams
-
-        debug_file = op.abspath('{}_class-thalamus_dtissue_after_ants.nii.gz'.format(outprefix_name))
-        print("Save output image to %s" % debug_file)
-        img = ni.Nifti1Image(max_prob, img_atlas.get_affine(), hdr2)
-        ni.save(img, debug_file)
-        del img
-
-        # Take into account jacobian to correct the probability maps after interpolation
-        img_data_spams = np.zeros(img_data_vspams.shape)
-        for nuc in np.arange(img_data_vspams.shape[3]):
-            temp_image = img_data_vspams[:, :, :, nuc]
-            t = np.multiply(temp_image, img_data_jacob)
-            img_data_spams[:, :, :, nuc] = t / t.max()
-        del temp_image, t, img_data_vspams, img_data_jacob
-
-        # Creating max_prob
-        img_data_spams[img_data_spams < thresh] = 0
-        ind = np.where(np.sum(img_data_spams, axis=3) == 0)
-        max_prob = img_data_spams.argmax(axis=3) + 1
-        max_prob[ind] = 0
-        # ? max_prob = imfill(max_prob,'holes');
-
-        debug_file = op.abspath('{}_class-thalamus_dtissue_after_jacobiancorr.nii.gz'.format(outprefix_name))
-        print("Save output image to %s" % debug_file)
-        img = ni.Nifti1Image(max_prob, img_atlas.get_affine(), hdr2)
-        ni.save(img, debug_file)
-        del img
-
         iflogger.info('Creating Thalamus mask from FreeSurfer aparc+aseg ')
         iflogger.info('- New FreeSurfer SUBJECTS_DIR:\n  {}\n'.format(self.inputs.subjects_dir))
 
-        # Extract indices of left/right thalamus mask from aparc+aseg volume
-        indl = np.where(img_data_atlas == 10)
-        indr = np.where(img_data_atlas == 49)
-
         def filter_isolated_cells(array, struct):
             """ Return array with completely isolated single cells removed
             :param array: Array with completely isolated single cells
@@ -1830,34 +1767,30 @@ class ParcellateThalamus(BaseInterface):
             filtered_array[area_mask[id_regions]] = 0
             return filtered_array
 
+        # Extract left/right thalamus masks from aparc+aseg volume
+        thal_masks = label_masks(img_data_atlas, {'lh': [10], 'rh': [49]})
+        thal_lh = thal_masks['lh']
+        thal_rh = thal_masks['rh']
+        del thal_masks
+
         remove_isolated_points = True
         if remove_isolated_points:
             struct = np.ones((3, 3, 3))
             # struct = np.zeros((3,3,3))
             # struct[1,1,1] = 1
 
-            # Left Hemisphere
-            # Removing isolated points
-            temp_i = np.zeros(img_data_atlas.shape)
-            temp_i[indl] = 1
-            temp_i = filter_isolated_cells(temp_i, struct=struct)
-            indl = np.where(temp_i == 1)
-
-            # Right Hemisphere
-            # Removing isolated points
-            temp_i = np.zeros(img_data_atlas.shape)
-            temp_i[indr] = 1
-            temp_i = filter_isolated_cells(temp_i, struct=struct)
-            indr = np.where(temp_i == 1)
+            # Removing isolated points in left and right hemispheres
+            thal_lh = filter_isolated_cells(thal_lh, struct=struct)
+            thal_rh = filter_isolated_cells(thal_rh, struct=struct)
 
-            del struct, temp_i
+            del struct
 
         # Creating Thalamic Mask (1: Left, 2:Right)
-        img_data_thal = np.zeros(img_data_atlas.shape)
-        img_data_thal[indl] = 1
-        img_data_thal[indr] = 2
+        img_data_thal = np.zeros(img_data_atlas.shape, dtype=np.uint16)
+        img_data_thal[thal_lh] = 1
+        img_data_thal[thal_rh] = 2
 
-        del indl, indr
+        del thal_lh, thal_rh
 
         # TODO: Masking according to csf
         # unzip_nifti([freesDir filesep subjId filesep 'tmp' filesep 'T1native.nii.gz']);
@@ -1872,105 +1805,60 @@ class ParcellateThalamus(BaseInterface):
 
         # update the header and save thalamus mask
         thalamus_mask = op.abspath('{}_class-thalamus_dtissue.nii.gz'.format(outprefix_name))
-        hdr = img_atlas.get_header()
-        hdr2 = hdr.copy()
-        hdr2.set_data_dtype(np.uint16)
         print("Save output image to %s" % thalamus_mask)
         img_thal = ni.Nifti1Image(img_data_thal, img_atlas.get_affine(), hdr2)
         ni.save(img_thal, thalamus_mask)
 
-        del hdr, hdr2, img_thal
+        del img_thal, img_data_atlas
+
+        iflogger.info('Correcting the volumes after the interpolation ')
+        # Load jacobian file
+        img_data_jacob = ni.load(jacobian_file).get_data()  # numpy.ndarray
 
-        nb_spams = img_data_spams.shape[3]
-        thresh = 0.05
+        # Load probability maps in native space after applying estimated transform and deformation,
+        # as a float32 working copy memory-mapped from the node directory, corrected in place
+        img_spams, img_data_spams = load_image_data(output_maps, writable=True)
+        affine_spams = img_spams.get_affine()
+        hdr_spams = img_spams.get_header().copy()
+        del img_spams
 
+        # Take into account jacobian to correct the probability maps after interpolation,
+        # and mask them using the left/right-hemisphere thalamus masks
         use_thalamus_mask = True
-        if use_thalamus_mask:
-            img_data_thal_lh = np.zeros(img_data_thal.shape)
-            indl = np.where(img_data_thal == 1)
-            img_data_thal_lh[indl] = 1
-            del indl
-
-            img_data_thal_rh = np.zeros(img_data_thal.shape)
-            indr = np.where(img_data_thal == 2)
-            img_data_thal_rh[indr] = 1
-
-            del img_data_thal
-
-            # Mask probability maps using the left-hemisphere thalamus mask
-            tmp_thal_lh = np.zeros(
-                (img_data_thal_lh.shape[0], img_data_thal_lh.shape[1], img_data_thal_lh.shape[2], 1))
-            tmp_thal_lh[:, :, :, 0] = img_data_thal_lh
-            temp_m = np.repeat(tmp_thal_lh, int(nb_spams / 2), axis=3)
-            del tmp_thal_lh
-            img_data_spam_lh = np.multiply(img_data_spams[:, :, :, 0:int(nb_spams / 2)], temp_m)
-            del temp_m
-
-            # Creating max_prob
-            img_data_spam_lh[img_data_spam_lh < thresh] = 0
-            ind = np.where(np.sum(img_data_spam_lh, axis=3) == 0)
-            # max_prob_l = img_data_spam_lh.max(axis=3)
-            max_prob_l = np.argmax(img_data_spam_lh, axis=3) + 1
-            max_prob_l[ind] = 0
-            # max_prob_l[ind] = 0
-            # ? max_prob_l = ndimage.binary_fill_holes(max_prob_l)
-            # ? max_prob_l = Atlas_Corr(img_data_thal_lh,max_prob_l)
-
-            # Mask probability maps using the right-hemisphere thalamus mask
-            tmp_thal_rh = np.zeros(
-                (img_data_thal_rh.shape[0], img_data_thal_rh.shape[1], img_data_thal_rh.shape[2], 1))
-            tmp_thal_rh[:, :, :, 0] = img_data_thal_rh
-            temp_m = np.repeat(tmp_thal_rh, int(nb_spams / 2), axis=3)
-            del tmp_thal_rh
-            img_data_spam_rh = np.multiply(img_data_spams[:, :, :, int(nb_spams / 2):int(nb_spams)], temp_m)
-            del temp_m
-
-            # Creating max_prob
-            img_data_spam_rh[img_data_spam_rh < thresh] = 0
-            ind = np.where(np.sum(img_data_spam_rh, axis=3) == 0)
-            # max_prob_r = img_data_spam_rh.max(axis=3)
-            max_prob_r = np.argmax(img_data_spam_rh, axis=3) + 1
-            # ?max_prob_r = imfill(max_prob_r,'holes');
-            # ?max_prob_r = Atlas_Corr(img_data_thal_rh,max_prob_r);
-            max_prob_r[indr] = max_prob_r[indr] + int(nb_spams / 2)
-            max_prob_r[ind] = 0
-
-            del indr
-
-            img_data_spams[:, :, :, 0:int(nb_spams / 2)] = img_data_spam_lh
-            img_data_spams[:, :, :, int(nb_spams / 2):nb_spams] = img_data_spam_rh
+        max_prob_ants, max_prob_jacobian, max_prob = correct_thalamic_nuclei_maps(
+            img_data_spams, img_data_jacob,
+            thalamus_mask=img_data_thal if use_thalamus_mask else None,
+            thresh=0.05
+        )
+        # ? max_prob = imfill(max_prob,'holes');
+        # ? max_prob = Atlas_Corr(img_data_thal,max_prob);
+
+        del img_data_jacob, img_data_thal
+
+        debug_file = op.abspath('{}_class-thalamus_dtissue_after_ants.nii.gz'.format(outprefix_name))
+        print("Save output image to %s" % debug_file)
+        img = ni.Nifti1Image(max_prob_ants, img_atlas.get_affine(), hdr2)
+        ni.save(img, debug_file)
+
+        debug_file = op.abspath('{}_class-thalamus_dtissue_after_jacobiancorr.nii.gz'.format(outprefix_name))
+        print("Save output image to %s" % debug_file)
+        img = ni.Nifti1Image(max_prob_jacobian, img_atlas.get_affine(), hdr2)
+        ni.save(img, debug_file)
+
+        del img, max_prob_ants, max_prob_jacobian
 
         # Save corrected probability maps of thalamic nuclei
         # update the header
-        hdr = img_spams.get_header()
-        hdr2 = hdr.copy()
-        hdr2.set_data_dtype(np.uint16)
+        hdr_spams.set_data_dtype(np.uint16)
         print("Save output image to %s" % output_maps)
-        img = ni.Nifti1Image(img_data_spams, img_spams.get_affine(), hdr2)
+        img = ni.Nifti1Image(img_data_spams, affine_spams, hdr_spams)
         ni.save(img, output_maps)
 
-        del hdr, img, img_spams
+        del hdr_spams, img, img_data_spams
 
         # Save Maxprob
-        # update the header
         max_prob_fn = op.abspath('{}_class-thalamus_probtissue_maxprob.nii.gz'.format(outprefix_name))
-        hdr = img_atlas.get_header()
-        hdr2 = hdr.copy()
-        hdr2.set_data_dtype(np.uint16)
-
-        if use_thalamus_mask:
-            max_prob = max_prob_l + max_prob_r
-        else:
-            # Creating max_prob
-            img_data_spams[img_data_spams < thresh] = 0
-            ind = np.where(np.sum(img_data_spams, axis=3) == 0)
-            max_prob = img_data_spams.argmax(axis=3) + 1
-            max_prob[ind] = 0
-            # ?max_prob = imfill(max_prob,'holes');
-
-        del img_data_spams
-
-        print("Save output image to %s" % max_prob)
+        print("Save output image to %s" % max_prob_fn)
         img = ni.Nifti1Image(max_prob, img_atlas.get_affine(), hdr2)
         ni.save(img, max_prob_fn)
 
@@ -2009,6 +1897,11 @@ class ParcellateInputSpec(BaseInterfaceInputSpec):
 
     erode_masks = traits.Bool(False, desc="If `True` erode the masks")
 
+    number_of_threads = traits.Int(
+        1, usedefault=True,
+        desc="Number of FreeSurfer commands run concurrently to create the Lausanne2018 parcellation"
+    )
+
 
 class ParcellateOutputSpec(TraitedSpec):
     white_matter_mask_file = File(desc='White matter (WM) mask file')
@@ -2077,7 +1970,8 @@ class Parcellate(BaseInterface):
             print("Parcellation scheme : Lausanne2018")
             create_T1_and_Brain(self.inputs.subject_id, self.inputs.subjects_dir)
             # create_annot_label(self.inputs.subject_id, self.inputs.subjects_dir)
-            create_roi(self.inputs.subject_id, self.inputs.subjects_dir)
+            create_roi(self.inputs.subject_id, self.inputs.subjects_dir,
+                       number_of_threads=self.inputs.number_of_threads)
             create_wm_mask(self.inputs.subject_id, self.inputs.subjects_dir)
             if self.inputs.erode_masks:
                 erode_mask(fsdir, op.join(fsdir, 'mri', 'fsmask_1mm.nii.gz'))
@@ -2269,6 +2163,202 @@ def extract(Z, shape, position, fill):
     return R
 
 
+def _cube_offset_shells(half_width):
+    """Return the non-zero offsets of a cube neighbourhood sorted by distance to its center.
+
+    Offsets sharing the same squared distance form a shell delimited by
+    `starts` and `stops` in the sorted offset array.
+    """
+    r = np.arange(-half_width, half_width + 1)
+    offsets = np.stack(np.meshgrid(r, r, r, indexing="ij"), axis=-1).reshape(-1, 3)
+    sq_dist = np.sum(offsets ** 2, axis=1)
+    order = np.argsort(sq_dist, kind="stable")[1:]  # the center comes first
+    offsets, sq_dist = offsets[order], sq_dist[order]
+    shells, starts = np.unique(sq_dist, return_index=True)
+    stops = np.append(starts[1:], len(sq_dist))
+    return offsets, shells, starts, stops
+
+
+def dilate_labels(labels, targets, half_width=12, mode="vote"):
+    """Assign to target voxels the label of their nearest labeled voxels.
+
+    The distance of each target voxel to the nearest labeled voxel is computed
+    once with a Euclidean distance transform. The search is restricted to the
+    cube of `2 * half_width + 1` voxels centered on each target voxel, whose own
+    label is not considered. Target voxels without labeled voxels in their
+    neighbourhood are given the label 0.
+
+    Parameters
+    ----------
+    labels : numpy.ndarray
+        3D volume of labels used for the assignment
+
+    targets : numpy.ndarray
+        3D boolean mask of the voxels to label
+
+    half_width : int
+        Half width of the cube neighbourhood in voxels
+
+    mode : 'vote' or 'nearest'
+        In `vote` mode, the most frequent label of the labeled voxels at
+        the minimal distance is assigned (the smallest label in case of ties),
+        as done by the former voxel-wise loop of `create_roi()` with `numpy.bincount`.
+        In `nearest` mode, the label of the nearest voxel returned by the
+        distance transform is assigned (ties are broken arbitrarily)
+
+    Returns
+    -------
+    values : numpy.ndarray
+        Labels of the target voxels, in the order of `labels[targets]`
+    """
+    if mode not in ["vote", "nearest"]:
+        raise ValueError("Invalid dilation mode: %s (should be 'vote' or 'nearest')" % mode)
+
+    coords = np.transpose(np.nonzero(targets))
+    values = np.zeros(len(coords), dtype=labels.dtype)
+    if len(coords) == 0:
+        return values
+
+    # Labeled voxels farther than the neighbourhood of the targets are never used
+    lo = np.maximum(coords.min(axis=0) - half_width, 0)
+    hi = np.minimum(coords.max(axis=0) + half_width + 1, labels.shape)
+    labels = labels[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+    coords = coords - lo
+    background = labels == 0
+    if background.all():
+        return values
+
+    index = tuple(coords.T)
+    resolved = np.zeros(len(coords), dtype=bool)
+    if mode == "nearest":
+        distances, indices = ndimage.distance_transform_edt(background, return_indices=True)
+        nearest = indices[(slice(None),) + index].T
+        # Targets whose nearest labeled voxel is themselves or out of the cube are voted
+        resolved = (distances[index] > 0) & (
+            np.abs(nearest - coords).max(axis=1) <= half_width
+        )
+        values[resolved] = labels[tuple(nearest[resolved].T)]
+    else:
+        distances = ndimage.distance_transform_edt(background)
+
+    # The squared distance to the nearest labeled voxel is where the search starts
+    first_shell = np.rint(np.square(distances[index])).astype(np.int64)
+    del distances
+
+    offsets, shells, starts, stops = _cube_offset_shells(half_width)
+    for shell, start, stop in zip(shells, starts, stops):
+        unresolved = ~resolved
+        if not unresolved.any():
+            break
+        rows = np.flatnonzero(unresolved & (first_shell <= shell))
+        if len(rows) == 0:
+            continue
+        candidates = neighbourhood_values(labels, coords[rows], offsets[start:stop])
+        found = np.any(candidates > 0, axis=1)
+        values[rows[found]] = modal_values(candidates[found])
+        resolved[rows[found]] = True
+
+    return values
+
+
+def _maxprob_labels(spams, offset=0):
+    """Return the 1-based index (shifted by `offset`) of the most probable map of each voxel, 0 where all maps are zero."""
+    max_prob = (np.argmax(spams, axis=-1) + 1 + offset).astype(np.uint16)
+    max_prob[np.sum(spams, axis=-1) == 0] = 0
+    return max_prob
+
+
+def correct_thalamic_nuclei_maps(spams, jacobian, thalamus_mask=None, thresh=0.05, chunk_size=8):
+    """Correct the registered probability maps of thalamic nuclei and label each voxel with its most probable nucleus.
+
+    The maps are clipped to [0, 1], multiplied by the Jacobian determinant of
+    the deformation, normalized by their maximum, and thresholded. If a thalamus
+    mask is given, the maps of the first (second) half of the nuclei are
+    restricted to the left (right) thalamus. The 4D maps are processed in place
+    by chunks of axial slices in two passes (maximum of each corrected map, then
+    normalization and labeling), such that no full 4D copy is made, and the
+    masking and labeling of the corrected maps is restricted to the bounding box
+    of the thalamus.
+
+    Parameters
+    ----------
+    spams : numpy.ndarray
+        4D probability maps of the thalamic nuclei (X x Y x Z x nuclei),
+        overwritten by the corrected maps (e.g. a writable memory map
+        returned by :func:`cmtklib.image.load_image_data`)
+
+    jacobian : numpy.ndarray
+        3D Jacobian determinant of the deformation
+
+    thalamus_mask : numpy.ndarray
+        3D thalamus mask (1: Left, 2: Right). If `None`, the maps are not masked
+
+    thresh : float
+        Probability under which the corrected maps are set to 0
+
+    chunk_size : int
+        Number of axial slices processed at once
+
+    Returns
+    -------
+    max_prob_registered : numpy.ndarray
+        Max probability labels of the clipped maps before Jacobian correction
+
+    max_prob_corrected : numpy.ndarray
+        Max probability labels of the corrected maps before masking
+
+    max_prob : numpy.ndarray
+        Max probability labels of the corrected (and masked) maps
+    """
+    nb_spams = spams.shape[3]
+    half = int(nb_spams / 2)
+    max_prob_registered = np.zeros(spams.shape[:3], dtype=np.uint16)
+    max_prob_corrected = np.zeros(spams.shape[:3], dtype=np.uint16)
+    max_prob = np.zeros(spams.shape[:3], dtype=np.uint16)
+
+    # First pass: maximum of each map after Jacobian correction
+    maxima = None
+    for index, _ in iter_spatial_chunks(spams.shape, axis=2, chunk_size=chunk_size):
+        chunk = np.clip(spams[index], 0, 1)
+        spams[index] = chunk
+        max_prob_registered[index[:3]] = _maxprob_labels(np.where(chunk < thresh, 0, chunk))
+        chunk_max = (chunk * jacobian[index[:3]][..., np.newaxis]).max(axis=(0, 1, 2))
+        maxima = chunk_max if maxima is None else np.maximum(maxima, chunk_max)
+
+    if thalamus_mask is not None:
+        coords = np.nonzero(thalamus_mask)
+        if len(coords[0]) > 0:
+            lo = [c.min() for c in coords]
+            hi = [c.max() + 1 for c in coords]
+        else:
+            lo = hi = [0, 0, 0]
+
+    # Second pass: normalization, thresholding and labeling
+    for index, (start, stop) in iter_spatial_chunks(spams.shape, axis=2, chunk_size=chunk_size):
+        chunk = spams[index] * jacobian[index[:3]][..., np.newaxis] / maxima
+        chunk[chunk < thresh] = 0
+        max_prob_corrected[index[:3]] = _maxprob_labels(chunk)
+        if thalamus_mask is None:
+            max_prob[index[:3]] = max_prob_corrected[index[:3]]
+            spams[index] = chunk
+            continue
+
+        masked = np.zeros(chunk.shape, dtype=spams.dtype)
+        z_lo, z_hi = max(lo[2], start), min(hi[2], stop)
+        if z_lo < z_hi:
+            box = (slice(lo[0], hi[0]), slice(lo[1], hi[1]), slice(z_lo - start, z_hi - start))
+            box_mask = thalamus_mask[lo[0]:hi[0], lo[1]:hi[1], z_lo:z_hi]
+            masked[box + (slice(0, half),)] = chunk[box + (slice(0, half),)] * (box_mask == 1)[..., np.newaxis]
+            masked[box + (slice(half, nb_spams),)] = chunk[box + (slice(half, nb_spams),)] * (box_mask == 2)[
+                ..., np.newaxis]
+            max_prob[lo[0]:hi[0], lo[1]:hi[1], z_lo:z_hi] = _maxprob_labels(
+                masked[box + (slice(0, half),)]
+            ) + _maxprob_labels(masked[box + (slice(half, nb_spams),)], offset=half)
+        spams[index] = masked
+
+    return max_prob_registered, max_prob_corrected, max_prob
+
+
 def create_T1_and_Brain(subject_id, subjects_dir):
     """Generates T1, T1 masked and aseg+aparc Freesurfer images in NIFTI format.
 
@@ -2314,7 +2404,94 @@ def create_T1_and_Brain(subject_id, subjects_dir):
     print("[DONE]")
 
 
-def create_roi(subject_id, subjects_dir, v=True):
+def _run_shell_command(cmd, v=True):
+    """Run a shell command and return its exit code and wall time in seconds."""
+    start = time.time()
+    if v == 2:
+        returncode = subprocess.call(cmd, shell=True)
+    else:
+        returncode = subprocess.call(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    return returncode, time.time() - start
+
+
+def run_command_graph(commands, dependencies=None, number_of_threads=1, v=True):
+    """Run shell commands concurrently, each one as soon as the commands it depends on are completed.
+
+    Commands are submitted in the order of `commands` to a pool of
+    `number_of_threads` threads, and the wall time of each command is
+    recorded in the log of the interface.
+
+    Parameters
+    ----------
+    commands : dict
+        Dictionary of the shell commands indexed by name
+
+    dependencies : dict
+        Dictionary of the list of the names of the commands that
+        have to be completed before a command is run, indexed by name
+
+    number_of_threads : int
+        Maximal number of commands run at the same time
+
+    v : Boolean
+        Verbose mode (outputs of the commands are shown if `v == 2`)
+
+    Yields
+    ------
+    name : string
+        Name of a completed command, in the order of completion
+
+    returncode : int
+        Exit code of the command
+
+    elapsed : float
+        Wall time of the command in seconds
+    """
+    dependencies = dependencies if dependencies is not None else {}
+    for name, deps in dependencies.items():
+        missing = set(deps) - set(commands)
+        if name not in commands or missing:
+            raise ValueError("Invalid dependencies of command %s: %s" % (name, sorted(missing)))
+    remaining = {name: set(dependencies.get(name, [])) for name in commands}
+    completed = queue.Queue()
+    lock = threading.Lock()
+    executor = ThreadPoolExecutor(max_workers=max(1, int(number_of_threads)))
+
+    def _submit(name):
+        future = executor.submit(_run_shell_command, commands[name], v)
+        future.add_done_callback(lambda f: _on_done(name, f))
+
+    def _on_done(name, future):
+        try:
+            returncode, elapsed = future.result()
+        except Exception as e:  # pragma: no cover
+            print("  ... ERROR: %s failed (%s)" % (name, e))
+            returncode, elapsed = -1, 0.0
+        iflogger.info("  ... %s completed in %.2f s (exit code %d)" % (name, elapsed, returncode))
+        ready = []
+        with lock:
+            for other, deps in remaining.items():
+                if name in deps:
+                    deps.discard(name)
+                    if not deps:
+                        ready.append(other)
+        # Dependent commands are submitted right away, not when the caller consumes the results
+        for other in ready:
+            _submit(other)
+        completed.put((name, returncode, elapsed))
+
+    with lock:
+        initial = [name for name, deps in remaining.items() if not deps]
+    for name in initial:
+        _submit(name)
+    try:
+        for _ in range(len(commands)):
+            yield completed.get()
+    finally:
+        executor.shutdown(wait=True)
+
+
+def create_roi(subject_id, subjects_dir, v=True, dilation_mode="vote", number_of_threads=1):
     """Iteratively creates the ROI_%s.nii.gz files using the given Lausanne2018 parcellation information from networks.
 
     Parameters
@@ -2328,6 +2505,14 @@ def create_roi(subject_id, subjects_dir, v=True):
 
     v : Boolean
         Verbose mode
+
+    dilation_mode : 'vote' or 'nearest'
+        Mode of the assignment of the labels of the nearest cortical
+        regions to unlabeled voxels (See :func:`dilate_labels`)
+
+    number_of_threads : int
+        Maximal number of FreeSurfer commands run concurrently
+        (See :func:`run_command_graph`)
     """
 
     freesurfer_subj = os.path.abspath(subjects_dir)
@@ -2372,29 +2557,15 @@ def create_roi(subject_id, subjects_dir, v=True):
     asegd = aseg.get_data()  # numpy.ndarray
 
     # identify cortical voxels, right (3) and left (42) hemispheres
-    idxr = np.where(asegd == 3)
-    idxl = np.where(asegd == 42)
-    xx = np.concatenate((idxr[0], idxl[0]))
-    yy = np.concatenate((idxr[1], idxl[1]))
-    zz = np.concatenate((idxr[2], idxl[2]))
-
-    # initialize variables necessary for cortical ROIs dilation
-    # dimensions of the neighbourhood for rois labels assignment (choose odd dimensions!)
-    shape = (25, 25, 25)
-    center = np.array(shape) // 2
-    # dist: distances from the center of the neighbourhood
-    dist = np.zeros(shape, dtype='float32')
-    for x in range(shape[0]):
-        for y in range(shape[1]):
-            for z in range(shape[2]):
-                distxyz = center - [x, y, z]
-                dist[x, y, z] = math.sqrt(
-                    np.sum(np.multiply(distxyz, distxyz)))
-
-        # Check existence of tmp folder in input subject folder
-        this_dir = os.path.join(subject_dir, 'tmp')
-        if not (os.path.isdir(this_dir)):
-            os.makedirs(this_dir)
+    cortex = (asegd == 3) | (asegd == 42)
+
+    # half width of the neighbourhood for rois labels assignment
+    half_width = 12
+
+    # Check existence of tmp folder in input subject folder
+    this_dir = os.path.join(subject_dir, 'tmp')
+    if not (os.path.isdir(this_dir)):
+        os.makedirs(this_dir)
 
     # Loop over parcellation scales
     if v:  # pragma: no cover
@@ -2415,54 +2586,50 @@ def create_roi(subject_id, subjects_dir, v=True):
                     'ROIv_scale3_Lausanne2018.nii.gz', 'ROIv_scale4_Lausanne2018.nii.gz',
                     'ROIv_scale5_Lausanne2018.nii.gz']
 
-    FNULL = open(os.devnull, 'w')
+    # 1. Resample fsaverage CorticalSurface onto SUBJECT_ID CorticalSurface and map annotation of each scale
+    # 2. Generate Nifti volume from annotation of each scale
+    #    Note: change here --wmparc-dmax (FS default 5mm) to dilate cortical regions toward the WM
+    # The scales are independent until the relabeling, such that the FreeSurfer commands of all
+    # scales and hemispheres are run concurrently, highest resolution first
+    commands = {}
+    dependencies = {}
+    for i in reversed(list(range(0, nscales))):
+        for hemi, annot_files in [('lh', lh_annot_files), ('rh', rh_annot_files)]:
+            commands['mri_surf2surf_%s_scale%d' % (hemi, i + 1)] = (
+                fs_string + '; mri_surf2surf --srcsubject fsaverage --trgsubject %s --hemi %s --sval-annot %s --tval %s' % (
+                    subject_id,
+                    hemi,
+                    pkg_resources.resource_filename('cmtklib',
+                                                    op.join('data', 'parcellation', 'lausanne2018', annot_files[i])),
+                    os.path.join(subject_dir, 'label', annot_files[i])
+                )
+            )
+        commands['mri_aparc2aseg_scale%d' % (i + 1)] = (
+            fs_string + '; mri_aparc2aseg --s %s --annot %s --wmparc-dmax 0 --labelwm --hypo-as-wm --new-ribbon --o %s' % (
+                subject_id,
+                annot[i],
+                os.path.join(subject_dir, 'tmp', rois_output[i])
+            )
+        )
+        dependencies['mri_aparc2aseg_scale%d' % (i + 1)] = [
+            'mri_surf2surf_lh_scale%d' % (i + 1), 'mri_surf2surf_rh_scale%d' % (i + 1)
+        ]
+
+    if v:  # pragma: no cover
+        print('     > resample fsaverage CorticalSurface to individual CorticalSurface'
+              ' and generate Nifti volumes from annotations ({} threads)'.format(number_of_threads))
+    jobs = run_command_graph(commands, dependencies, number_of_threads=number_of_threads, v=v)
+    completed = set()
+    convert_commands = {}
 
     for i in reversed(list(range(0, nscales))):
 
         if v:  # pragma: no cover
             print(' ... working on multiscale parcellation, SCALE {}'.format(i + 1))
 
-        # 1. Resample fsaverage CorticalSurface onto SUBJECT_ID CorticalSurface and map annotation for current scale
-        # Left hemisphere
-        if v:  # pragma: no cover
-            print(
-                '     > resample fsaverage CorticalSurface to individual CorticalSurface')
-        mri_cmd = fs_string + '; mri_surf2surf --srcsubject fsaverage --trgsubject %s --hemi lh --sval-annot %s --tval %s' % (
-            subject_id,
-            pkg_resources.resource_filename('cmtklib',
-                                            op.join('data', 'parcellation', 'lausanne2018', lh_annot_files[i])),
-            os.path.join(subject_dir, 'label', lh_annot_files[i])
-        )
-        if v == 2:
-            subprocess.call(mri_cmd, shell=True)
-        else:
-            subprocess.call(mri_cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-
-        # Right hemisphere
-        mri_cmd = fs_string + '; mri_surf2surf --srcsubject fsaverage --trgsubject %s --hemi rh --sval-annot %s --tval %s' % (
-            subject_id,
-            pkg_resources.resource_filename('cmtklib',
-                                            op.join('data', 'parcellation', 'lausanne2018', rh_annot_files[i])),
-            os.path.join(subject_dir, 'label', rh_annot_files[i])
-        )
-        if v == 2:
-            subprocess.call(mri_cmd, shell=True)
-        else:
-            subprocess.call(mri_cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
-
-        # 2. Generate Nifti volume from annotation
-        #    Note: change here --wmparc-dmax (FS default 5mm) to dilate cortical regions toward the WM
-        if v:  # pragma: no cover
-            print('     > generate Nifti volume from annotation')
-        mri_cmd = fs_string + '; mri_aparc2aseg --s %s --annot %s --wmparc-dmax 0 --labelwm --hypo-as-wm --new-ribbon --o %s' % (
-            subject_id,
-            annot[i],
-            os.path.join(subject_dir, 'tmp', rois_output[i])
-        )
-        if v == 2:
-            subprocess.call(mri_cmd, shell=True)
-        else:
-            subprocess.call(mri_cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
+        # Wait for the Nifti volume of the current scale while the other commands keep running
+        while 'mri_aparc2aseg_scale%d' % (i + 1) not in completed:
+            completed.add(next(jobs)[0])
 
         # 3. Update numerical IDs of cortical and subcortical regions
         # Load Nifti volume
@@ -2481,37 +2648,25 @@ def create_roi(subject_id, subjects_dir, v=True):
         if i == (nscales - 1):
             print("     ... storing ROIs volume maximal resolution")
             roisMax = vol.copy()
-            idxMax = np.where(roisMax > 0)
-            xxMax = idxMax[0]
-            yyMax = idxMax[1]
-            zzMax = idxMax[2]
+            targets = cortex & (newrois == 0)
         # correct cortical surfaces using as reference the roisMax volume (for consistency between resolutions)
         else:
             print("     > adapt cortical surfaces")
 
-            idxRois = np.where(vol > 0)
-            xxRois = idxRois[0]
-            yyRois = idxRois[1]
-            zzRois = idxRois[2]
             # correct voxels labeled in current resolution, but not labeled in highest resolution
-            for j in range(xxRois.size):
-                if roisMax[xxRois[j], yyRois[j], zzRois[j]] == 0:
-                    newrois[xxRois[j], yyRois[j], zzRois[j]] = 0
+            newrois[roisMax == 0] = 0
+            # voxels not labeled in current resolution, but labeled in highest resolution,
+            # and the cortical voxels to dilate share the same nearest label assignment
+            targets = (cortex | (roisMax > 0)) & (newrois == 0)
+
+        # Nearest labels of the current resolution, computed once for both corrections
+        filled = newrois.copy()
+        filled[targets] = dilate_labels(vol, targets, half_width=half_width, mode=dilation_mode)
+
+        if i < (nscales - 1):
             # correct voxels not labeled in current resolution, but labeled in highest resolution
-            for j in range(xxMax.size):
-                if newrois[xxMax[j], yyMax[j], zzMax[j]] == 0:
-                    local = extract(vol, shape, position=(
-                        xxMax[j], yyMax[j], zzMax[j]), fill=0)
-                    mask = local.copy()
-                    mask[np.nonzero(local > 0)] = 1
-                    thisdist = np.multiply(dist, mask)
-                    thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
-                    value = np.int_(
-                        local[np.nonzero(thisdist == np.amin(thisdist))])
-                    if value.size > 1:
-                        counts = np.bincount(value)
-                        value = np.argmax(counts)
-                    newrois[xxMax[j], yyMax[j], zzMax[j]] = value
+            corrected = (roisMax > 0) & (newrois == 0)
+            newrois[corrected] = filled[corrected]
 
         if v:  # pragma: no cover
             print('     ... save output volumes')
@@ -2523,21 +2678,9 @@ def create_roi(subject_id, subjects_dir, v=True):
         # 4. Dilate cortical regions
         if v:  # pragma: no cover
             print("     > dilating cortical regions")
-        # loop throughout all the voxels belonging to the aseg GM volume
-        for j in range(xx.size):
-            if newrois[xx[j], yy[j], zz[j]] == 0:
-                local = extract(vol, shape, position=(
-                    xx[j], yy[j], zz[j]), fill=0)
-                mask = local.copy()
-                mask[np.nonzero(local > 0)] = 1
-                thisdist = np.multiply(dist, mask)
-                thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
-                value = np.int_(
-                    local[np.nonzero(thisdist == np.amin(thisdist))])
-                if value.size > 1:
-                    counts = np.bincount(value)
-                    value = np.argmax(counts)
-                newrois[xx[j], yy[j], zz[j]] = value
+        # all the unlabeled voxels belonging to the aseg GM volume
+        dilated = cortex & (newrois == 0)
+        newrois[dilated] = filled[dilated]
 
         # 5. Save Nifti and mgz volumes
         if v:  # pragma: no cover
@@ -2547,14 +2690,9 @@ def create_roi(subject_id, subjects_dir, v=True):
         ni.save(img, this_out)
         del img
 
-        mri_cmd = fs_string + '; mri_convert -i %s -o %s' % (
+        convert_commands['mri_convert_scale%d' % (i + 1)] = fs_string + '; mri_convert -i %s -o %s' % (
             this_out,
             os.path.join(subject_dir, 'mri', roivs_output[i][0:-4] + '.mgz'))
-        if v == 2:
-            _ = subprocess.call(mri_cmd, shell=True)
-        else:
-            _ = subprocess.call(
-                mri_cmd, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
 
         # Create Gray Matter mask
         if i == 0:
@@ -2570,6 +2708,11 @@ def create_roi(subject_id, subjects_dir, v=True):
             ni.save(img, out_mask)
             del img
 
+    for _ in jobs:
+        pass
+    for _ in run_command_graph(convert_commands, number_of_threads=number_of_threads, v=v):
+        pass
+
     mri_cmd = ['mri_convert', '-i', op.join(subject_dir, 'mri', 'ribbon.mgz'), '-o',
                op.join(subject_dir, 'mri', 'ribbon.nii.gz')]
     subprocess.check_call(mri_cmd)
@@ -2606,8 +2749,6 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
     fsmask = ni.load(op.join(fs_dir, 'mri', 'ribbon.nii.gz'))
     fsmaskd = fsmask.get_data()
 
-    wmmask = np.zeros(fsmask.get_data().shape)
-
     # these data is stored and could be extracted from fs_dir/stats/aseg.txt
 
     # FIXME understand when ribbon file has default value or has "aseg" value
@@ -2616,16 +2757,13 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
         iflogger.info("    > Extract right and left wm")
     # Ribbon labels by default
     if fsmaskd.max() == 120:
-        idx_lh = np.where(fsmaskd == 120)
-        idx_rh = np.where(fsmaskd == 20)
+        wm_labels = [120, 20]
     # Ribbon label w.r.t aseg label
     else:
-        idx_lh = np.where(fsmaskd == 41)
-        idx_rh = np.where(fsmaskd == 2)
+        wm_labels = [41, 2]
 
     # extract right and left
-    wmmask[idx_lh] = 1
-    wmmask[idx_rh] = 1
+    wmmask = apply_label_lut(fsmaskd, build_label_lut([(wm_labels, 1)], dtype=np.uint8))
 
     # remove subcortical nuclei from white matter mask
     if v:  # pragma: no cover
@@ -2642,10 +2780,29 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
     # need binary erosion function
     imerode = nd.binary_erosion
 
+    # masks of all the structures are extracted in one pass over the aseg volume
+    eroded_nuclei = [10, 11, 12, 49, 50, 51]
+    label_sets = {
+        # lateral ventricles, thalamus proper and caudate
+        # the latter two removed for better erosion, but put back afterwards
+        'csf_and_nuclei': [4, 43, 11, 50, 31, 63, 10, 49],
+        'thalamus_and_caudate': [11, 50, 10, 49],
+        # REST CSF, IE 3RD AND 4TH VENTRICULE
+        # and EXTRACEREBRAL CSF
+        # 43 ??, 4??  213?, 221?
+        # more to discuss.
+        'other_csf': [5, 14, 15, 24, 44, 72, 75, 76, 213, 221],
+        # grey nuclei without erosion
+        'grey_nuclei': [13, 17, 18, 26, 52, 53, 54, 58],
+        # remaining structure, e.g. brainstem
+        'remaining': [16],
+    }
+    for i in eroded_nuclei:
+        label_sets['nucleus_%d' % i] = [i]
+    masks = label_masks(asegd, label_sets)
+
     # ventricle erosion
     iflogger.info("    > Ventricle erosion")
-    csfA = np.zeros(asegd.shape)
-    csfB = np.zeros(asegd.shape)
 
     # structuring elements for erosion
     se1 = np.zeros((3, 3, 5))
@@ -2658,16 +2815,7 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
     se[1, 1, :] = 1
 
     # lateral ventricles, thalamus proper and caudate
-    # the latter two removed for better erosion, but put back afterwards
-    idx = np.where((asegd == 4) |
-                   (asegd == 43) |
-                   (asegd == 11) |
-                   (asegd == 50) |
-                   (asegd == 31) |
-                   (asegd == 63) |
-                   (asegd == 10) |
-                   (asegd == 49))
-    csfA[idx] = 1
+    csfA = masks['csf_and_nuclei'].astype(np.uint8)
 
     if v:  # pragma: no cover
         iflogger.info("    > Save CSF mask")
@@ -2679,29 +2827,11 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
 
     # thalamus proper and caudate are put back because
     # they are not lateral ventricles
-    idx = np.where((asegd == 11) |
-                   (asegd == 50) |
-                   (asegd == 10) |
-                   (asegd == 49))
-    csfA[idx] = 0
+    csfA[masks['thalamus_and_caudate']] = 0
 
     # REST CSF, IE 3RD AND 4TH VENTRICULE
     # and EXTRACEREBRAL CSF
-    # idx = np.where((asegd == 5) |
-    #                (asegd == 14) |
-    #                (asegd == 15) |
-    #                (asegd == 24) |
-    #                (asegd == 44) |
-    #                (asegd == 72) |
-    #                (asegd == 75) |
-    #                (asegd == 76) |
-    #                (asegd == 213) |
-    #                (asegd == 221))
-    # 43 ??, 4??  213?, 221?
-    # more to discuss.
-    for i in [5, 14, 15, 24, 44, 72, 75, 76, 213, 221]:
-        idx = np.where(asegd == i)
-        csfB[idx] = 1
+    csfB = masks['other_csf']
 
     # do not remove the subthalamic nucleus for now from the wm mask
     # 23, 60
@@ -2710,34 +2840,20 @@ def create_wm_mask(subject_id, subjects_dir, v=True):
     # grey nuclei, either with or without erosion
     if v:  # pragma: no cover
         iflogger.info("    > Grey nuclei, either with or without erosion")
-    gr_ncl = np.zeros(asegd.shape)
+    # without erosion
+    gr_ncl = masks['grey_nuclei'].copy()
 
     # with erosion
-    for i in [10, 11, 12, 49, 50, 51]:
-        idx = np.where(asegd == i)
-        # temporary volume
-        tmp = np.zeros(asegd.shape)
-        tmp[idx] = 1
-        tmp = imerode(tmp, se)
-        idx = np.where(tmp == 1)
-        gr_ncl[idx] = 1
-
-    # without erosion
-    for i in [13, 17, 18, 26, 52, 53, 54, 58]:
-        idx = np.where(asegd == i)
-        gr_ncl[idx] = 1
+    for i in eroded_nuclei:
+        gr_ncl |= imerode(masks['nucleus_%d' % i], se)
 
     # remove remaining structure, e.g. brainstem
     if v:  # pragma: no cover
         iflogger.info("    > Remove remaining structure, e.g. brainstem")
-    remaining = np.zeros(asegd.shape)
-    idx = np.where(asegd == 16)
-    remaining[idx] = 1
+    remaining = masks['remaining']
 
     # now remove all the structures from the white matter
-    idx = np.where((csfA != 0) | (csfB != 0) |
-                   (gr_ncl != 0) | (remaining != 0))
-    wmmask[idx] = 0
+    wmmask[csfA | csfB | gr_ncl | remaining] = 0
     if v:  # pragma: no cover
         iflogger.info(
             "    > Removing lateral ventricles and eroded grey nuclei and brainstem from white matter mask")
@@ -2941,10 +3057,7 @@ def generate_WM_and_GM_mask(subject_id, subjects_dir):
 
     print("wm_labels mask....")
     # %% create wm_labels mask
-    nii_wm = np.zeros(nii_apar_cdata.shape, dtype=np.uint8)
-
-    for i in wm_labels:
-        nii_wm[nii_apar_cdata == i] = 1
+    nii_wm = apply_label_lut(nii_apar_cdata, build_label_lut([(wm_labels, 1)], dtype=np.uint8))
 
     # we do not add subcortical regions
     #    for i in SUBCORTICAL[1]:
@@ -2959,15 +3072,15 @@ def generate_WM_and_GM_mask(subject_id, subjects_dir):
     print("GM mask....")
     # %% create GM parcellation (CORTICAL+SUBCORTICAL)
     # %  -------------------------------------
+    # aparc+aseg labels are remapped in one pass with a lookup table
+    nii_gm = apply_label_lut(
+        nii_apar_cdata, build_label_lut({ma[1]: ma[0] for ma in mapping}, dtype=np.uint8)
+    )
+
     for park in list(get_parcellation('NativeFreesurfer').keys()):
         print("Parcellation: " + park)
         gm_out = op.join(fs_dir, 'mri', 'ROIv_%s.nii.gz' % park)
 
-        nii_gm = np.zeros(nii_apar_cdata.shape, dtype=np.uint8)
-
-        for ma in mapping:
-            nii_gm[nii_apar_cdata == ma[1]] = ma[0]
-
         #        # % 33 cortical regions (stored in the order of "parcel33")
         #        for idx,i in enumerate(CORTICAL[1]):
         #            nii_gm[ nii_apar_cdata == (2000+i)] = CORTICAL[2][idx] # RIGHT
@@ -3007,16 +3120,9 @@ def generate_WM_and_GM_mask(subject_id, subjects_dir):
 
     asegfile = op.join(fs_dir, 'mri', 'aseg.nii.gz')
     aseg = ni.load(asegfile).get_data().astype(np.uint32)
-    idx = np.where((aseg == 4) |
-                   (aseg == 43) |
-                   (aseg == 11) |
-                   (aseg == 50) |
-                   (aseg == 31) |
-                   (aseg == 63) |
-                   (aseg == 10) |
-                   (aseg == 49))
-    er_mask = np.zeros(aseg.shape)
-    er_mask[idx] = 1
+    er_mask = apply_label_lut(
+        aseg, build_label_lut([([4, 43, 11, 50, 31, 63, 10, 49], 1)], dtype=np.uint8)
+    )
     img = ni.Nifti1Image(er_mask, ni.load(
         asegfile).get_affine(), ni.load(asegfile).get_header())
     ni.save(img, op.join(fs_dir, 'mri', 'csf_mask.nii.gz'))
@@ -180,9 +180,137 @@ def return_button_style_sheet(image, image_disabled=None, verbose=False):  # pra
     return button_style_sheet
 
 
+def _streamline_segment_lengths(points, offsets):
+    """Return the length of the segment starting at each point of a set of concatenated streamlines.
+
+    The last point of each streamline has a segment of length 0.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    counts = np.diff(offsets)
+    dists = np.zeros(points.shape[0])
+    if points.shape[0] > 1:
+        dists[:-1] = np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+    # Remove the segments joining two consecutive streamlines
+    dists[np.asarray(offsets[1:])[counts > 0] - 1] = 0
+    return dists
+
+
+def streamline_lengths(points, offsets):
+    """Euclidean length of a set of streamlines.
+
+    Parameters
+    ----------
+    points : array-like shape (N,3)
+        Points of all the streamlines concatenated (nibabel ``ArraySequence`` layout)
+
+    offsets : array-like shape (M+1,)
+        The points of streamline `i` are ``points[offsets[i]:offsets[i + 1]]``
+
+    Returns
+    -------
+    L : array shape (M,)
+        Length of each streamline (0 for streamlines with less than 2 points)
+
+    Examples
+    --------
+    >>> points = np.array([[1,1,1],[2,3,4],[0,0,0],[0,0,0],[0,0,1]])
+    >>> np.allclose(streamline_lengths(points, [0, 3, 5]), [length(points[:3]), 1])
+    True
+    """
+    offsets = np.asarray(offsets)
+    counts = np.diff(offsets)
+    lengths = np.zeros(len(counts))
+    nonempty = counts > 0
+    if np.any(nonempty):
+        lengths[nonempty] = np.add.reduceat(
+            _streamline_segment_lengths(points, offsets), offsets[:-1][nonempty]
+        )
+    return lengths
+
+
+def streamline_cumulative_lengths(points, offsets):
+    """Cumulative length along a set of streamlines.
+
+    Parameters
+    ----------
+    points : array-like shape (N,3)
+        Points of all the streamlines concatenated (nibabel ``ArraySequence`` layout)
+
+    offsets : array-like shape (M+1,)
+        The points of streamline `i` are ``points[offsets[i]:offsets[i + 1]]``
+
+    Returns
+    -------
+    L : array shape (N,)
+        Length from the first point of its streamline to each point
+    """
+    offsets = np.asarray(offsets)
+    counts = np.diff(offsets)
+    dists = _streamline_segment_lengths(points, offsets)
+    cumulative = np.zeros(dists.shape[0])
+    cumulative[1:] = np.cumsum(dists[:-1])
+    nonempty = counts > 0
+    return cumulative - np.repeat(cumulative[offsets[:-1][nonempty]], counts[nonempty])
+
+
+def _streamline_gradient(values, offsets):
+    """Gradient along a set of concatenated streamlines as computed by ``np.gradient`` for each of them."""
+    offsets = np.asarray(offsets)
+    counts = np.diff(offsets)
+    gradient = np.full(values.shape, np.nan)
+    gradient[1:-1] = (values[2:] - values[:-2]) / 2.0
+    # One-sided differences at the extremities of each streamline
+    first = offsets[:-1][counts > 1]
+    last = offsets[1:][counts > 1] - 1
+    gradient[first] = values[first + 1] - values[first]
+    gradient[last] = values[last] - values[last - 1]
+    # Gradient is not defined for streamlines with a single point
+    gradient[offsets[:-1][counts == 1]] = np.nan
+    return gradient
+
+
+def streamline_mean_curvature(points, offsets):
+    """Calculates the mean curvature of a set of streamlines.
+
+    Parameters
+    ----------
+    points : array-like shape (N,3)
+        Points of all the streamlines concatenated (nibabel ``ArraySequence`` layout)
+
+    offsets : array-like shape (M+1,)
+        The points of streamline `i` are ``points[offsets[i]:offsets[i + 1]]``
+
+    Returns
+    -------
+    m : array shape (M,)
+        Mean curvature of each streamline (`nan` for streamlines
+        with less than 2 points)
+    """
+    points = np.asarray(points, dtype=np.float64)
+    offsets = np.asarray(offsets)
+    counts = np.diff(offsets)
+
+    dxyz = _streamline_gradient(points, offsets)
+    ddxyz = _streamline_gradient(dxyz, offsets)
+
+    # Curvature
+    k = magn(np.cross(dxyz, ddxyz), 1)[:, 0] / (magn(dxyz, 1)[:, 0] ** 3)
+
+    curvature = np.full(len(counts), np.nan)
+    nonempty = counts > 0
+    if np.any(nonempty):
+        curvature[nonempty] = (
+            np.add.reduceat(k, offsets[:-1][nonempty]) / counts[nonempty]
+        )
+    return curvature
+
+
 def length(xyz, along=False):
     """Euclidean length of track line.
 
+    Thin wrapper around :func:`streamline_lengths` and
+    :func:`streamline_cumulative_lengths` for a single track.
+
     Parameters
     ----------
     xyz : array-like shape (N,3)
@@ -202,7 +330,7 @@ def length(xyz, along=False):
     --------
     >>> xyz = np.array([[1,1,1],[2,3,4],[0,0,0]])
     >>> expected_lens = np.sqrt([1+2**2+3**2, 2**2+3**2+4**2])
-    >>> length(xyz) == expected_lens.sum()
+    >>> np.allclose(length(xyz), expected_lens.sum())
     True
     >>> len_along = length(xyz, along=True)
     >>> np.allclose(len_along, expected_lens.cumsum())
@@ -219,10 +347,10 @@ def length(xyz, along=False):
         if along:
             return np.array([0])
         return 0
-    dists = np.sqrt((np.diff(xyz, axis=0) ** 2).sum(axis=1))
+    offsets = np.array([0, xyz.shape[0]])
     if along:
-        return np.cumsum(dists)
-    return np.sum(dists)
+        return streamline_cumulative_lengths(xyz, offsets)[1:]
+    return streamline_lengths(xyz, offsets)[0]
 
 
 def magn(xyz, n=1):
@@ -248,6 +376,8 @@ def magn(xyz, n=1):
 def mean_curvature(xyz):
     """Calculates the mean curvature of a curve.
 
+    Thin wrapper around :func:`streamline_mean_curvature` for a single curve.
+
     Parameters
     ------------
     xyz : array-like shape (N,3)
@@ -280,14 +410,10 @@ def mean_curvature(xyz):
     n_pts = xyz.shape[0]
     if n_pts == 0:
         raise ValueError("xyz array cannot be empty")
+    if n_pts < 2:
+        raise ValueError("xyz array must have at least 2 points")
 
-    dxyz = np.gradient(xyz)[0]
-    ddxyz = np.gradient(dxyz)[0]
-
-    # Curvature
-    k = magn(np.cross(dxyz, ddxyz), 1) / (magn(dxyz, 1) ** 3)
-
-    return np.mean(k)
+    return streamline_mean_curvature(xyz, np.array([0, n_pts]))[0]
 
 
 def extract_freesurfer_subject_dir(reconall_report, local_output_dir=None, debug=False):
@@ -0,0 +1,79 @@
+"""Tests of the concurrent execution of FreeSurfer commands by `cmtklib.parcellation.run_command_graph` with stub executables."""
+
+import os
+import stat
+
+import pytest
+
+from cmtklib.parcellation import run_command_graph
+
+
+def _stub_executable(tmp_path):
+    """Create a stub of a FreeSurfer executable that logs its start and end times."""
+    stub = tmp_path / "stub_fs_command"
+    stub.write_text(
+        "#!/bin/sh\n"
+        'echo "start $1 $(date +%s.%N)" >> "$2"\n'
+        "sleep $3\n"
+        'echo "end $1 $(date +%s.%N)" >> "$2"\n'
+        "exit $4\n"
+    )
+    stub.chmod(stub.stat().st_mode | stat.S_IEXEC)
+    return str(stub)
+
+
+def _read_log(log):
+    times = {}
+    with open(log) as f:
+        for line in f:
+            event, name, t = line.split()
+            times.setdefault(name, {})[event] = float(t)
+    return times
+
+
+def _max_overlap(times):
+    events = sorted(
+        [(t["start"], 1) for t in times.values()] + [(t["end"], -1) for t in times.values()]
+    )
+    running = overlap = 0
+    for _, delta in events:
+        running += delta
+        overlap = max(overlap, running)
+    return overlap
+
+
+@pytest.mark.skipif(os.name != "posix", reason="Stub executables are shell scripts")
+def test_commands_run_concurrently_within_thread_limit(tmp_path):
+    stub, log = _stub_executable(tmp_path), str(tmp_path / "log.txt")
+    commands = {
+        "cmd%d" % i: "%s cmd%d %s 0.3 0" % (stub, i, log) for i in range(6)
+    }
+    completed = list(run_command_graph(commands, number_of_threads=3))
+
+    assert sorted(name for name, _, _ in completed) == sorted(commands)
+    assert all(returncode == 0 and elapsed >= 0.3 for _, returncode, elapsed in completed)
+    assert 1 < _max_overlap(_read_log(log)) <= 3
+
+
+@pytest.mark.skipif(os.name != "posix", reason="Stub executables are shell scripts")
+def test_dependent_commands_wait_for_their_dependencies(tmp_path):
+    stub, log = _stub_executable(tmp_path), str(tmp_path / "log.txt")
+    commands = {
+        "aparc2aseg": "%s aparc2aseg %s 0.1 0" % (stub, log),
+        "surf2surf_lh": "%s surf2surf_lh %s 0.3 0" % (stub, log),
+        "surf2surf_rh": "%s surf2surf_rh %s 0.1 2" % (stub, log),
+    }
+    dependencies = {"aparc2aseg": ["surf2surf_lh", "surf2surf_rh"]}
+    completed = list(run_command_graph(commands, dependencies, number_of_threads=4))
+
+    assert [name for name, _, _ in completed][-1] == "aparc2aseg"
+    assert dict((name, returncode) for name, returncode, _ in completed)["surf2surf_rh"] == 2
+    times = _read_log(log)
+    assert times["aparc2aseg"]["start"] >= max(
+        times["surf2surf_lh"]["end"], times["surf2surf_rh"]["end"]
+    )
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError):
+        list(run_command_graph({"a": "true"}, {"a": ["b"]}))
@@ -0,0 +1,119 @@
+"""Regression tests of the grouped edge aggregation of `cmtklib.connectome` against the former per-edge processing of `cmat`."""
+
+import warnings
+
+import networkx as nx
+import numpy as np
+
+from cmtklib.connectome import aggregate_edge_metrics
+
+
+def _legacy_edge_metrics(final_fiberlabels_array, final_fiberlength_array, roi_volume, node_ids):
+    """Per-edge ``np.where`` scans formerly run by `cmat`."""
+    G = nx.Graph()
+    for u in node_ids:
+        G.add_node(int(u))
+        G.nodes[int(u)]["roi_volume"] = roi_volume[u]
+    for i, (startROI, endROI) in enumerate(final_fiberlabels_array):
+        if G.has_edge(startROI, endROI):
+            G[startROI][endROI]["fiblist"].append(i)
+        else:
+            G.add_edge(startROI, endROI, fiblist=[i])
+
+    total_fibers = 0
+    total_volume = 0
+    u_old = -1
+    for u, v, d in G.edges(data=True):
+        total_fibers += len(d["fiblist"])
+        if u != u_old:
+            total_volume += G.nodes[int(u)]["roi_volume"]
+        u_old = u
+
+    metrics = {}
+    for u, v, d in G.edges(data=True):
+        di = {"number_of_fibers": len(G[u][v]["fiblist"])}
+        if u <= v:
+            idx = np.where(
+                (final_fiberlabels_array[:, 0] == int(u))
+                & (final_fiberlabels_array[:, 1] == int(v))
+            )[0]
+        else:
+            idx = np.where(
+                (final_fiberlabels_array[:, 0] == int(v))
+                & (final_fiberlabels_array[:, 1] == int(u))
+            )[0]
+
+        with warnings.catch_warnings():
+            # Edges whose fibers all have NaN lengths
+            warnings.simplefilter("ignore", RuntimeWarning)
+            di["fiber_length_mean"] = float(np.nanmean(final_fiberlength_array[idx]))
+            di["fiber_length_median"] = float(np.nanmedian(final_fiberlength_array[idx]))
+            di["fiber_length_std"] = float(np.nanstd(final_fiberlength_array[idx]))
+        di["fiber_proportion"] = float(
+            100.0 * (di["number_of_fibers"] / float(total_fibers))
+        )
+        pair_volume = G.nodes[int(u)]["roi_volume"] + G.nodes[int(v)]["roi_volume"]
+        if di["fiber_length_mean"] > 0.0:
+            di["fiber_density"] = float(
+                (float(di["number_of_fibers"]) / float(di["fiber_length_mean"]))
+                * float(2.0 / pair_volume)
+            )
+            di["normalized_fiber_density"] = float(
+                (
+                    (float(di["number_of_fibers"]) / float(total_fibers))
+                    / float(di["fiber_length_mean"])
+                )
+                * ((2.0 * float(total_volume)) / pair_volume)
+            )
+        else:
+            di["fiber_density"] = 0.0
+            di["normalized_fiber_density"] = 0.0
+        metrics[(min(u, v), max(u, v))] = di
+    return metrics
+
+
+def _synthetic_fibers(n_fibers=3000, n_rois=25):
+    """Sorted fiber labels with self-connections and NaN lengths, and shuffled node labels."""
+    rng = np.random.RandomState(0)
+    labels = rng.randint(1, n_rois + 1, size=(n_fibers, 2))
+    labels.sort(axis=1)
+    lengths = rng.rand(n_fibers) * 100.0
+    lengths[rng.rand(n_fibers) < 0.1] = np.nan
+    # An edge whose fibers all have undefined lengths
+    labels[:4] = [2, 5]
+    lengths[(labels[:, 0] == 2) & (labels[:, 1] == 5)] = np.nan
+    roi_volume = rng.randint(1, 500, size=n_rois + 1).astype(np.int64)
+    node_ids = list(rng.permutation(np.arange(1, n_rois + 1)))
+    return labels.astype(np.int32), lengths, roi_volume, node_ids
+
+
+def test_matches_legacy_edge_metrics():
+    labels, lengths, roi_volume, node_ids = _synthetic_fibers()
+    legacy = _legacy_edge_metrics(labels, lengths, roi_volume, node_ids)
+
+    edges, metrics, fiber_order, edge_offsets = aggregate_edge_metrics(
+        labels, lengths, roi_volume, node_ids
+    )
+    assert sorted(legacy.keys()) == [tuple(edge) for edge in edges]
+    for i, edge in enumerate(edges):
+        di = legacy[tuple(edge)]
+        for key, expected in di.items():
+            assert np.isclose(metrics[key][i], expected, equal_nan=True), (edge, key)
+        fibers = fiber_order[edge_offsets[i]:edge_offsets[i + 1]]
+        assert np.all(labels[fibers] == edge)
+
+    nan_edge = np.flatnonzero((edges[:, 0] == 2) & (edges[:, 1] == 5))[0]
+    assert np.isnan(metrics["fiber_length_mean"][nan_edge])
+    assert metrics["fiber_density"][nan_edge] == 0.0
+    assert metrics["normalized_fiber_density"][nan_edge] == 0.0
+
+
+def test_total_volume_follows_node_order():
+    labels, lengths, roi_volume, _ = _synthetic_fibers(n_fibers=40, n_rois=8)
+    for node_ids in [list(range(1, 9)), list(range(8, 0, -1)), [5, 2, 8, 1, 7, 3, 6, 4]]:
+        legacy = _legacy_edge_metrics(labels, lengths, roi_volume, node_ids)
+        edges, metrics, _, _ = aggregate_edge_metrics(labels, lengths, roi_volume, node_ids)
+        expected = np.array(
+            [legacy[tuple(edge)]["normalized_fiber_density"] for edge in edges]
+        )
+        assert np.allclose(metrics["normalized_fiber_density"], expected)
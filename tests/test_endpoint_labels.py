@@ -0,0 +1,86 @@
+"""Regression tests of the batched endpoint labeling of `cmtklib.connectome` against the former per-fiber loop of `cmat`."""
+
+import numpy as np
+
+from cmtklib.connectome import filter_fiber_labels, label_fiber_endpoints
+
+
+def _legacy_fiber_labels(endpoints, roiData, nROIs):
+    """Per-fiber labeling formerly run by `cmat` for one resolution."""
+    n = endpoints.shape[0]
+    fiberlabels = np.zeros((n, 2))
+    final_fiberlabels = []
+    for i in range(n):
+        try:
+            startvox = [int(c) for c in endpoints[i, 0]]
+            endvox = [int(c) for c in endpoints[i, 1]]
+
+            startROI = int(roiData[startvox[0], startvox[1], startvox[2]])
+            endROI = int(roiData[endvox[0], endvox[1], endvox[2]])
+        except IndexError:
+            continue
+
+        if startROI == 0 or endROI == 0:
+            fiberlabels[i, 0] = -1
+            continue
+
+        if startROI > nROIs or endROI > nROIs:
+            continue
+
+        if endROI < startROI:
+            tmp = startROI
+            startROI = endROI
+            endROI = tmp
+
+        fiberlabels[i, 0] = startROI
+        fiberlabels[i, 1] = endROI
+
+        final_fiberlabels.append([startROI, endROI])
+
+    return (
+        np.array(fiberlabels, dtype=np.int32),
+        np.array(final_fiberlabels, dtype=np.int32).reshape(-1, 2),
+    )
+
+
+def _synthetic_data(n_fibers=2000):
+    """Endpoints partly outside the volumes and ROI volumes of two grids with labels above the number of regions."""
+    rng = np.random.RandomState(0)
+    shapes = [(12, 10, 9), (12, 10, 9), (7, 11, 8)]
+    n_rois = [10, 30, 5]
+    roi_volumes = [
+        rng.randint(0, n + 3, size=shape).astype(np.int16)
+        for shape, n in zip(shapes, n_rois)
+    ]
+    endpoints = rng.rand(n_fibers, 2, 3) * np.array([13.0, 12.0, 10.0])
+    return endpoints, roi_volumes, n_rois
+
+
+def test_matches_legacy_labels():
+    endpoints, roi_volumes, n_rois = _synthetic_data()
+    endpoint_labels, inside = label_fiber_endpoints(endpoints, roi_volumes)
+
+    for roi_data, nROIs, labels, vox_inside in zip(roi_volumes, n_rois, endpoint_labels, inside):
+        legacy_fiberlabels, legacy_final = _legacy_fiber_labels(endpoints, roi_data, nROIs)
+        fiberlabels, valid, orphans, outside, overflow = filter_fiber_labels(
+            labels, vox_inside, nROIs
+        )
+        # Outputs saved as filtered_fiberslabel_*.npy and final_fiberlabels_*.npy
+        assert np.array_equal(np.array(fiberlabels, dtype=np.int32), legacy_fiberlabels)
+        assert np.array_equal(np.array(fiberlabels[valid], dtype=np.int32), legacy_final)
+        assert np.count_nonzero(orphans) == np.count_nonzero(legacy_fiberlabels[:, 0] == -1)
+        assert np.any(outside) and np.any(overflow)
+
+
+def test_negative_indices_are_outside():
+    roi_data = np.ones((4, 4, 4), dtype=np.int16)
+    endpoints = np.array(
+        [
+            [[0.5, 1.0, 2.0], [3.0, 3.0, 3.0]],
+            [[-1.5, 1.0, 2.0], [3.0, 3.0, 3.0]],
+            [[0.5, 1.0, 2.0], [3.0, 4.0, 3.0]],
+        ]
+    )
+    endpoint_labels, inside = label_fiber_endpoints(endpoints, [roi_data])
+    assert np.array_equal(inside[0], [True, False, False])
+    assert np.array_equal(endpoint_labels[0], [[1, 1], [0, 1], [1, 0]])
@@ -0,0 +1,67 @@
+"""Tests of the in-process morphology of `cmtklib.morphology` against brute-force definitions of the `fslmaths` filters."""
+
+import numpy as np
+
+from cmtklib.morphology import (
+    box_kernel,
+    dilate,
+    gaussian_smooth,
+    modal_dilate,
+    sphere_kernel,
+)
+
+
+def test_kernels():
+    assert sphere_kernel(1.0, (1.0, 1.0, 1.0)).sum() == 7
+    assert sphere_kernel(5, (1.0, 1.0, 1.0)).shape == (11, 11, 11)
+    assert sphere_kernel(2.0, (1.0, 1.0, 2.0)).shape == (5, 5, 3)
+    assert box_kernel(3.0, (1.0, 1.0, 2.0)).shape == (3, 3, 1)
+
+
+def test_modal_dilate():
+    rng = np.random.RandomState(0)
+    data = rng.choice([0, 0, 0, 0, 3, 7], size=(12, 10, 8)).astype(np.float32)
+    kernel = sphere_kernel(1.5, (1.0, 1.0, 1.0))
+    center = np.array(kernel.shape) // 2
+    dilated = modal_dilate(data, kernel, chunk_size=50)
+
+    for x, y, z in np.ndindex(data.shape):
+        if data[x, y, z] != 0:
+            assert dilated[x, y, z] == data[x, y, z]
+            continue
+        values = [
+            data[tuple(p)]
+            for p in np.transpose(np.nonzero(kernel)) - center + [x, y, z]
+            if np.all(p >= 0) and np.all(p < data.shape) and data[tuple(p)] != 0
+        ]
+        if not values:
+            assert dilated[x, y, z] == 0
+            continue
+        labels, counts = np.unique(values, return_counts=True)
+        assert dilated[x, y, z] == labels[np.argmax(counts)]
+
+    mask = data > 0
+    assert np.array_equal(dilate(mask, kernel), modal_dilate(mask.astype(np.uint8), kernel) > 0)
+
+
+def test_gaussian_smooth():
+    rng = np.random.RandomState(0)
+    data = rng.rand(9, 8, 7)
+    voxel_size = (1.0, 1.5, 2.0)
+    sigma = 2.0 / 2.3548
+    smoothed = gaussian_smooth(data, voxel_size, sigma=sigma)
+
+    # Kernel-weighted mean over the voxels inside the image
+    half_width = [int(np.ceil(4.0 * sigma / d)) for d in voxel_size]
+    for x, y, z in [(0, 0, 0), (4, 3, 3), (8, 7, 6), (2, 6, 1)]:
+        total = weight = 0.0
+        for dx, dy, dz in np.ndindex(*[2 * n + 1 for n in half_width]):
+            offset = np.array([dx, dy, dz]) - half_width
+            p = np.array([x, y, z]) + offset
+            if np.all(p >= 0) and np.all(p < data.shape):
+                w = np.exp(-np.sum(np.square(offset * voxel_size)) / (2 * sigma ** 2))
+                total += w * data[tuple(p)]
+                weight += w
+        assert np.isclose(smoothed[x, y, z], total / weight)
+
+    assert np.allclose(gaussian_smooth(np.ones((5, 5, 5)), voxel_size, fwhm=2.0), 1.0)
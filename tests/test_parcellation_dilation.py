@@ -0,0 +1,65 @@
+"""Regression tests of the distance-transform dilation of `cmtklib.parcellation` against the former voxel-wise loop."""
+
+import numpy as np
+
+from cmtklib.parcellation import dilate_labels, extract
+
+
+def _legacy_dilation(vol, targets, shape=(25, 25, 25)):
+    """Voxel-wise neighbourhood search formerly run by `create_roi()`."""
+    center = np.array(shape) // 2
+    grid = np.indices(shape).reshape(3, -1).T
+    dist = np.sqrt(np.sum((grid - center) ** 2, axis=1)).reshape(shape).astype("float32")
+    values = []
+    for x, y, z in zip(*np.nonzero(targets)):
+        local = extract(vol, shape, position=(x, y, z), fill=0)
+        mask = local.copy()
+        mask[np.nonzero(local > 0)] = 1
+        thisdist = np.multiply(dist, mask)
+        thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
+        value = np.int_(local[np.nonzero(thisdist == np.amin(thisdist))])
+        if value.size > 1:
+            counts = np.bincount(value)
+            value = np.argmax(counts)
+        values.append(int(np.ravel(value)[0]))
+    return np.array(values)
+
+
+def _synthetic_parcellation():
+    """Shell of labeled parcels with holes, and unlabeled and labeled voxels to fill."""
+    rng = np.random.RandomState(0)
+    shape = (30, 28, 26)
+    grid = np.indices(shape).astype(float)
+    radius = np.sqrt(np.sum((grid - (np.array(shape) / 2.0)[:, None, None, None]) ** 2, axis=0))
+    shell = (radius > 6) & (radius < 10)
+    # Parcels as octants of the shell with a few random labels for ties
+    vol = 1 + (grid[0] > shape[0] / 2) + 2 * (grid[1] > shape[1] / 2) + 4 * (grid[2] > shape[2] / 2)
+    vol = (vol * 1000 + rng.randint(0, 3, size=shape)).astype(np.int32)
+    vol[~shell] = 0
+    vol[rng.rand(*shape) < 0.3] = 0
+    # Unlabeled voxels and labeled voxels (whose own label is ignored) around the parcels
+    targets = (radius > 4) & (radius < 13) & ((vol == 0) | (rng.rand(*shape) < 0.05))
+    return vol, targets
+
+
+def test_vote_mode_matches_legacy_loop():
+    vol, targets = _synthetic_parcellation()
+    values = dilate_labels(vol, targets, half_width=12, mode="vote")
+    assert np.array_equal(values, _legacy_dilation(vol, targets))
+
+
+def test_nearest_mode_assigns_a_nearest_label():
+    vol, targets = _synthetic_parcellation()
+    values = dilate_labels(vol, targets, half_width=12, mode="nearest")
+    legacy = _legacy_dilation(vol, targets)
+    # Labels may only differ between equidistant labeled voxels
+    assert np.all((values > 0) == (legacy > 0))
+    assert np.mean(values == legacy) > 0.8
+
+
+def test_no_label_in_neighbourhood():
+    vol = np.zeros((30, 30, 30), dtype=np.int32)
+    vol[0, 0, 0] = 5
+    targets = np.zeros(vol.shape, dtype=bool)
+    targets[1, 1, 1] = targets[29, 29, 29] = True
+    assert np.array_equal(dilate_labels(vol, targets), [5, 0])
@@ -0,0 +1,70 @@
+"""Parity tests between the batched streamline geometry kernels of `cmtklib.util` and per-streamline computations."""
+
+import numpy as np
+
+from cmtklib.util import (
+    length,
+    mean_curvature,
+    streamline_lengths,
+    streamline_cumulative_lengths,
+    streamline_mean_curvature,
+)
+
+
+def _reference_length(xyz, along=False):
+    dists = np.sqrt((np.diff(xyz, axis=0) ** 2).sum(axis=1))
+    if along:
+        return np.cumsum(dists)
+    return np.sum(dists)
+
+
+def _reference_mean_curvature(xyz):
+    def _magn(v):
+        mag = np.sum(v ** 2, axis=1) ** 0.5
+        mag[mag == 0] = np.finfo(float).eps
+        return mag
+
+    dxyz = np.gradient(xyz)[0]
+    ddxyz = np.gradient(dxyz)[0]
+    return np.mean(_magn(np.cross(dxyz, ddxyz)) / (_magn(dxyz) ** 3))
+
+
+def _random_streamlines(n_points):
+    rng = np.random.RandomState(42)
+    streamlines = [np.cumsum(rng.randn(n, 3), axis=0) for n in n_points]
+    offsets = np.concatenate(([0], np.cumsum(n_points)))
+    return streamlines, np.concatenate(streamlines), offsets
+
+
+def test_streamline_lengths():
+    streamlines, points, offsets = _random_streamlines([2, 3, 10, 1, 0, 57, 2])
+    lengths = streamline_lengths(points, offsets)
+    cumulative = streamline_cumulative_lengths(points, offsets)
+    for i, xyz in enumerate(streamlines):
+        if len(xyz) < 2:
+            assert lengths[i] == 0
+            continue
+        assert np.isclose(lengths[i], _reference_length(xyz))
+        assert np.isclose(length(xyz), _reference_length(xyz))
+        assert cumulative[offsets[i]] == 0
+        assert np.allclose(
+            cumulative[offsets[i] + 1:offsets[i + 1]], _reference_length(xyz, along=True)
+        )
+        assert np.allclose(length(xyz, along=True), _reference_length(xyz, along=True))
+
+
+def test_streamline_mean_curvature():
+    streamlines, points, offsets = _random_streamlines([2, 3, 10, 1, 0, 57, 2])
+    curvatures = streamline_mean_curvature(points, offsets)
+    for i, xyz in enumerate(streamlines):
+        if len(xyz) < 2:
+            assert np.isnan(curvatures[i])
+            continue
+        assert np.isclose(curvatures[i], _reference_mean_curvature(xyz))
+        assert np.isclose(mean_curvature(xyz), _reference_mean_curvature(xyz))
+
+
+def test_straight_line_has_zero_curvature():
+    x = np.linspace(0, 1, 100)
+    xyz = np.vstack((x, 0 * x, 0 * x)).T
+    assert np.isclose(mean_curvature(xyz), 0)
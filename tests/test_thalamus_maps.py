@@ -0,0 +1,80 @@
+"""Regression tests of the streaming correction of thalamic nuclei maps of `cmtklib.parcellation` against the former in-memory processing."""
+
+import numpy as np
+
+from cmtklib.parcellation import correct_thalamic_nuclei_maps
+
+
+def _legacy_processing(img_data_vspams, img_data_jacob, img_data_thal, thresh=0.05):
+    """Processing of the registered maps formerly run by `ParcellateThalamus`."""
+    img_data_vspams = img_data_vspams.copy()
+    img_data_vspams[img_data_vspams < 0] = 0
+    img_data_vspams[img_data_vspams > 1] = 1
+
+    img_data_spams = img_data_vspams.copy()
+    img_data_spams[img_data_spams < thresh] = 0
+    ind = np.where(np.sum(img_data_spams, axis=3) == 0)
+    max_prob_ants = img_data_spams.argmax(axis=3) + 1
+    max_prob_ants[ind] = 0
+
+    img_data_spams = np.zeros(img_data_vspams.shape)
+    for nuc in np.arange(img_data_vspams.shape[3]):
+        t = np.multiply(img_data_vspams[:, :, :, nuc], img_data_jacob)
+        img_data_spams[:, :, :, nuc] = t / t.max()
+    img_data_spams[img_data_spams < thresh] = 0
+    ind = np.where(np.sum(img_data_spams, axis=3) == 0)
+    max_prob_jacobian = img_data_spams.argmax(axis=3) + 1
+    max_prob_jacobian[ind] = 0
+
+    half = int(img_data_spams.shape[3] / 2)
+    img_data_spam_lh = img_data_spams[:, :, :, :half] * (img_data_thal == 1)[..., np.newaxis]
+    ind = np.where(np.sum(img_data_spam_lh, axis=3) == 0)
+    max_prob_l = np.argmax(img_data_spam_lh, axis=3) + 1
+    max_prob_l[ind] = 0
+
+    img_data_spam_rh = img_data_spams[:, :, :, half:] * (img_data_thal == 2)[..., np.newaxis]
+    ind = np.where(np.sum(img_data_spam_rh, axis=3) == 0)
+    indr = np.where(img_data_thal == 2)
+    max_prob_r = np.argmax(img_data_spam_rh, axis=3) + 1
+    max_prob_r[indr] = max_prob_r[indr] + half
+    max_prob_r[ind] = 0
+
+    img_data_spams[:, :, :, :half] = img_data_spam_lh
+    img_data_spams[:, :, :, half:] = img_data_spam_rh
+    return max_prob_ants, max_prob_jacobian, max_prob_l + max_prob_r, img_data_spams
+
+
+def _synthetic_maps():
+    """Noisy probability maps of 8 nuclei with out-of-range values, and a two-sided thalamus mask."""
+    rng = np.random.RandomState(0)
+    shape = (24, 20, 30)
+    spams = (rng.rand(*shape, 8) * 1.3 - 0.2).astype(np.float32)
+    spams[rng.rand(*shape) < 0.2] = 0
+    jacobian = (0.5 + rng.rand(*shape)).astype(np.float32)
+    thalamus = np.zeros(shape, dtype=np.uint16)
+    thalamus[4:10, 5:15, 7:19] = 1
+    thalamus[13:20, 6:14, 9:21] = 2
+    thalamus[rng.rand(*shape) < 0.1] = 0
+    return spams, jacobian, thalamus
+
+
+def test_matches_legacy_processing():
+    spams, jacobian, thalamus = _synthetic_maps()
+    legacy = _legacy_processing(spams, jacobian, thalamus)
+    corrected = spams.copy()
+    results = correct_thalamic_nuclei_maps(corrected, jacobian, thalamus_mask=thalamus, chunk_size=7)
+    for max_prob, legacy_max_prob in zip(results, legacy[:3]):
+        assert max_prob.dtype == np.uint16
+        assert np.array_equal(max_prob, legacy_max_prob)
+    assert corrected.dtype == np.float32
+    assert np.allclose(corrected, legacy[3], atol=1e-6)
+
+
+def test_without_thalamus_mask():
+    spams, jacobian, thalamus = _synthetic_maps()
+    legacy = _legacy_processing(spams, jacobian, thalamus)
+    corrected = spams.copy()
+    _, max_prob_jacobian, max_prob = correct_thalamic_nuclei_maps(corrected, jacobian)
+    assert np.array_equal(max_prob_jacobian, legacy[1])
+    assert np.array_equal(max_prob, legacy[1])
+    assert np.count_nonzero(corrected) > np.count_nonzero(legacy[3])
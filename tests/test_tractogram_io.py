@@ -0,0 +1,78 @@
+"""Round-trip tests of the lazy tractogram filtering of `cmtklib.diffusion` on TRK and TCK files."""
+
+import os
+
+import nibabel as nib
+import numpy as np
+
+from cmtklib.diffusion import (
+    compute_length_array,
+    filter_fibers,
+    iter_streamline_chunks,
+    save_streamlines_subset,
+)
+from cmtklib.util import streamline_lengths
+
+
+def _save_tractogram(fname, streamlines, affine):
+    """Save streamlines given in RAS+ mm to a TRK or TCK file."""
+    tractogram = nib.streamlines.Tractogram(streamlines, affine_to_rasmm=np.eye(4))
+    header = None
+    if fname.endswith(".trk"):
+        header = {
+            nib.streamlines.Field.VOXEL_TO_RASMM: affine,
+            nib.streamlines.Field.VOXEL_SIZES: np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0)),
+            nib.streamlines.Field.DIMENSIONS: (20, 20, 20),
+            nib.streamlines.Field.VOXEL_ORDER: "RAS",
+        }
+    nib.streamlines.save(tractogram, fname, header=header)
+
+
+def _straight_streamlines():
+    """Straight streamlines of lengths 10, 30, 60 and 600 mm (given by their first and last points)."""
+    streamlines = []
+    for n, step in [(11, 1.0), (7, 5.0), (13, 5.0), (61, 10.0)]:
+        points = np.zeros((n, 3), dtype=np.float32)
+        points[:, 0] = np.arange(n) * step
+        points[:, 1] = 2.0
+        streamlines.append(points)
+    return streamlines
+
+
+def test_tck_filter_round_trip(tmpdir):
+    # filter_fibers() saves the length array in the working directory
+    tmpdir.chdir()
+    streamlines = _straight_streamlines()
+    in_file = os.path.join(str(tmpdir), "tracks.tck")
+    out_file = os.path.join(str(tmpdir), "tracks_cutfiltered.tck")
+    _save_tractogram(in_file, streamlines, np.eye(4))
+
+    lengths = compute_length_array(in_file, savefname=os.path.join(str(tmpdir), "lengths.npy"))
+    assert np.allclose(lengths, [10, 30, 60, 600])
+
+    filter_fibers(in_file, out_file, fiber_cutoff_lower=20, fiber_cutoff_upper=500)
+    filtered = list(nib.streamlines.load(out_file).streamlines)
+    assert len(filtered) == 2
+    for streamline, expected in zip(filtered, streamlines[1:3]):
+        assert np.allclose(streamline, expected, atol=1e-4)
+
+    subset_file = os.path.join(str(tmpdir), "subset.tck")
+    assert save_streamlines_subset(in_file, subset_file, np.array([0, 3])) == 2
+    subset = list(nib.streamlines.load(subset_file).streamlines)
+    assert np.allclose(subset[0], streamlines[0], atol=1e-4)
+    assert np.allclose(subset[1], streamlines[3], atol=1e-4)
+
+
+def test_trk_lengths_match_voxmm_lengths(tmpdir):
+    streamlines = _straight_streamlines()
+    affine = np.diag([2.0, 2.0, 2.5, 1.0])
+    affine[:3, 3] = [-20, -20, -25]
+    in_file = os.path.join(str(tmpdir), "tracks.trk")
+    _save_tractogram(in_file, streamlines, affine)
+
+    lengths = compute_length_array(in_file, savefname=os.path.join(str(tmpdir), "lengths.npy"))
+    voxmm_lengths = np.concatenate(
+        [streamline_lengths(points, offsets) for points, offsets in iter_streamline_chunks(in_file)]
+    )
+    assert np.allclose(lengths, voxmm_lengths, atol=1e-3)
+    assert np.allclose(lengths, [10, 30, 60, 600], atol=1e-3)